@@ -0,0 +1,153 @@
+"""
+Headless batch rendering of the group lineplots, one figure per behavior (its measures stacked)
+
+The data is read and aggregated once (aggregate_bins: mean, SE and count per bin and group), the figures are
+drawn from those small tables with the Agg backend in a process pool. A hash of the aggregated data and the
+plot settings of every figure is kept in the output folder, figures whose inputs did not change are skipped.
+"""
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+import pandas as pd
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from utils import find_behaviors_measures
+from plot_group_lineplots import (
+    load_data,
+    aggregate_bins,
+    draw_group_lineplot,
+    plot_out_path,
+    experiment_name,
+    surgery,
+    group_var,
+    x_axis_var,
+    custom_palette,
+    scale_factor,
+)
+
+hash_file = "figure_hashes.json"
+formats = ["pdf", "png"]
+n_jobs = None  # None uses all cores
+
+
+def figure_hash(agg, settings):
+    """
+    Hash of the aggregated data of a figure and the settings it is drawn with
+
+    Args:
+        agg (DataFrame): rows of aggregate_bins drawn in the figure
+        settings (dict): everything else that changes the figure (titles, colors, ...)
+
+    Returns:
+        str: hex digest
+    """
+    h = hashlib.sha1(pd.util.hash_pandas_object(agg, index=False).to_numpy().tobytes())
+    h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def render_figure(task):
+    """
+    Draws and saves one figure (runs in a worker process)
+
+    Args:
+        task (dict): path (without extension), behavior, measures, agg, hue_order
+
+    Returns:
+        str: path of the figure
+    """
+    measures = task["measures"]
+    fig, ax = plt.subplots(
+        nrows=len(measures), ncols=1, figsize=(8, 3.5 * len(measures)), squeeze=False
+    )
+    for i, measure in enumerate(measures):
+        agg = task["agg"][task["agg"]["measure"] == measure]
+        draw_group_lineplot(
+            ax[i, 0],
+            agg,
+            f"{surgery} {task['behavior']} {measure}",
+            task["hue_order"],
+        )
+
+    for text_obj in fig.findobj(match=plt.Text):
+        text_obj.set_fontsize(text_obj.get_fontsize() * scale_factor)
+
+    fig.tight_layout()
+    for fmt in formats:
+        fig.savefig(f"{task['path']}.{fmt}")
+    plt.close(fig)
+    return task["path"]
+
+
+def make_tasks(df):
+    """
+    One task per behavior, with only the aggregated rows it needs and the hash of its inputs
+    """
+    behaviors_measures = find_behaviors_measures(df)
+    agg = aggregate_bins(df, behaviors_measures)
+    hue_order = df[group_var].dropna().unique().tolist()
+
+    tasks = []
+    for behavior in dict.fromkeys(beh for beh, _ in behaviors_measures):
+        measures = [m for beh, m in behaviors_measures if beh == behavior]
+        agg_beh = agg[agg["behavior"] == behavior].reset_index(drop=True)
+        settings = {
+            "measures": measures,
+            "hue_order": hue_order,
+            "palette": custom_palette,
+            "x": x_axis_var,
+            "scale_factor": scale_factor,
+            "formats": formats,
+        }
+        tasks.append(
+            {
+                "path": f"{plot_out_path}/lineplots_{surgery}_{behavior}_{experiment_name}",
+                "behavior": behavior,
+                "measures": measures,
+                "agg": agg_beh,
+                "hue_order": hue_order,
+                "hash": figure_hash(agg_beh, settings),
+            }
+        )
+    return tasks
+
+
+def main():
+    os.makedirs(plot_out_path, exist_ok=True)
+    hash_path = os.path.join(plot_out_path, hash_file)
+    hashes = {}
+    if os.path.exists(hash_path):
+        with open(hash_path, "r") as f:
+            hashes = json.load(f)
+
+    tasks = make_tasks(load_data())
+
+    # Skip figures whose inputs did not change and whose files still exist
+    todo = [
+        task
+        for task in tasks
+        if hashes.get(task["path"]) != task["hash"]
+        or not all(os.path.exists(f"{task['path']}.{fmt}") for fmt in formats)
+    ]
+    print(
+        f"Rendering {len(todo)} of {len(tasks)} figures "
+        f"({len(tasks) - len(todo)} unchanged)"
+    )
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        for task, path in zip(todo, pool.map(render_figure, todo)):
+            hashes[task["path"]] = task["hash"]
+            print(f"Saved {path}")
+
+            # Save after every figure, so an interrupted batch does not render finished figures again
+            with open(hash_path, "w") as f:
+                json.dump(hashes, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,5 @@
 import pandas as pd
 import numpy as np
-import seaborn as sns
 import matplotlib.pyplot as plt
 import os
 from utils import find_behaviors_measures, calc_plot_dimensions, highlight_days
@@ -34,7 +33,10 @@ excludes = {
 }
 
 
-def main():
+def load_data():
+    """
+    Reads the processed data and applies the group stripping, exclusions and surgery subset
+    """
     df = pd.read_excel(data_path, dtype={"animal_id": str})
 
     # Strip the spaces
@@ -48,9 +50,85 @@ def main():
     df = df[df["surgery"] == surgery]
     print(df["surgery"].drop_duplicates())
     print(df[["treatment", "animal_id"]].drop_duplicates())
+    return df
+
+
+def aggregate_bins(df, behaviors_measures, x=x_axis_var, hue=group_var):
+    """
+    Mean, standard error and count per behavior, measure, x bin and group in one groupby,
+    the same estimates as sns.lineplot(..., errorbar="se") makes from the raw rows
+
+    Args:
+        df (DataFrame): processed data with the columns behavior, x, hue and the measures
+        behaviors_measures (list): (behavior, measure) tuples as returned by find_behaviors_measures
+        x (str): column of the x-axis bins
+        hue (str): column of the groups
+
+    Returns:
+        DataFrame: columns behavior, measure, x, hue, mean, se and n (rows without data have n == 0)
+    """
+    measures = sorted({measure for _, measure in behaviors_measures})
+    long = df.melt(
+        id_vars=["behavior", x, hue], value_vars=measures, var_name="measure"
+    )
+    agg = (
+        long.groupby(["behavior", "measure", x, hue], observed=True)["value"]
+        .agg(mean="mean", se="sem", n="count")
+        .reset_index()
+    )
+    keep = pd.MultiIndex.from_tuples(behaviors_measures, names=["behavior", "measure"])
+    return agg[pd.MultiIndex.from_frame(agg[["behavior", "measure"]]).isin(keep)]
+
+
+def draw_group_lineplot(ax, agg, title, hue_order, x=x_axis_var, hue=group_var):
+    """
+    Draws the pre-aggregated means of one behavior and measure as a line per group with a +/- SE band
+
+    Args:
+        ax: matplotlib Axes
+        agg (DataFrame): rows of aggregate_bins for one behavior and measure
+        title (str): subplot title
+        hue_order (list): order of the groups in the legend
+    """
+    x_max = agg[x].max()
+    for group in hue_order:
+        g = agg[(agg[hue] == group) & (agg["n"] > 0)]
+        if g.empty:
+            continue
+        color = custom_palette.get(group)
+        ax.plot(g[x], g["mean"], color=color, label=group)
+        ax.fill_between(
+            g[x],
+            g["mean"] - g["se"],
+            g["mean"] + g["se"],
+            color=color,
+            alpha=0.2,
+            linewidth=0,
+        )
+
+    ax.set_ylabel(agg["measure"].iloc[0])
+    ax.set_xlabel("Time bin (h)")
+    ax.set_title(title)
+    ax.set_xticks(np.arange(0, x_max, 12))
+    ax.legend(title=hue, bbox_to_anchor=(1.01, 0.5), loc="center left")
+    ax.margins(x=0)
+
+    highlight_days(
+        x_max,
+        ax,
+        dark_first=True,
+        light_color="#f2f2f2",
+        dark_color="#999999",
+    )
+
+
+def main():
+    df = load_data()
 
     # Extract all available behaviors and corresponding measures
     behaviors_measures = find_behaviors_measures(df)
+    agg = aggregate_bins(df, behaviors_measures)
+    hue_order = df[group_var].dropna().unique().tolist()
 
     # determine plot dimensions
     nrows = len(behaviors_measures)
@@ -58,34 +136,9 @@ def main():
     ax = ax.ravel()
 
     for i, (beh, measure) in enumerate(behaviors_measures):
-        # Slice data
-        df_beh = df[df["behavior"] == beh].copy()
-
-        # Plot
-        sns.lineplot(
-            data=df_beh,
-            x=x_axis_var,
-            y=measure,
-            ax=ax[i],
-            hue=group_var,
-            errorbar="se",
-            palette=custom_palette,
-        )
-
-        ax[i].set_ylabel(measure)
-        ax[i].set_xlabel("Time bin (h)")
-        ax[i].set_title(f"{surgery} {beh} {measure}")
-        ax[i].set_xticks(np.arange(0, df_beh[x_axis_var].max(), 12))
-        ax[i].legend(bbox_to_anchor=(1.01, 0.5), loc="center left")
-        ax[i].margins(x=0)
-
-        highlight_days(
-            df_beh[x_axis_var].max(),
-            ax[i],
-            dark_first=True,
-            light_color="#f2f2f2",
-            dark_color="#999999",
-        )
+        # Slice the aggregated data and plot
+        agg_beh = agg[(agg["behavior"] == beh) & (agg["measure"] == measure)]
+        draw_group_lineplot(ax[i], agg_beh, f"{surgery} {beh} {measure}", hue_order)
 
     for text_obj in plt.findobj(match=plt.Text):
         text_obj.set_fontsize(text_obj.get_fontsize() * scale_factor)
@@ -0,0 +1,37 @@
+'''
+Validates the batched multitaper engine against mne.time_frequency.psd_array_multitaper
+and compares their speed on random epochs
+
+Usage: python bench_multitaper.py [n_epochs] [n_jobs]
+'''
+
+import numpy as np
+import time
+import sys
+import os
+import mne
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from spectral_engine import multitaper_psd
+
+
+if __name__ == '__main__':
+    n_epochs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    sfreq = 500.
+    rng = np.random.default_rng(0)
+
+    for n_samples, bandwidth in [(250, None), (500, 3), (1000, 2), (501, 3)]:
+        data = rng.standard_normal((n_epochs, 4, n_samples))
+
+        start = time.perf_counter()
+        psds_mne, freqs_mne = mne.time_frequency.psd_array_multitaper(data, sfreq, fmin=0, fmax=100, bandwidth=bandwidth, verbose=False)
+        t_mne = time.perf_counter() - start
+
+        start = time.perf_counter()
+        psds, freqs = multitaper_psd(data, sfreq, fmin=0, fmax=100, bandwidth=bandwidth, n_jobs=n_jobs)
+        t_engine = time.perf_counter() - start
+
+        same = np.allclose(freqs, freqs_mne) and np.allclose(psds, psds_mne, rtol=1e-8, atol=0)
+        print(f'{n_samples} samples, bandwidth {bandwidth}: matches MNE: {same}, '
+              f'MNE {t_mne:.2f} s, engine {t_engine:.2f} s ({t_mne / t_engine:.1f}x)')
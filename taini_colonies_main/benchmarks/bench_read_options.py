@@ -0,0 +1,68 @@
+'''
+Benchmark of the epoch-read throughput for different HDF5 read options
+(chunk cache, page buffering, core driver) on a synthetic recording
+
+Usage: python bench_read_options.py [hours] [nwb_file]
+'''
+
+import numpy as np
+import h5py
+import tempfile
+import time
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from nwb_data_retrieval_functions import set_read_options, get_eeg_segments, get_sfreq
+from synthetic_recording import make_synthetic_nwb
+
+CONFIGS = {
+    'h5py default (1 MB cache)': {},
+    'chunk cache 64 MB': {'rdcc_nbytes': 64 * 1024**2, 'rdcc_nslots': 100003},
+    'chunk cache 64 MB, w0=1': {'rdcc_nbytes': 64 * 1024**2, 'rdcc_nslots': 100003, 'rdcc_w0': 1},
+    'page buffer 16 MB': {'page_buf_size': 16 * 1024**2},
+    'core driver (file in RAM)': {'driver': 'core'},
+}
+
+
+def bench_epoch_reads(nwb_file, n_epochs=2000, epoch_length=1.0, batch_size=256, seed=0):
+    '''
+        Reads n_epochs sorted random epochs in batches, like epoch_eeg does.
+        Every batch opens the file through open_nwb (reused with a file driver), so the options are measured
+        the way the retrieval functions use them
+        Returns epochs per second
+    '''
+    rng = np.random.default_rng(seed)
+    sfreq = get_sfreq(nwb_file)
+    samples_per_epoch = int(epoch_length * sfreq)
+    with h5py.File(nwb_file, 'r') as f:
+        n_samples = f['acquisition/filtered_EEG/data'].shape[0]
+    onsets = np.sort(rng.integers(0, n_samples - samples_per_epoch, n_epochs))
+    segments = [(s, s + samples_per_epoch) for s in onsets]
+
+    start = time.perf_counter()
+    out_filt, out_raw = None, None
+    for i in range(0, n_epochs, batch_size):
+        out_filt = get_eeg_segments(nwb_file, segments[i:i + batch_size], out=out_filt)
+        out_raw = get_eeg_segments(nwb_file, segments[i:i + batch_size], out=out_raw, filtered=False)
+    return n_epochs / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 1
+    with tempfile.TemporaryDirectory() as tmp:
+        if len(sys.argv) > 2:
+            nwb_file = sys.argv[2]
+        else:
+            nwb_file = os.path.join(tmp, 'synthetic.nwb')
+            print(f'Writing a synthetic recording of {hours} h to {nwb_file}')
+            make_synthetic_nwb(nwb_file, hours=hours, paged=True)
+
+        print(f'{"configuration":<30} {"epochs/s":>10}')
+        for name, options in CONFIGS.items():
+            set_read_options(options)
+            try:
+                print(f'{name:<30} {bench_epoch_reads(nwb_file):>10.1f}')
+            except (OSError, ValueError) as e:
+                print(f'{name:<30} {"failed":>10} ({e})')
+        set_read_options({})
@@ -0,0 +1,104 @@
+'''
+Creates a synthetic NWB recording with the same layout as nwb_create_with_filtering.py
+(raw_EEG, filtered_EEG, TTL_1-4, behavior event trace and coordinate data) for benchmarking
+'''
+
+from pynwb import NWBFile, NWBHDF5IO, TimeSeries
+from datetime import datetime
+from dateutil import tz
+from pynwb.file import Subject
+import numpy as np
+from pynwb.behavior import SpatialSeries, IntervalSeries, BehavioralEpochs
+from pynwb.ecephys import ElectricalSeries
+from ndx_events import TTLs
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+import h5py
+import sys
+
+LOCATIONS = ['OFC_right', 'S_right', 'EMG_right', 'EMG_left', 'S_left', 'OFC_left']
+BEHAVIORS = ['social_sniff', 'social_approach', 'social_contact', 'hide_in_nest']
+
+
+def make_synthetic_nwb(outname, hours=1, sfreq=500., n_events=2000, paged=False, seed=0):
+    '''
+        Writes a synthetic NWB recording
+
+        Args:
+            - outname: path, of the nwb file to write
+            - hours: float, length of the recording
+            - sfreq: float, sampling frequency
+            - n_events: int, number of scored bouts per behavior
+            - paged: bool, write the file with paged aggregation (needed for page_buf_size)
+            - seed: int, random seed
+    '''
+    rng = np.random.default_rng(seed)
+    n_samples = int(hours * 3600 * sfreq)
+    n_frames = int(hours * 3600 * 30)
+
+    nwb = NWBFile(session_description='Synthetic recording',
+                  identifier='colonies_00000_Day1',
+                  session_start_time=datetime.now(tz.tzlocal()),
+                  experiment_description='Colony/Arena_1_Position_1')
+    nwb.subject = Subject(subject_id='00000', species='Mus musculus', sex='M')
+
+    device = nwb.create_device(name='synthetic', description='synthetic', manufacturer='TaiNi')
+    nwb.add_electrode_column(name='label', description='label of electrode')
+    for i, location in enumerate(LOCATIONS):
+        electrode_group = nwb.create_electrode_group(name=f'EEG {i}', description=location, device=device, location=location)
+        nwb.add_electrode(x=0., y=0., z=0., imp=np.nan, location=location, filtering='unknown',
+                          group=electrode_group, label=location)
+    all_table_region = nwb.create_electrode_table_region(region=list(range(len(LOCATIONS))), description='all electrodes')
+
+    # Pink-ish noise around the TaiNi offset with a theta rhythm, plus some package loss
+    t = np.arange(n_samples) / sfreq
+    filt = np.cumsum(rng.standard_normal((n_samples, len(LOCATIONS))), axis=0)
+    filt -= np.convolve(filt[:, 0], np.ones(int(sfreq)) / sfreq, mode='same')[:, None]
+    filt = 1e-5 * filt / filt.std() + 2e-5 * np.sin(2 * np.pi * 7 * t)[:, None]
+    raw = 0.0095 + filt
+    for start in rng.integers(0, n_samples - 100, int(hours * 60)):
+        raw[start:start + 20] = 0
+
+    nwb.add_acquisition(ElectricalSeries(name='raw_EEG', data=H5DataIO(data=raw, compression=True),
+                                         electrodes=all_table_region, starting_time=0., rate=sfreq))
+    nwb.add_acquisition(ElectricalSeries(name='filtered_EEG', data=H5DataIO(data=filt, compression=True),
+                                         electrodes=all_table_region, starting_time=0., rate=sfreq,
+                                         filtering='5th Order Bandpass butterwort Filter. Low:0.5 Hz, High: 200, low_val:0.006, high_val:0.013, art:None'))
+
+    # One TTL pulse every 30 frames
+    ttl = np.arange(0, hours * 3600 - 1, 1.) + 0.25
+    for arena in range(1, 5):
+        nwb.add_acquisition(TTLs(name=f'TTL_{arena}', description=f'Processed TTL - Input {arena}',
+                                 timestamps=ttl, data=np.ones(len(ttl)), labels=[f'TTL_{arena}']))
+
+    # Event trace
+    all_epochs = BehavioralEpochs(name='all_colony_behaviors')
+    for behavior in BEHAVIORS:
+        starts = np.sort(rng.choice(np.arange(30, n_frames - 600), n_events, replace=False))
+        timestamps = np.empty(n_events * 2, dtype=int)
+        timestamps[::2] = starts
+        timestamps[1::2] = starts + rng.integers(5, 300, n_events)
+        events = np.tile([1, -1], n_events)
+        all_epochs.add_interval_series(IntervalSeries(name=behavior, description=behavior, data=events, timestamps=timestamps))
+    nwb.create_processing_module(name='behavior_v1_synthetic', description='synthetic event trace').add(all_epochs)
+
+    # Coordinate data
+    coordinate_module = nwb.create_processing_module(name='coordinate_data', description='synthetic coordinate data')
+    frames = np.arange(n_frames)
+    for a in [1, 2]:
+        coordinate_module.add(SpatialSeries(name=f'xy_center_{a}', description='synthetic',
+                                            data=np.cumsum(rng.standard_normal((n_frames, 2)), axis=0),
+                                            timestamps=frames, reference_frame='synthetic', unit='mm'))
+        coordinate_module.add(TimeSeries(name=f'motion_{a}', description='synthetic',
+                                         data=np.abs(rng.standard_normal((n_frames, 1))),
+                                         timestamps=frames, unit='N/A'))
+
+    if paged:
+        with NWBHDF5IO(file=h5py.File(outname, 'w', fs_strategy='page', fs_persist=True), mode='w') as io:
+            io.write(nwb)
+    else:
+        with NWBHDF5IO(outname, 'w') as io:
+            io.write(nwb)
+
+
+if __name__ == '__main__':
+    make_synthetic_nwb(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 1)
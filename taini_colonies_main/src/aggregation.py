@@ -0,0 +1,150 @@
+'''
+Group statistics of epoch arrays with one sort and segment reductions
+
+The epochs are sorted once by a composite key of metadata columns (e.g. injection, animal_id), so every
+group is a contiguous segment. Sums, sums of squares and counts of all groups are then computed with
+np.add.reduceat over the epoch axis of the whole (epochs, channels, freqs) array at once.
+Bad channels (the bads dict of the notebooks) are a mask of valid values instead of per-animal index lists.
+'''
+
+import numpy as np
+import pandas as pd
+
+
+def sort_by_keys(metadata, keys):
+    '''
+        Sort order of the epochs by a composite key
+
+        Args:
+            - metadata: pd.DataFrame, epoch metadata
+            - keys: str or list of str, metadata columns
+        Returns:
+            - order: 1D int array, epoch order that makes every group contiguous
+            - starts: 1D int array, first (sorted) position of every group
+            - groups: pd.DataFrame, the key values of every group (one row per group)
+    '''
+    keys = [keys] if isinstance(keys, str) else list(keys)
+    codes = [pd.factorize(metadata[key], sort=True)[0] for key in keys]
+    order = np.lexsort(codes[::-1])
+
+    sorted_codes = np.stack([code[order] for code in codes], axis=1)
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = np.any(sorted_codes[1:] != sorted_codes[:-1], axis=1)
+    starts = np.where(new_group)[0]
+
+    groups = metadata[keys].iloc[order[starts]].reset_index(drop=True)
+    return order, starts, groups
+
+
+def valid_mask(metadata, ch_names, bads={}, animal_col='animal_id'):
+    '''
+        Boolean mask (epochs, channels) of the values to use, from a dict animal: list of bad channels (or 'all')
+    '''
+    animals = metadata[animal_col].to_numpy()
+    valid = np.ones((len(metadata), len(ch_names)), dtype=bool)
+    for animal, bad_channels in bads.items():
+        bad = np.ones(len(ch_names), dtype=bool) if bad_channels == 'all' else np.isin(ch_names, bad_channels)
+        valid[np.ix_(animals == animal, bad)] = False
+    return valid
+
+
+def segment_stats(data, starts, valid=None):
+    '''
+        Mean, SEM and count per segment of sorted data
+
+        Args:
+            - data: np.array (epochs, ...), sorted so every segment is contiguous
+            - starts: 1D int array, first position of every segment
+            - valid: bool np.array broadcastable to data, values to use (NaNs are always left out)
+        Returns:
+            - mean, sem, count: np.arrays (segments, ...). SEM uses ddof=1 (NaN for a single value)
+    '''
+    data = np.asarray(data, dtype=float)
+    valid = ~np.isnan(data) if valid is None else np.broadcast_to(valid, data.shape) & ~np.isnan(data)
+    values = np.where(valid, data, 0)
+
+    count = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+    total = np.add.reduceat(values, starts, axis=0)
+    total_sq = np.add.reduceat(values ** 2, starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        var = (total_sq - count * mean ** 2) / (count - 1)
+        sem = np.sqrt(np.clip(var, 0, None) / count)
+    return mean, np.where(count > 1, sem, np.nan), count
+
+
+def aggregate(data, metadata, keys, valid=None):
+    '''
+        Mean, SEM and count of every group of epochs
+
+        Args:
+            - data: np.array (epochs, ...) e.g. PSDs (epochs, channels, freqs)
+            - metadata: pd.DataFrame, epoch metadata (e.g. epochs.metadata)
+            - keys: str or list of str, metadata columns to group by
+            - valid: bool np.array broadcastable to data, e.g. valid_mask(...)[..., np.newaxis]
+        Returns:
+            - groups: pd.DataFrame, key values of every group
+            - mean, sem, count: np.arrays (groups, ...)
+    '''
+    order, starts, groups = sort_by_keys(metadata, keys)
+    valid = None if valid is None else np.broadcast_to(valid, np.shape(data))[order]
+    mean, sem, count = segment_stats(np.asarray(data)[order], starts, valid)
+    return groups, mean, sem, count
+
+
+def hierarchical_aggregate(data, metadata, group_cols, animal_col='animal_id', valid=None):
+    '''
+        Animal first, then group: the mean per animal within every group, then the mean and SEM over animals
+
+        Args:
+            - data: np.array (epochs, ...)
+            - metadata: pd.DataFrame, epoch metadata
+            - group_cols: str or list of str, metadata columns of the groups (e.g. 'injection' or ['surgery', 'injection'])
+            - animal_col: str, metadata column with the animal of every epoch
+            - valid: bool np.array broadcastable to data, values to use
+        Returns:
+            - dict with
+                - animals: pd.DataFrame, group and animal of every row of animal_mean
+                - animal_mean, n_epochs: np.arrays (group x animal, ...)
+                - groups: pd.DataFrame, key values of every group
+                - mean, sem, n_animals: np.arrays (groups, ...), over the animals with data
+    '''
+    group_cols = [group_cols] if isinstance(group_cols, str) else list(group_cols)
+    animals, animal_mean, _, n_epochs = aggregate(data, metadata, group_cols + [animal_col], valid)
+
+    # Animals are already sorted by group, so the groups are segments of the animal rows
+    order, starts, groups = sort_by_keys(animals, group_cols)
+    mean, sem, n_animals = segment_stats(animal_mean[order], starts, n_epochs[order] > 0)
+    return {
+        'animals': animals,
+        'animal_mean': animal_mean,
+        'n_epochs': n_epochs,
+        'groups': groups,
+        'mean': mean,
+        'sem': sem,
+        'n_animals': n_animals
+    }
+
+
+def to_long_df(groups, ch_names=None, freqs=None, **arrays):
+    '''
+        Tidy DataFrame of aggregated (groups, channels, freqs) arrays, e.g. for seaborn
+
+        Args:
+            - groups: pd.DataFrame, key values of every group
+            - ch_names: list of str, channel names of axis 1 (None if the arrays have no channel axis)
+            - freqs: 1D array, frequencies of the last axis (None if the arrays have no frequency axis)
+            - **arrays: name=np.array (groups, [channels], [freqs]), e.g. mean=..., sem=...
+        Returns:
+            - pd.DataFrame with the group columns, channel, freq and one column per array
+    '''
+    axes = [('channel', ch_names), ('freq', freqs)]
+    axes = [(name, np.asarray(values)) for name, values in axes if values is not None]
+    grid = np.meshgrid(np.arange(len(groups)), *[np.arange(len(values)) for _, values in axes], indexing='ij')
+
+    df = groups.iloc[grid[0].ravel()].reset_index(drop=True)
+    for (name, values), idx in zip(axes, grid[1:]):
+        df[name] = values[idx.ravel()]
+    for name, values in arrays.items():
+        df[name] = np.asarray(values).ravel()
+    return df
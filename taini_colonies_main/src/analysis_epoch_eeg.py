@@ -18,6 +18,9 @@ import sys
 
 # taini_colonies stuff
 from nwb_data_retrieval_functions import *
+from ragged_epochs import make_ragged_store
+from prefetch_pipeline import run_pipeline
+from filtering_functions import decimation_factors, decimation_padding, decimate
 
 
 def get_behavior_eeg_onsets(nwb_file, behavior):
@@ -40,70 +43,138 @@ def get_behavior_eeg_onsets(nwb_file, behavior):
     events = get_event_trace(nwb_file)
     sfreq = get_sfreq(nwb_file)
 
-    def find_ttl_pulse(frame_number):
-        # Check if the input frame number falls exactly on a TTL pulse
-        if (frame_number % 30) == 0:
-            pulse_number = frame_number // 30
-            return pulse_number, frame_number
-        else:
-            # Calculate the last TTL pulse number
-            last_pulse = (frame_number - 1) // 30 + 1
-            last_frame = (last_pulse - 1) * 30 
-            
-            # Calculate the next TTL pulse number
-            next_pulse = (frame_number + 29) // 30 + 1
-            next_frame = (next_pulse - 1) * 30
-            return last_pulse, last_frame, next_pulse, next_frame
-    
     behavior_onsets =  events[events['event']==behavior]['start_frame'].to_numpy()
     behavior_ends =  events[events['event']==behavior]['end_frame'].to_numpy()
-    b_on_corr = []
-    b_end_corr = []
-    sample_onsets = []
-    sample_ends = []
-    for behavior_onset_f, behavior_end_f in zip(behavior_onsets, behavior_ends):
-        behavior_duration = behavior_end_f - behavior_onset_f
-        
-        # First check if behavior length is ok
-        try: 
-            if len(find_ttl_pulse(behavior_onset_f)) == 2:
-                pulse_number, frame_number = find_ttl_pulse(behavior_onset_f)
-                computed_onset = ttl_onsets[pulse_number - 1]
-                sample_onsets.append(computed_onset)
-                sample_ends.append(int(computed_onset + sfreq*behavior_duration/30))
-                b_on_corr.append(behavior_onset_f)
-                b_end_corr.append(behavior_end_f)
-
-            else:
-                last_pulse, last_frame, next_pulse, next_frame = find_ttl_pulse(behavior_onset_f)
-
-                # Find these in EEG recording
-                last_eeg_pulse = ttl_onsets[last_pulse - 1]
-                next_eeg_pulse = ttl_onsets[next_pulse - 1]
-                
-                # Distance in seconds in recording
-                delta_F1 = (behavior_onset_f - last_frame) / 30
-                delta_F2 = (next_frame - behavior_onset_f) / 30
-                
-                # Solve for EEG sample onsets
-                x1 = int(delta_F1 * sfreq + last_eeg_pulse)
-                x2 = int(next_eeg_pulse - delta_F2 * sfreq)
-                
-                computed_onset = np.mean([x1, x2], dtype=int)
-                sample_onsets.append(computed_onset)
-                sample_ends.append(int(computed_onset + sfreq * behavior_duration / 30))
-                b_on_corr.append(behavior_onset_f)
-                b_end_corr.append(behavior_end_f)
-
-        except IndexError as e:
-            print(f"IndexError: {e}. Check if 'ttl_onsets' has sufficient elements.")
-            continue
+
+    # Frames to EEG samples through the TTL pulses (one pulse every 30 frames), all onsets at once
+    computed_onsets = frames_to_samples(behavior_onsets, ttl_onsets, sfreq)
+    found = computed_onsets >= 0
+    if not found.all():
+        print(f"{np.sum(~found)} onsets of {behavior} fall outside the TTL pulses ({len(ttl_onsets)} pulses) and are skipped")
+
+    sample_onsets = computed_onsets[found]
+    sample_ends = (sample_onsets + sfreq * (behavior_ends[found] - behavior_onsets[found]) / 30).astype(int)
+    b_on_corr = behavior_onsets[found]
+    b_end_corr = behavior_ends[found]
 
     return np.array(sample_onsets), np.array(sample_ends), np.array(b_on_corr), np.array(b_end_corr)
 
 
+def build_interval_index(events, behaviors=None):
+    '''
+        Builds a sorted interval index over the events of an event trace,
+        so that overlaps can be looked up with np.searchsorted instead of scanning the DataFrame
+
+        Args:
+            - events: pd.DataFrame, event trace as returned by get_event_trace (start_frame, end_frame, event)
+            - behaviors: list of str, behaviors to index. If None all behaviors in the trace are indexed
+        Returns:
+            - dict, keys: behavior labels
+                    values: tuple of (sorted start frames, running maximum of the end frames)
+    '''
+    events = events.dropna(subset=['start_frame', 'end_frame', 'event'])
+    if behaviors is None:
+        behaviors = events['event'].unique()
+
+    index = {}
+    for behavior in behaviors:
+        beh_events = events[events['event'] == behavior]
+        order = np.argsort(beh_events['start_frame'].to_numpy(), kind='stable')
+        starts = beh_events['start_frame'].to_numpy()[order].astype(np.int64)
+        ends = beh_events['end_frame'].to_numpy()[order].astype(np.int64)
+
+        # Bouts of one behavior can overlap each other, so keep the running maximum
+        # of the ends: a window overlaps a bout if any bout starting before the window
+        # end finishes after the window start
+        index[behavior] = (starts, np.maximum.accumulate(ends) if ends.size else ends)
+    return index
+
+
+def find_overlapping_behaviors(interval_index, window_starts, window_ends):
+    '''
+        Finds which indexed behaviors overlap each epoch window, for all windows at once
+
+        Args:
+            - interval_index: dict, as returned by build_interval_index
+            - window_starts: 1D array of window start frames
+            - window_ends: 1D array of window end frames (exclusive)
+        Returns:
+            - pd.DataFrame of bools, rows: windows, columns: behaviors in the index
+    '''
+    window_starts = np.asarray(window_starts)
+    window_ends = np.asarray(window_ends)
+
+    overlaps = {}
+    for behavior, (starts, max_ends) in interval_index.items():
+        # Number of bouts that start before the end of each window
+        n_before = np.searchsorted(starts, window_ends, side='left')
+        if max_ends.size == 0:
+            overlaps[behavior] = np.zeros(window_starts.size, dtype=bool)
+            continue
+        last_end = max_ends[np.maximum(n_before - 1, 0)]
+        overlaps[behavior] = (n_before > 0) & (last_end > window_starts)
+    return pd.DataFrame(overlaps, index=np.arange(window_starts.size))
+
+
+def find_circ_phase(behavior_ends):
+    '''
+        Find whether a behavior was done on the light or dark phase.
+        Assumes that recordings always start on the start of the dark phase.
+        If a behavior lasts from one phase to the other, we score it as it happened during the second phase
+
+        Args:
+            behavior_ends: array, of all end frames of the scored behaviors
+        Returns:
+            array of str, of corresponding phases (light or dark)
+    '''
+    fps = 30
+    seconds_in_hour = 3600
+    hours_per_phase = 12
+
+    # Convert frame numbers to hours
+    behavior_end_hours = np.array(behavior_ends) / (fps * seconds_in_hour)
+
+    # Determine the phase for each behavior based on the end hour
+    end_phase = (behavior_end_hours // hours_per_phase) % 2  # 0 for dark, 1 for light
+
+    return np.where(end_phase == 1, 'light', 'dark')
+
+
+def make_epoch_metadata(nwb_file, behavior, behavior_onsets, behavior_ends, frame_onsets, frame_ends):
+    '''
+        Creates the epoch metadata table (one row per behavior bout)
+
+        Args:
+            - nwb_file: path, of the nwb_file
+            - behavior: str, of behavior label (e.g. social_sniff)
+            - behavior_onsets, behavior_ends, frame_onsets, frame_ends: arrays as returned by get_behavior_eeg_onsets
+        Returns:
+            - pd.DataFrame of epoch metadata
+    '''
+    animal_id =  get_animal_id(nwb_file)   
+    arena = get_arena_id(nwb_file)
+    day = get_day(nwb_file)
+    circ_phase = find_circ_phase(frame_ends)
+    
+    # Create metadata table
+    return pd.DataFrame({
+        'animal_id' : animal_id,
+        'arena': arena,
+        'day': day,
+        'circ_phase': circ_phase,
+        'behavior_label': behavior,
+        'beh_start_frame': frame_onsets,
+        'beh_end_frame': frame_ends,
+        'beh_dur_frame': frame_ends - frame_onsets,
+        'beh_start_sample': behavior_onsets,
+        'beh_end_sample': behavior_ends,
+        'beh_dur_sample': behavior_ends - behavior_onsets
+    })
+
 
-def epoch_eeg(nwb_file, behavior, epoch_length=1.0, relative_start = 0, ploss_threshold = 10):
+def epoch_eeg(nwb_file, behavior, epoch_length=1.0, relative_start = 0, ploss_threshold = 10,
+              overlap=None, overlap_behaviors=None, batch_size=256, prefetch_depth=2, target_sfreq=None,
+              vigilance=None):
     '''
         Args:
             - nwb_file: path, of the nwb_file
@@ -112,10 +183,25 @@ def epoch_eeg(nwb_file, behavior, epoch_length=1.0, relative_start = 0, ploss_th
             - relative_start: seconds relative to the behavior onset which we use to get the eeg sample
                 for example if relative start=-1 we get the eeg sample 1 second before the onset of the behavior
             - ploss_threshold: int or float, milliseconds of packageloss above which an epoch is excluded
+            - overlap: None, 'drop' or 'annotate'. What to do with epochs whose window overlaps other behaviors:
+                None keeps them, 'drop' removes them and 'annotate' adds an 'overlapping_behaviors' metadata column
+            - overlap_behaviors: list of str, behaviors checked for overlap. If None all other behaviors are checked
+            - batch_size: int, number of epochs read from the file at once
+            - prefetch_depth: int, number of batches read ahead while the current batch is processed
+            - target_sfreq: float, decimate the epochs to (about) this sampling frequency with an anti-aliasing
+                polyphase filter. The sample based metadata columns are converted as well. None keeps the full rate
+            - vigilance: None, 'annotate' or list of str. Uses the hypnogram of nwb_add_hypnogram.py: 'annotate' adds a
+                'vigilance_state' metadata column with the state at the behavior onset, a list of states
+                (e.g. ['wake']) keeps only the epochs in those states (and annotates them)
         Returns:
             - mne.EpochsArray of behavioral EEG epochs (bad epochs are removed)
 
     '''
+    if overlap not in [None, 'drop', 'annotate']:
+        raise ValueError('overlap must be either None, "drop" or "annotate"')
+    if isinstance(vigilance, str) and vigilance != 'annotate':
+        raise ValueError('vigilance must be either None, "annotate" or a list of states')
+
     print(f"Gonna epoch now for {nwb_file}")
 
     behavior_onsets, behavior_ends, frame_onsets, frame_ends = get_behavior_eeg_onsets(nwb_file, behavior)
@@ -123,32 +209,72 @@ def epoch_eeg(nwb_file, behavior, epoch_length=1.0, relative_start = 0, ploss_th
     if behavior_onsets.size == 0:
         print(f'No Behaviors were scored for {nwb_file}')
         return None
+
+    if overlap:
+        # Epoch windows in frames, so they can be compared to the event trace directly
+        fps = 30
+        window_starts = frame_onsets + int(relative_start * fps)
+        window_ends = window_starts + int(np.ceil(epoch_length * fps))
+
+        events = get_event_trace(nwb_file)
+        if overlap_behaviors is None:
+            overlap_behaviors = [b for b in events['event'].dropna().unique() if b != behavior]
+        overlaps = find_overlapping_behaviors(build_interval_index(events, overlap_behaviors), window_starts, window_ends)
     
     sfreq = get_sfreq(nwb_file, filtered=False)
     relative_start = int(relative_start*sfreq)
+    tmin = relative_start / sfreq  # epochs.times are relative to the behavior onset
     samples_per_epoch = int(epoch_length * sfreq)
 
-    # Initialize empty dict to store epochs
-    data = {}
-    bad_epochs = []
-
-    # Extract epochs from behavior onsets
-    for i, start_sample in enumerate(behavior_onsets):
-        epoch_start = start_sample + relative_start
-        epoch_end = epoch_start + samples_per_epoch
-
-        # Load EEG data for the current epoch
-        filt = get_filtered_eeg(nwb_file, segment=(epoch_start, epoch_end))
-        ploss, _ = get_package_loss(nwb_file, segment=(epoch_start, epoch_end))
-
-        for location, eeg in filt.items():
-            if location not in data:
-                data[location] = np.zeros((behavior_onsets.size, samples_per_epoch))
-            data[location][i] = eeg
-
-            # Check package loss threshold
-            if np.sum(np.isnan(ploss[location])) > int(sfreq * ploss_threshold / 1000):
-                bad_epochs.append(i)
+    # Anti-aliased decimation, the filtered segments are read with padding so the filter can settle
+    pad = 0
+    if target_sfreq is not None and target_sfreq < sfreq:
+        up, down, new_sfreq = decimation_factors(sfreq, target_sfreq)
+        pad = decimation_padding(up, down)
+        print(f'Decimating from {sfreq} Hz to {new_sfreq} Hz (up={up}, down={down})')
+
+    # Read the epochs in batches of segments, prefetching the next batch while the current one is processed
+    segments = [(start_sample + relative_start, start_sample + relative_start + samples_per_epoch)
+                for start_sample in behavior_onsets]
+
+    # Epochs (with padding) that do not fit in the recording are bad
+    n_samples = get_n_samples(nwb_file)
+    in_recording = np.array([(start - pad >= 0) and (end + pad <= n_samples) for start, end in segments], dtype=bool)
+    segments = [segment for segment, ok in zip(segments, in_recording) if ok]
+
+    batches = [segments[i:i + batch_size] for i in range(0, len(segments), batch_size)]
+    low_val, high_val, art = get_filtering_info(nwb_file)
+    max_ploss = int(sfreq * ploss_threshold / 1000)
+
+    def read_batch(batch, out):
+        filt_out, raw_out = out if out is not None else (None, None)
+        padded = [(start - pad, end + pad) for start, end in batch]
+        return (get_eeg_segments(nwb_file, padded, out=filt_out),
+                get_eeg_segments(nwb_file, batch, out=raw_out, filtered=False))
+
+    def process_batch(batch, batch_data):
+        filt, raw = batch_data
+        # Check package loss threshold, per epoch and channel
+        ploss = find_package_loss(raw.transpose(0, 2, 1), low_val, high_val, art)
+        bad = np.any(ploss.sum(axis=-1) > max_ploss, axis=-1)
+        filt = filt.transpose(0, 2, 1).astype(float)
+        if pad:
+            # Decimate the whole batch at once
+            filt = decimate(filt, up, down, pad=pad)
+        return filt, bad
+
+    results, _ = run_pipeline(batches, read_batch, process_batch, depth=prefetch_depth)
+    n_out = results[0][0].shape[-1] if results else samples_per_epoch
+    epochs_data = np.zeros((len(behavior_onsets), len(get_channel_locations(nwb_file)), n_out))
+    bad = ~in_recording
+    if results:
+        epochs_data[in_recording] = np.concatenate([r[0] for r in results])
+        bad[in_recording] = np.concatenate([r[1] for r in results])
+    bad_epochs = np.where(bad)[0].tolist()
+    data = {location: epochs_data[:, i] for i, location in enumerate(get_channel_locations(nwb_file))}
+
+    if pad:
+        sfreq = new_sfreq
     
     # Create channel info for MNE
     ch_names = list(data.keys())
@@ -160,84 +286,142 @@ def epoch_eeg(nwb_file, behavior, epoch_length=1.0, relative_start = 0, ploss_th
             ch_types.append('eeg')
     info = mne.create_info(ch_names=ch_names, ch_types=ch_types, sfreq=sfreq)
 
-    # Function to find circardian phase from frame number
-    def find_circ_phase(behavior_ends):
-        '''
-            Find whether a behavior was done on the light or dark phase.
-            Assumes that recordings always start on the start of the dark phase.
-            If a behavior lasts from one phase to the other, we score it as it happened during the second phase
-
-            Args:
-                behavior_ends: array, of all end frames of the scored behaviors
-            Returns:
-                array of str, of corresponding phases (light or dark)
-        '''
-        fps = 30
-        seconds_in_hour = 3600
-        hours_per_phase = 12
+    epoch_metadata = make_epoch_metadata(nwb_file, behavior, behavior_onsets, behavior_ends, frame_onsets, frame_ends)
+    day = epoch_metadata['day'][0]
 
-        # Convert frame numbers to hours
-        behavior_end_hours = np.array(behavior_ends) / (fps * seconds_in_hour)
+    if vigilance is not None:
+        # Vigilance state at the behavior onset, by one lookup in the hypnogram intervals
+        onset_times = behavior_onsets / get_sfreq(nwb_file, filtered=False)
+        epoch_metadata['vigilance_state'] = lookup_states(get_hypnogram(nwb_file), onset_times)
 
-        # Determine the phase for each behavior based on the end hour
-        end_phase = (behavior_end_hours // hours_per_phase) % 2  # 0 for dark, 1 for light
-
-        return np.where(end_phase == 1, 'light', 'dark')
-    
-    animal_id =  get_animal_id(nwb_file)   
-    arena = get_arena_id(nwb_file)
-    day = get_day(nwb_file)
-    circ_phase = find_circ_phase(frame_ends)
-    
-    # Create metadata table
-    epoch_metadata = pd.DataFrame({
-        'animal_id' : animal_id,
-        'arena': arena,
-        'day': day,
-        'circ_phase': circ_phase,
-        'behavior_label': behavior,
-        'beh_start_frame': frame_onsets,
-        'beh_end_frame': frame_ends,
-        'beh_dur_frame': frame_ends - frame_onsets,
-        'beh_start_sample': behavior_onsets,
-        'beh_end_sample': behavior_ends,
-        'beh_dur_sample': behavior_ends - behavior_onsets
-    })
+    if pad:
+        # Sample based columns in the decimated sampling frequency
+        for col in ['beh_start_sample', 'beh_end_sample', 'beh_dur_sample']:
+            epoch_metadata[col] = np.round(epoch_metadata[col] * up / down).astype(int)
 
     print(f'For {nwb_file} the day is: {day}')
 
+    # Create a mask for good epochs
+    good_epochs_mask = np.ones(len(behavior_onsets), dtype=bool)
+
     if bad_epochs:
         # Remove duplicate bad epoch indexes
         bad_epochs = np.unique(bad_epochs)
         print(f'Bad epochs for {nwb_file} listed: {bad_epochs}')
-
-        # Create a mask for good epochs
-        good_epochs_mask = np.ones(len(behavior_onsets), dtype=bool)
         good_epochs_mask[bad_epochs] = False
 
-        # Filter out bad epochs from the EEG data
-        cleaned_epochs = {location: data[location][good_epochs_mask] for location in data.keys()}
-                    
-        # Also, filter out the corresponding rows from the metadata dataframe
-        cleaned_metadata = epoch_metadata[good_epochs_mask].reset_index(drop=True)
-        print(f'Metadata: {cleaned_metadata}')
-
-        # Return cleaned_epochs
-        return mne.EpochsArray(
-            data=np.stack(list(cleaned_epochs.values()), axis=1), 
-            info=info,
-            metadata=cleaned_metadata
-        )
-
-
-    else:
-        print(f'Metadata: {cleaned_metadata}')
-
-        return mne.EpochsArray(
-                data=np.stack(list(cleaned_epochs.values()), axis=1), 
-                info=info,
-                metadata=cleaned_metadata
-            )
+    if overlap == 'drop':
+        overlapping = overlaps.any(axis=1).to_numpy()
+        print(f'Epochs overlapping other behaviors for {nwb_file}: {np.where(overlapping)[0]}')
+        good_epochs_mask &= ~overlapping
+    elif overlap == 'annotate':
+        epoch_metadata['overlapping_behaviors'] = [
+            ','.join(overlaps.columns[row]) for row in overlaps.to_numpy()
+        ]
+
+    if vigilance is not None and vigilance != 'annotate':
+        in_state = epoch_metadata['vigilance_state'].isin(vigilance).to_numpy()
+        print(f'Epochs not in {vigilance} for {nwb_file}: {np.where(~in_state)[0]}')
+        good_epochs_mask &= in_state
+
+    # Filter out bad epochs from the EEG data
+    cleaned_epochs = {location: data[location][good_epochs_mask] for location in data.keys()}
+
+    # Also, filter out the corresponding rows from the metadata dataframe
+    cleaned_metadata = epoch_metadata[good_epochs_mask].reset_index(drop=True)
+    print(f'Metadata: {cleaned_metadata}')
+
+    if not good_epochs_mask.any():
+        print(f'No good epochs left for {nwb_file}')
+        return None
+
+    # Return cleaned_epochs
+    return mne.EpochsArray(
+        data=np.stack(list(cleaned_epochs.values()), axis=1), 
+        info=info,
+        tmin=tmin,
+        metadata=cleaned_metadata
+    )
+
+
+def epoch_eeg_ragged(nwb_file, behavior, min_length=None, max_length=None, relative_start=0, ploss_threshold=10,
+                     batch_size=256, prefetch_depth=2):
+    '''
+        Epochs every behavior bout at its true duration (beh_dur_sample) into a ragged store,
+        instead of forcing all epochs to a fixed epoch_length
+
+        Args:
+            - nwb_file: path, of the nwb_file
+            - behavior: str, of behavior label (e.g. social_sniff)
+            - min_length: float, seconds. Shorter bouts are padded with the EEG that follows them
+            - max_length: float, seconds. Longer bouts are clipped to max_length
+            - relative_start: seconds relative to the behavior onset which we use to get the eeg sample
+            - ploss_threshold: int or float, milliseconds of packageloss above which a bout is excluded
+            - batch_size: int, number of bouts read from the file at once
+            - prefetch_depth: int, number of batches read ahead while the current batch is processed
+        Returns:
+            - dict, ragged store of the good bouts (see ragged_epochs.py). Bouts that do not fit in the recording
+                are bad
+    '''
+    print(f"Gonna epoch (ragged) now for {nwb_file}")
+
+    behavior_onsets, behavior_ends, frame_onsets, frame_ends = get_behavior_eeg_onsets(nwb_file, behavior)
+
+    if behavior_onsets.size == 0:
+        print(f'No Behaviors were scored for {nwb_file}')
+        return None
+
+    sfreq = get_sfreq(nwb_file, filtered=False)
+    relative_start = int(relative_start*sfreq)
+
+    # Bout lengths in samples, clipped or padded if asked
+    lengths = behavior_ends - behavior_onsets
+    if min_length is not None:
+        lengths = np.maximum(lengths, int(min_length * sfreq))
+    if max_length is not None:
+        lengths = np.minimum(lengths, int(max_length * sfreq))
+
+    # Bouts that do not fit in the recording are bad
+    starts = behavior_onsets + relative_start
+    ends = starts + lengths
+    in_recording = (starts >= 0) & (ends <= get_n_samples(nwb_file))
+    segments = list(zip(starts[in_recording], ends[in_recording]))
+
+    # Read the bouts in batches (one flat buffer per batch), prefetching the next batch while the current one is processed
+    batches = [segments[i:i + batch_size] for i in range(0, len(segments), batch_size)]
+    low_val, high_val, art = get_filtering_info(nwb_file)
+    max_ploss = int(sfreq * ploss_threshold / 1000)
+
+    def read_batch(batch, out):
+        filt_out, raw_out = out if out is not None else (None, None)
+        return (get_ragged_segments(nwb_file, batch, out=filt_out)[0],
+                get_ragged_segments(nwb_file, batch, out=raw_out, filtered=False)[0])
+
+    def process_batch(batch, batch_data):
+        filt, raw = batch_data
+        offsets = np.r_[0, np.cumsum([end - start for start, end in batch])]
+        bouts, bad = [], []
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            # Check package loss threshold, per channel
+            ploss = find_package_loss(raw[start:end].T, low_val, high_val, art)
+            bad.append(np.any(ploss.sum(axis=-1) > max_ploss))
+            bouts.append(filt[start:end].T.astype(float))
+        return bouts, bad
+
+    results, _ = run_pipeline(batches, read_batch, process_batch, depth=prefetch_depth)
+    bouts = [bout for batch_bouts, _ in results for bout in batch_bouts]
+    good_epochs_mask = in_recording.copy()
+    good_epochs_mask[in_recording] = ~np.array([b for _, batch_bad in results for b in batch_bad], dtype=bool)
+    bouts = [bout for bout, good in zip(bouts, good_epochs_mask[in_recording]) if good]
+
+    epoch_metadata = make_epoch_metadata(nwb_file, behavior, behavior_onsets, behavior_ends, frame_onsets, frame_ends)
+    print(f'Bad epochs for {nwb_file} listed: {np.where(~good_epochs_mask)[0]}')
+
+    if not bouts:
+        print(f'No good epochs left for {nwb_file}')
+        return None
+
+    return make_ragged_store(bouts, get_channel_locations(nwb_file), sfreq, epoch_metadata[good_epochs_mask])
 
 
 if __name__ == '__main__':
@@ -13,35 +13,90 @@ from pynwb import NWBHDF5IO
 import seaborn as sns
 from ndx_events import LabeledEvents, AnnotatedEventsTable, TTLs
 from .nwb_data_retrieval_functions import *
+from .psd_cache import psd_array_cached
+from .psd_statistics import hierarchical_bootstrap_ci
 from scipy import signal
 import re
 import os
 
 
-def eeg_plotter(eeg_dict, r):
+def plot_envelope(ax, times, stats, factor, **kwargs):
+    '''
+        Plots (3, bins) min / max / mean stats as a min-max band around the mean, or (1, samples) as a line at full
+        resolution (factor 1, see minmax_decimate)
+    '''
+    if factor == 1:
+        ax.plot(times, stats[-1], lw=0.5, **kwargs)
+    else:
+        ax.fill_between(times, stats[0], stats[1], lw=0, alpha=0.5, **kwargs)
+        ax.plot(times, stats[2], lw=0.5, **kwargs)
+
+def eeg_plotter(eeg_dict, r, n_pixels=None):
+    '''
+        Plots signal[r[0]:r[1]] of every channel, ranges with more samples than pixels are drawn as a min-max band
+        Args:
+            - eeg_dict: dict, location: 1D array (as returned by get_filtered_eeg)
+            - r: (start, end) in samples
+            - n_pixels: int, bins to draw (None: the width of the figure in pixels)
+    '''
     fig, ax = plt.subplots(nrows=1, figsize=(10,2))
+    n_pixels = n_pixels or int(fig.get_size_inches()[0] * fig.dpi)
     for location, signal in eeg_dict.items():
-        ax.plot(signal[r[0]:r[1]])
+        stats, factor = minmax_decimate(signal[r[0]:r[1]], n_pixels)
+        plot_envelope(ax, np.arange(stats.shape[-1]) * factor, stats, factor)
         ax.set_ylabel(location)
         ax.spines[['right', 'top', 'bottom']].set_visible(False)
     plt.tight_layout()
     plt.show()
 
-def plot_channel_psd(epochs, channel, fmin = 0, fmax = 100, method = 'multitaper', save_title=False, **kwargs):
-    if method == 'multitaper':
-        psds, freqs = mne.time_frequency.psd_array_multitaper(epochs.get_data(picks=channel), fmin=fmin, fmax=fmax, sfreq=epochs.info['sfreq'], **kwargs)
-    elif method == 'welch':
-        psds, freqs = epochs.compute_psd(method='welch', picks=channel, fmin=fmin, fmax=fmax, **kwargs).get_data(picks=channel)
-    else:
-        raise NotImplementedError('Please chose either "welch", or "multitaper" for method')
+def plot_eeg_overview(nwb_file, segment=None, picks=None, n_pixels=None, figsize=(12, 1.5), save_title=False):
+    '''
+        Overview of a long stretch of filtered EEG (up to whole days) from the EEG pyramid of the NWB file
+        The coarsest level with at least one bin per pixel is read (see nwb_add_eeg_pyramid.py), so only a few
+        thousand bins per channel are read and drawn. Without a pyramid the segment is streamed and decimated in blocks.
+        Args:
+            - nwb_file: path, of the nwb file
+            - segment: (start, end) in samples, None plots the whole recording
+            - picks: list of channel locations, None plots all channels
+            - n_pixels: int, bins to draw (None: the width of the figure in pixels)
+            - figsize: (width, height) of one channel
+        Returns:
+            - fig, axes
+    '''
+    n_pixels = n_pixels or int(figsize[0] * plt.rcParams['figure.dpi'])
+    eeg, factor, start = get_eeg_pyramid(nwb_file, segment, n_pixels=n_pixels)
+    sfreq = get_sfreq(nwb_file)
+    picks = list(eeg) if picks is None else picks
+
+    fig, axes = plt.subplots(nrows=len(picks), figsize=(figsize[0], figsize[1] * len(picks)), sharex=True, squeeze=False)
+    for ax, location in zip(axes[:, 0], picks):
+        stats = eeg[location]
+        hours = (start + (np.arange(stats.shape[-1]) + 0.5) * factor) / sfreq / 3600
+        plot_envelope(ax, hours, stats, factor, color='k')
+        ax.set_ylabel(location)
+        ax.spines[['right', 'top']].set_visible(False)
+    axes[-1, 0].set_xlabel('Time (h)')
+    plt.tight_layout()
+    if save_title:
+        plt.savefig(f'eeg_overview_{save_title}.pdf')
+    return fig, axes[:, 0]
+
+def plot_channel_psd(epochs, channel, fmin = 0, fmax = 100, method = 'multitaper', save_title=False, err_method='ci', **kwargs):
+    # PSDs are looked up in the PSD cache first
+    psds, freqs = psd_array_cached(epochs.get_data(picks=channel), epochs.info['sfreq'], fmin=fmin, fmax=fmax, method=method, **kwargs)
     
-    mean_psd = np.mean(psds[:, 0, :], axis=0)
-    conf_int = 1.96 * np.std(psds[:, 0, :], axis=0) / np.sqrt(psds.shape[0])  # 95% confidence interval
+    if err_method == 'bootstrap':
+        # Hierarchical (animal, then epochs) bootstrap 95% CI of the animal-level mean
+        mean_psd, lower, upper = hierarchical_bootstrap_ci(psds[:, 0, :], epochs.metadata['animal_id'].to_numpy())
+    else:
+        mean_psd = np.mean(psds[:, 0, :], axis=0)
+        conf_int = 1.96 * np.std(psds[:, 0, :], axis=0) / np.sqrt(psds.shape[0])  # 95% confidence interval
+        lower, upper = mean_psd - conf_int, mean_psd + conf_int
     
     # Plot
     fig, ax = plt.subplots(figsize=(8, 6))
     ax.plot(freqs, 10 * np.log10(mean_psd), label='Average PSD', color='b')
-    ax.fill_between(freqs, 10 * np.log10(mean_psd - conf_int), 10 * np.log10(mean_psd + conf_int), alpha=0.2, color='b', label='95% CI')
+    ax.fill_between(freqs, 10 * np.log10(lower), 10 * np.log10(upper), alpha=0.2, color='b', label='95% CI')
     ax.set_xlabel('Frequency (Hz)')
     ax.set_ylabel('Power/Frequency (dB/Hz)')
     ax.set_title(f'Average (PSD) - {channel}')
@@ -59,14 +114,9 @@ def plot_two_channel_psd(epochs1, epochs2, label1, label2, channel, fmin = 0, fm
     elif channel == 'all':
         pass
     else:
-        if method == 'multitaper':
-            psds1, freqs1 = mne.time_frequency.psd_array_multitaper(epochs1.get_data(picks=channel), fmin=fmin, fmax=fmax, sfreq=epochs1.info['sfreq'], **kwargs)
-            psds2, freqs2 = mne.time_frequency.psd_array_multitaper(epochs2.get_data(picks=channel), fmin=fmin, fmax=fmax, sfreq=epochs2.info['sfreq'], **kwargs)
-        elif method == 'welch':
-            psds1, freqs1 = epochs1.compute_psd(method='welch', picks=channel, fmin=fmin, fmax=fmax, **kwargs).get_data(picks=channel)
-            psds2, freqs2 = epochs2.compute_psd(method='welch', picks=channel, fmin=fmin, fmax=fmax, **kwargs).get_data(picks=channel)
-        else:
-            raise NotImplementedError('Please chose either "welch", or "multitaper" for method')
+        # PSDs are looked up in the PSD cache first
+        psds1, freqs1 = psd_array_cached(epochs1.get_data(picks=channel), epochs1.info['sfreq'], fmin=fmin, fmax=fmax, method=method, **kwargs)
+        psds2, freqs2 = psd_array_cached(epochs2.get_data(picks=channel), epochs2.info['sfreq'], fmin=fmin, fmax=fmax, method=method, **kwargs)
         
         mean_psd1 = np.mean(psds1[:, 0, :], axis=0)
         conf_int1 = 1.96 * np.std(psds1[:, 0, :], axis=0) / np.sqrt(psds1.shape[0])  # 95% confidence interval
@@ -0,0 +1,116 @@
+'''
+Band power features from one PSD per epoch and channel
+
+Instead of one multitaper estimate per band, the PSD is computed once over the full range
+and all bands are integrated with one matrix multiply against a band-to-bin index matrix.
+'''
+
+import numpy as np
+import pandas as pd
+try:
+    from .spectral_engine import multitaper_psd
+except ImportError:
+    # Imported by the scripts run from src (nwb_add_spectral_summary.py), outside the package
+    from spectral_engine import multitaper_psd
+
+# Same bands as in epoch_visualization.ipynb
+FREQ_BANDS = {
+    'delta': (1, 4),
+    'theta': (4, 8),
+    'alpha': (8, 13),
+    'beta': (13, 30),
+    'gamma': (30, 100)
+}
+
+
+def band_matrix(freqs, bands=FREQ_BANDS):
+    '''
+        Band-to-bin index matrix
+
+        Args:
+            - freqs: 1D np.array of PSD frequencies
+            - bands: dict, band name: (fmin, fmax). A bin belongs to a band if fmin <= f < fmax
+                (the last bin of the highest band is included, so fmax=100 keeps the 100 Hz bin)
+        Returns:
+            - 2D np.array (freqs, bands) of 0/1
+    '''
+    top = max(fmax for _, fmax in bands.values())
+    matrix = np.zeros((len(freqs), len(bands)))
+    for i, (fmin, fmax) in enumerate(bands.values()):
+        matrix[:, i] = (freqs >= fmin) & ((freqs < fmax) | ((fmax == top) & (freqs == fmax)))
+    return matrix
+
+
+def compute_band_power(psds, freqs, bands=FREQ_BANDS):
+    '''
+        Integrates the PSD over all bands at once
+
+        Args:
+            - psds: np.array (epochs, channels, freqs)
+            - freqs: 1D np.array of frequencies
+            - bands: dict, band name: (fmin, fmax)
+        Returns:
+            - absolute: np.array (epochs, channels, bands), band power (PSD integrated over the band)
+            - relative: np.array (epochs, channels, bands), absolute power divided by the power over all bands
+    '''
+    df = freqs[1] - freqs[0] if len(freqs) > 1 else 1
+    matrix = band_matrix(freqs, bands)
+    absolute = psds @ matrix * df
+    total = psds @ matrix.any(axis=1).astype(float) * df
+    relative = absolute / total[..., np.newaxis]
+    return absolute, relative
+
+
+def band_power_features(data, sfreq, ch_names, metadata=None, bands=FREQ_BANDS, bandwidth=None, n_jobs=1):
+    '''
+        One multitaper PSD per epoch and channel, integrated over all bands
+
+        Args:
+            - data: np.array (epochs, channels, samples), e.g. epochs.get_data()
+            - sfreq: float, sampling frequency
+            - ch_names: list of str, channel names
+            - metadata: pd.DataFrame, epoch metadata (e.g. epochs.metadata), joined on the epoch index
+            - bands: dict, band name: (fmin, fmax)
+            - bandwidth: float, multitaper bandwidth
+            - n_jobs: int, threads for the multitaper engine
+        Returns:
+            - tidy pd.DataFrame with columns epoch, channel, band, absolute, relative, db (+ metadata)
+    '''
+    fmin = min(low for low, _ in bands.values())
+    fmax = max(high for _, high in bands.values())
+    psds, freqs = multitaper_psd(data, sfreq, fmin=fmin, fmax=fmax, bandwidth=bandwidth, n_jobs=n_jobs)
+    absolute, relative = compute_band_power(psds, freqs, bands)
+
+    n_epochs, n_channels, n_bands = absolute.shape
+    with np.errstate(divide='ignore'):
+        db = 10 * np.log10(absolute)
+    tidy = pd.DataFrame({
+        'epoch': np.repeat(np.arange(n_epochs), n_channels * n_bands),
+        'channel': np.tile(np.repeat(ch_names, n_bands), n_epochs),
+        'band': np.tile(list(bands.keys()), n_epochs * n_channels),
+        'absolute': absolute.ravel(),
+        'relative': relative.ravel(),
+        'db': np.where(np.isfinite(db), db, np.nan).ravel()
+    })
+    if metadata is not None:
+        tidy = tidy.join(metadata.reset_index(drop=True), on='epoch')
+    return tidy
+
+
+def epochs_band_power(epochs, picks=None, **kwargs):
+    '''
+        band_power_features for an mne.Epochs object (metadata included)
+    '''
+    ch_names = list(epochs.ch_names) if picks is None else ([picks] if isinstance(picks, str) else list(picks))
+    return band_power_features(epochs.get_data(picks=ch_names), epochs.info['sfreq'], ch_names,
+                               metadata=epochs.metadata, **kwargs)
+
+
+def band_power_wide(tidy, value='db'):
+    '''
+        Pivots the tidy band power table to one row per epoch with <channel>_<band> columns,
+        the naming used by feature_engineer_epochs
+    '''
+    wide = tidy.pivot(index='epoch', columns=['channel', 'band'], values=value)
+    wide.columns = [f'{channel}_{band}' for channel, band in wide.columns]
+    return wide.reset_index(drop=True)
@@ -0,0 +1,218 @@
+'''
+Spectral connectivity from one cross-spectral density tensor
+
+The DPSS-tapered FFT of every epoch is computed once and all channel pairs are formed in one einsum,
+giving the (epochs, channels, channels, freqs) cross-spectral density. Coherence, imaginary coherence,
+PLV and wPLI (same definitions as mne_connectivity.spectral_connectivity_epochs with mode='multitaper')
+are all derived from that tensor, and per-group results only average the per-epoch terms again.
+grouped_connectivity does this in chunks of epochs and only keeps the per-group sums of the terms,
+so the memory use does not grow with the number of epochs.
+'''
+
+import numpy as np
+import pandas as pd
+from scipy import fft
+from .spectral_engine import get_dpss_tapers
+
+METHODS = ['coh', 'imcoh', 'plv', 'wpli']
+
+
+def tapered_fft(data, tapers, weights, fmask):
+    '''
+        Eigenvalue-weighted DPSS-tapered FFT of a chunk of epochs, only at the frequencies of fmask
+
+        Returns:
+            - complex np.array (epochs, channels, tapers, freqs)
+    '''
+    data = data - data.mean(axis=-1, keepdims=True)
+    x_mt = fft.rfft(data[:, :, np.newaxis, :] * tapers, axis=-1)[..., fmask]
+    x_mt *= weights[:, np.newaxis]
+    return x_mt
+
+
+def epoch_csd(data, sfreq, fmin=0, fmax=np.inf, bandwidth=None, low_bias=True):
+    '''
+        Multitaper cross-spectral density of every epoch, for all channel pairs
+
+        Args:
+            - data: np.array (epochs, channels, samples)
+            - sfreq: float, sampling frequency
+            - fmin, fmax: float, frequency range
+            - bandwidth: float, multitaper bandwidth (None as in MNE)
+            - low_bias: bool, only keep tapers with a spectral concentration > 0.9
+        Returns:
+            - csd: complex np.array (epochs, channels, channels, freqs), csd[e, i, j] = S_ij of epoch e
+            - freqs: 1D np.array of frequencies
+    '''
+    data = np.asarray(data, dtype=float)
+    n_samples = data.shape[-1]
+    tapers, eigvals = get_dpss_tapers(n_samples, float(sfreq), bandwidth, low_bias)
+    freqs = fft.rfftfreq(n_samples, 1.0 / sfreq)
+    fmask = (freqs >= fmin) & (freqs <= fmax)
+
+    weights = np.sqrt(eigvals)
+    x_mt = tapered_fft(data, tapers, weights, fmask)
+
+    # Sum over tapers of x_i * conj(x_j) for all pairs at once
+    csd = np.einsum('eitf,ejtf->eijf', x_mt, x_mt.conj()) * (2 / np.sum(weights ** 2))
+    return csd, freqs[fmask]
+
+
+def epoch_terms(csd):
+    '''
+        Per-epoch terms that are averaged over epochs by the connectivity estimators
+
+        Returns:
+            - dict of np.arrays (epochs, channels, channels, freqs): csd, phase (csd / |csd|)
+                and imag (imaginary part of the csd)
+    '''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        phase = csd / np.abs(csd)
+    return {
+        'csd': csd,
+        'phase': np.nan_to_num(phase),
+        'imag': csd.imag
+    }
+
+
+def connectivity_from_means(mean_csd, mean_phase, mean_imag, mean_abs_imag, methods=METHODS):
+    '''
+        Connectivity estimators from epoch-averaged terms
+
+        Args:
+            - mean_csd: complex np.array (..., channels, channels, freqs), mean cross-spectral density
+            - mean_phase: complex np.array, mean of csd / |csd|
+            - mean_imag: np.array, mean of Im(csd)
+            - mean_abs_imag: np.array, mean of |Im(csd)|
+            - methods: list of str, "coh", "imcoh", "plv" and/or "wpli"
+        Returns:
+            - dict, method: np.array (..., channels, channels, freqs)
+    '''
+    power = np.real(np.diagonal(mean_csd, axis1=-3, axis2=-2))  # (..., freqs, channels)
+    power = np.moveaxis(power, -1, -2)  # (..., channels, freqs)
+    norm = np.sqrt(power[..., :, np.newaxis, :] * power[..., np.newaxis, :, :])
+
+    out = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for method in methods:
+            if method == 'coh':
+                out[method] = np.abs(mean_csd) / norm
+            elif method == 'imcoh':
+                out[method] = mean_csd.imag / norm
+            elif method == 'plv':
+                out[method] = np.abs(mean_phase)
+            elif method == 'wpli':
+                out[method] = np.abs(mean_imag) / mean_abs_imag
+            else:
+                raise NotImplementedError(f'Unknown connectivity method {method}, please chose from {METHODS}')
+    return out
+
+
+def spectral_connectivity(data, sfreq, fmin=0, fmax=np.inf, methods=METHODS, bandwidth=None, low_bias=True):
+    '''
+        Connectivity over all epochs for all channel pairs
+
+        Args:
+            - data: np.array (epochs, channels, samples)
+            - sfreq: float, sampling frequency
+            - fmin, fmax: float, frequency range
+            - methods: list of str, "coh", "imcoh", "plv" and/or "wpli"
+            - bandwidth: float, multitaper bandwidth
+        Returns:
+            - dict, method: np.array (channels, channels, freqs)
+            - freqs: 1D np.array of frequencies
+    '''
+    con, freqs, _ = grouped_connectivity(data, sfreq, np.zeros(len(data)), fmin=fmin, fmax=fmax, methods=methods,
+                                         bandwidth=bandwidth, low_bias=low_bias)
+    return {method: values[0] for method, values in con.items()}, freqs
+
+
+def grouped_connectivity(data, sfreq, groups, fmin=0, fmax=np.inf, methods=METHODS, bandwidth=None, low_bias=True,
+                         chunk_size=256):
+    '''
+        Connectivity per group of epochs.
+        The CSD and its per-epoch terms are computed in chunks of epochs and summed per group with one matrix
+        multiply by a (groups, epochs) indicator matrix, only the per-group sums are kept.
+
+        Args:
+            - data: np.array (epochs, channels, samples)
+            - sfreq: float, sampling frequency
+            - groups: array-like (epochs,), group of every epoch (e.g. epochs.metadata['injection'])
+            - fmin, fmax, methods, bandwidth, low_bias: see spectral_connectivity
+            - chunk_size: int, number of epochs transformed at once (limits memory use)
+        Returns:
+            - dict, method: np.array (groups, channels, channels, freqs), groups in the order of group_names
+            - freqs: 1D np.array of frequencies
+            - group_names: np.array of the unique groups
+    '''
+    n_epochs, n_channels, n_samples = np.shape(data)
+    tapers, eigvals = get_dpss_tapers(n_samples, float(sfreq), bandwidth, low_bias)
+    freqs = fft.rfftfreq(n_samples, 1.0 / sfreq)
+    fmask = (freqs >= fmin) & (freqs <= fmax)
+    weights = np.sqrt(eigvals)
+    scale = 2 / np.sum(weights ** 2)
+
+    group_names, group_idx = np.unique(np.asarray(groups), return_inverse=True)
+    indicator = np.zeros((len(group_names), n_epochs))
+    indicator[group_idx, np.arange(n_epochs)] = 1
+
+    shape = (len(group_names), n_channels, n_channels, int(fmask.sum()))
+    sums = {'csd': np.zeros(shape, dtype=complex), 'phase': np.zeros(shape, dtype=complex),
+            'imag': np.zeros(shape), 'abs_imag': np.zeros(shape)}
+    for start in range(0, n_epochs, chunk_size):
+        chunk = np.asarray(data[start:start + chunk_size], dtype=float)
+        x_mt = tapered_fft(chunk, tapers, weights, fmask)
+        terms = epoch_terms(np.einsum('eitf,ejtf->eijf', x_mt, x_mt.conj()) * scale)
+        terms['abs_imag'] = np.abs(terms['imag'])
+        chunk_indicator = indicator[:, start:start + len(chunk)]
+        for name, values in terms.items():
+            sums[name] += (chunk_indicator @ values.reshape(len(chunk), -1)).reshape(shape)
+
+    counts = indicator.sum(axis=1)[:, np.newaxis, np.newaxis, np.newaxis]
+    con = connectivity_from_means(
+        sums['csd'] / counts,
+        sums['phase'] / counts,
+        sums['imag'] / counts,
+        sums['abs_imag'] / counts,
+        methods=methods
+    )
+    return con, freqs[fmask], group_names
+
+
+def epochs_connectivity(epochs, grouper=None, picks=None, **kwargs):
+    '''
+        Connectivity of an mne.Epochs object, optionally per metadata group, as a tidy DataFrame
+
+        Args:
+            - epochs: mne.Epochs
+            - grouper: str or list of str, metadata column(s) to group the epochs by (None uses all epochs)
+            - picks: list of channel names (None uses all channels)
+            - **kwargs: passed to grouped_connectivity (fmin, fmax, methods, bandwidth, chunk_size)
+        Returns:
+            - pd.DataFrame with the columns of grouper, channel_1, channel_2, freq and one column per method
+                (each channel pair once)
+    '''
+    ch_names = list(epochs.ch_names) if picks is None else list(picks)
+    if grouper is None:
+        groups = np.full(len(epochs), 'all')
+        grouper = ['group']
+    else:
+        grouper = [grouper] if isinstance(grouper, str) else list(grouper)
+        groups = epochs.metadata[grouper].astype(str).agg('|'.join, axis=1).to_numpy()
+
+    con, freqs, group_names = grouped_connectivity(epochs.get_data(picks=ch_names), epochs.info['sfreq'], groups,
+                                                   **kwargs)
+    i, j = np.triu_indices(len(ch_names), k=1)
+    n_pairs, n_freqs = len(i), len(freqs)
+
+    df = pd.DataFrame({
+        'channel_1': np.tile(np.repeat(np.array(ch_names)[i], n_freqs), len(group_names)),
+        'channel_2': np.tile(np.repeat(np.array(ch_names)[j], n_freqs), len(group_names)),
+        'freq': np.tile(freqs, len(group_names) * n_pairs)
+    })
+    for method, values in con.items():
+        df[method] = values[:, i, j, :].ravel()
+    group_values = pd.Series(np.repeat(group_names, n_pairs * n_freqs)).str.split('|', expand=True)
+    for k, col in enumerate(grouper):
+        df.insert(k, col, group_values[k].to_numpy())
+    return df
@@ -0,0 +1,247 @@
+'''
+DBSCAN epoch cleaning with one neighbor index for all settings
+
+The scaled features are indexed once (KD-tree / ball tree) and the neighbors within the largest eps
+of interest are stored as a sparse distance graph. DBSCAN with metric='precomputed' only looks at the
+stored distances, so every (eps, min_samples) setting up to that eps reuses the same graph.
+The k-distance curve of the same index is used to suggest an eps.
+
+A fitted setting can be saved as a cleaning model (scaler parameters + core samples), which labels
+epochs of new files by their distance to the nearest core sample, without re-clustering everything.
+'''
+
+import numpy as np
+import pandas as pd
+import os
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors, KDTree, sort_graph_by_row_values
+from sklearn.preprocessing import StandardScaler
+
+
+def scale_features(features_df, exclude=[]):
+    '''
+        Drops the excluded columns (if present) and standardizes the features, as dbscan_epochs
+
+        Returns:
+            - features: 2D np.array (epochs, features), standardized
+            - scaler: fitted StandardScaler
+            - columns: list of str, the feature columns used
+    '''
+    columns_to_drop = [col for col in exclude if col in features_df.columns]
+    features_df = features_df.drop(columns=columns_to_drop)
+    scaler = StandardScaler()
+    features = scaler.fit_transform(features_df.values)
+    return features, scaler, features_df.columns.tolist()
+
+
+def build_neighbor_index(features, algorithm='kd_tree', n_jobs=None):
+    '''
+        Fits the neighbor index on the scaled features (algorithm: "kd_tree", "ball_tree" or "auto")
+    '''
+    return NearestNeighbors(algorithm=algorithm, n_jobs=n_jobs).fit(features)
+
+
+def k_distance(index, k):
+    '''
+        Sorted distance of every epoch to its k-th nearest neighbor (not counting the epoch itself).
+        With min_samples = k + 1, an epoch is a core point for every eps above its k-distance.
+    '''
+    distances, _ = index.kneighbors(n_neighbors=k)
+    return np.sort(distances[:, -1])
+
+
+def suggest_eps(k_distances):
+    '''
+        Knee of the sorted k-distance curve: the point furthest below the line from the first to the last point
+
+        Returns:
+            - float, suggested eps
+    '''
+    n = len(k_distances)
+    if n < 3:
+        return float(k_distances[-1])
+    x = np.linspace(0, 1, n)
+    span = k_distances[-1] - k_distances[0]
+    y = (k_distances - k_distances[0]) / span if span > 0 else np.zeros(n)
+    return float(k_distances[np.argmax(x - y)])
+
+
+def neighbor_graph(index, max_eps):
+    '''
+        Sparse distance graph of all neighbor pairs within max_eps, to pass to DBSCAN(metric='precomputed')
+    '''
+    graph = index.radius_neighbors_graph(radius=max_eps, mode='distance')
+    # Every epoch is its own neighbor (DBSCAN would otherwise add the diagonal and unsort the graph at every fit)
+    graph.setdiag(graph.diagonal())
+    return sort_graph_by_row_values(graph, copy=False, warn_when_not_sorted=False)
+
+
+def dbscan_from_graph(graph, eps, min_samples):
+    '''
+        DBSCAN labels from a precomputed neighbor graph (eps must not be larger than the graph radius)
+    '''
+    return DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed').fit(graph).labels_
+
+
+def sweep_dbscan(features_df, eps_values=None, min_samples_values=(4,), exclude=[], group_col='animal_id',
+                 algorithm='kd_tree', n_jobs=None):
+    '''
+        Runs DBSCAN for a grid of (eps, min_samples) settings on one cached neighbor graph
+
+        Args:
+            - features_df: pd.DataFrame, features (with metadata columns listed in exclude)
+            - eps_values: list of float. None uses 0.5x - 2x the eps suggested by the k-distance curve
+            - min_samples_values: list of int
+            - exclude: list of str, columns that are not features (metadata, EMG, ...)
+            - group_col: str, column in features_df to count the noise epochs per animal
+            - algorithm: str, neighbor index ("kd_tree", "ball_tree" or "auto")
+            - n_jobs: int, passed to NearestNeighbors
+        Returns:
+            - summary: pd.DataFrame, one row per setting with n_clusters, n_noise and
+                noise_<animal> counts per animal
+            - labels: pd.DataFrame, one column of cluster labels per setting (eps_<eps>_min_samples_<n>)
+            - suggested_eps: dict, min_samples: eps suggested by the k-distance curve
+    '''
+    features, _, _ = scale_features(features_df, exclude)
+    index = build_neighbor_index(features, algorithm=algorithm, n_jobs=n_jobs)
+
+    suggested_eps = {n: suggest_eps(k_distance(index, n - 1)) for n in min_samples_values}
+    print(f'Suggested eps per min_samples: {suggested_eps}')
+    if eps_values is None:
+        eps_values = np.round(np.unique(np.concatenate(
+            [np.linspace(0.5, 2, 7) * eps for eps in suggested_eps.values()])), 3)
+
+    graph = neighbor_graph(index, max(eps_values))
+    groups = features_df[group_col].to_numpy() if group_col in features_df.columns else None
+
+    rows = []
+    labels = {}
+    for eps in eps_values:
+        for min_samples in min_samples_values:
+            setting_labels = dbscan_from_graph(graph, eps, min_samples)
+            labels[f'eps_{eps}_min_samples_{min_samples}'] = setting_labels
+            noise = setting_labels == -1
+            row = {
+                'eps': eps,
+                'min_samples': min_samples,
+                'n_clusters': len(set(setting_labels)) - (1 if noise.any() else 0),
+                'n_noise': int(noise.sum()),
+                'noise_fraction': noise.mean()
+            }
+            if groups is not None:
+                row.update({f'noise_{animal}': int(count) for animal, count in
+                            pd.Series(noise).groupby(groups).sum().items()})
+            rows.append(row)
+
+    return pd.DataFrame(rows), pd.DataFrame(labels, index=features_df.index), suggested_eps
+
+
+def save_sweep(summary, labels, behavior_name, folder='feature_dfs'):
+    '''
+        Saves the sweep summary and the labels of every setting as .xlsx next to the feature dataframes
+    '''
+    os.makedirs(folder, exist_ok=True)
+    summary.to_excel(os.path.join(folder, f'dbscan_sweep_{behavior_name}.xlsx'), index=False)
+    labels.to_excel(os.path.join(folder, f'dbscan_sweep_{behavior_name}_labels.xlsx'), index=False)
+
+
+def fit_cleaning_model(features_df, eps, min_samples, exclude=[], algorithm='kd_tree'):
+    '''
+        Runs DBSCAN once and keeps what is needed to label new epochs later
+
+        Args:
+            - features_df: pd.DataFrame, features (with metadata columns listed in exclude)
+            - eps: float, DBSCAN eps
+            - min_samples: int, DBSCAN min_samples
+            - exclude: list of str, columns that are not features
+            - algorithm: str, neighbor index used for the DBSCAN fit
+        Returns:
+            - model: dict with the feature columns, scaler mean/scale, the scaled core samples and their cluster
+                labels, eps and min_samples (and a KDTree on the core samples under "tree")
+            - labels: 1D np.array, DBSCAN labels of features_df
+    '''
+    features, scaler, columns = scale_features(features_df, exclude)
+    db = DBSCAN(eps=eps, min_samples=min_samples, algorithm=algorithm).fit(features)
+    core = db.core_sample_indices_
+    model = {
+        'columns': columns,
+        'mean': scaler.mean_,
+        'scale': scaler.scale_,
+        'core_features': features[core],
+        'core_labels': db.labels_[core],
+        'eps': float(eps),
+        'min_samples': int(min_samples)
+    }
+    model['tree'] = KDTree(model['core_features'])
+    return model, db.labels_
+
+
+def save_cleaning_model(model, path):
+    '''
+        Saves a cleaning model as .npz (the KDTree is rebuilt when loading)
+    '''
+    np.savez(path, **{key: np.asarray(value) for key, value in model.items() if key != 'tree'})
+
+
+def load_cleaning_model(path):
+    '''
+        Loads a cleaning model saved with save_cleaning_model
+    '''
+    with np.load(path) as f:
+        model = {
+            'columns': f['columns'].tolist(),
+            'mean': f['mean'],
+            'scale': f['scale'],
+            'core_features': f['core_features'],
+            'core_labels': f['core_labels'],
+            'eps': float(f['eps']),
+            'min_samples': int(f['min_samples'])
+        }
+    model['tree'] = KDTree(model['core_features'])
+    return model
+
+
+def label_new_epochs(model, features_df):
+    '''
+        Labels new epochs with a fitted cleaning model
+
+        An epoch within eps of a core sample gets the cluster label of the nearest core sample
+        (like a DBSCAN border point), otherwise it is noise (-1). Core samples are not updated,
+        refit the model (fit_cleaning_model) to re-cluster everything.
+
+        Args:
+            - model: dict, cleaning model
+            - features_df: pd.DataFrame, features of the new epochs (must contain model['columns'])
+        Returns:
+            - labels: 1D np.array of cluster labels
+            - distances: 1D np.array, distance to the nearest core sample (in scaled units)
+    '''
+    missing = [col for col in model['columns'] if col not in features_df.columns]
+    if missing:
+        raise ValueError(f'Features missing for the cleaning model: {missing}')
+    features = (features_df[model['columns']].values - model['mean']) / model['scale']
+
+    if len(model['core_labels']) == 0:
+        return np.full(len(features), -1), np.full(len(features), np.inf)
+    distances, nearest = model['tree'].query(features, k=1)
+    distances, nearest = distances[:, 0], nearest[:, 0]
+    labels = np.where(distances <= model['eps'], model['core_labels'][nearest], -1)
+    return labels, distances
+
+
+def append_cluster_labels(features_df, labels, exclude=[], cluster_file=None):
+    '''
+        Builds the clusters dataframe of dbscan_epoch_cleaning.ipynb (features without the excluded columns
+        + clusters_label) and optionally appends it to an existing features_<behavior>_clusters.xlsx,
+        for epochs that were appended to the concatenated epochs file in the same order
+
+        Returns:
+            - pd.DataFrame, the (appended) clusters dataframe
+    '''
+    clusters_df = features_df.drop(columns=[col for col in exclude if col in features_df.columns])
+    clusters_df['clusters_label'] = labels
+    if cluster_file is not None:
+        if os.path.exists(cluster_file):
+            clusters_df = pd.concat([pd.read_excel(cluster_file), clusters_df], ignore_index=True)
+        clusters_df.to_excel(cluster_file, index=False)
+    return clusters_df
@@ -0,0 +1,161 @@
+'''
+Vectorized epoch features for DBSCAN cleaning
+
+Same features as feature_engineer_epochs in dbscan_epoch_cleaning.ipynb, but every feature is an
+axis reduction over the whole (epochs, channels, samples) array instead of a loop over epochs and channels.
+The columns keep the <channel>_<feature> naming, so the output can go straight into dbscan_epochs.
+The band features are the mean dB PSD over the calc_mean_psd bands (CLEANING_BANDS), as the notebook computes them.
+The band power in dB of band_power.py (FREQ_BANDS) can be added as a separate feature set, <channel>_<band>_power_db.
+'''
+
+import numpy as np
+import pandas as pd
+from .spectral_engine import multitaper_psd
+from .band_power import FREQ_BANDS, compute_band_power
+
+TIME_FEATURES = ['peak_to_peak', 'mean', 'std', 'skewness', 'kurtosis', 'variance', 'min', 'max', 'slope',
+                 'zero_crossing_rate']
+
+# Bands of calc_mean_psd in feature_engineer_epochs (both edges included)
+CLEANING_BANDS = {
+    'delta': (1, 4),
+    'theta': (4, 8),
+    'alpha': (8, 12),
+    'beta': (12, 30),
+    'gamma': (30, 100)
+}
+
+
+def time_domain_features(data):
+    '''
+        Time-domain features of a block of epochs
+
+        Skewness and kurtosis are the bias-corrected estimates of pd.Series.skew / pd.Series.kurtosis,
+        the slope is the least-squares slope of linregress against the sample index
+        and std/variance use ddof=0 like np.std / np.var.
+
+        Args:
+            - data: np.array (epochs, channels, samples)
+        Returns:
+            - dict, feature name: np.array (epochs, channels)
+    '''
+    data = np.asarray(data, dtype=float)
+    n = data.shape[-1]
+    mean = data.mean(axis=-1)
+    centered = data - mean[..., np.newaxis]
+
+    m2 = np.einsum('...i,...i->...', centered, centered)
+    sq = centered * centered
+    m3 = np.einsum('...i,...i->...', sq, centered)
+    m4 = np.einsum('...i,...i->...', sq, sq)
+    del sq
+
+    # Same corrections (and zero for constant signals) as pandas nanskew / nankurt
+    with np.errstate(divide='ignore', invalid='ignore'):
+        skew = (n * (n - 1) ** 0.5 / (n - 2)) * (m3 / m2 ** 1.5)
+        kurt = (n * (n + 1) * (n - 1) * m4) / ((n - 2) * (n - 3) * m2 ** 2) - 3 * (n - 1) ** 2 / ((n - 2) * (n - 3))
+    constant = m2 == 0
+    skew[constant] = 0
+    kurt[constant] = 0
+
+    x = np.arange(n) - (n - 1) / 2
+    minimum = data.min(axis=-1)
+    maximum = data.max(axis=-1)
+    variance = m2 / n
+
+    return {
+        'peak_to_peak': maximum - minimum,
+        'mean': mean,
+        'std': np.sqrt(variance),
+        'skewness': skew,
+        'kurtosis': kurt,
+        'variance': variance,
+        'min': minimum,
+        'max': maximum,
+        'slope': data @ x / (x @ x),
+        'zero_crossing_rate': ((data[..., :-1] * data[..., 1:]) < 0).sum(axis=-1) / n
+    }
+
+
+def band_mean_db(data, sfreq, bands=CLEANING_BANDS, **kwargs):
+    '''
+        Mean multitaper PSD in dB per band, as calc_mean_psd, from a single PSD per epoch and channel
+
+        Returns:
+            - dict, band name: np.array (epochs, channels)
+    '''
+    fmin = min(low for low, _ in bands.values())
+    fmax = max(high for _, high in bands.values())
+    psds, freqs = multitaper_psd(data, sfreq, fmin=fmin, fmax=fmax, **kwargs)
+    psds[psds == 0] = np.nan
+    psds_db = 10 * np.log10(psds)
+    return {band: psds_db[..., (freqs >= low) & (freqs <= high)].mean(axis=-1) for band, (low, high) in bands.items()}
+
+
+def band_db(data, sfreq, bands=FREQ_BANDS, **kwargs):
+    '''
+        Band power in dB (compute_band_power of band_power.py) from a single multitaper PSD per epoch and channel,
+        NaN where the band power is zero
+
+        Returns:
+            - dict, band name: np.array (epochs, channels)
+    '''
+    fmin = min(low for low, _ in bands.values())
+    fmax = max(high for _, high in bands.values())
+    psds, freqs = multitaper_psd(data, sfreq, fmin=fmin, fmax=fmax, **kwargs)
+    absolute, _ = compute_band_power(psds, freqs, bands)
+    with np.errstate(divide='ignore'):
+        db = 10 * np.log10(absolute)
+    db[~np.isfinite(db)] = np.nan
+    return {band: db[..., i] for i, band in enumerate(bands)}
+
+
+def extract_epoch_features(data, sfreq, ch_names, bands=CLEANING_BANDS, power_bands=None, chunk_size=None, **kwargs):
+    '''
+        Time-domain and band features for all epochs, with <channel>_<feature> columns
+
+        Args:
+            - data: np.array (epochs, channels, samples)
+            - sfreq: float, sampling frequency
+            - ch_names: list of str, channel names
+            - bands: dict, band name: (fmin, fmax) of the mean dB PSD features, None to skip them
+            - power_bands: dict, band name: (fmin, fmax) of extra band power features in dB (<band>_power_db),
+                e.g. FREQ_BANDS. None (default) keeps the features of the DBSCAN cleaning
+            - chunk_size: int, number of epochs processed at once (None processes all at once)
+            - **kwargs: passed to multitaper_psd (e.g. bandwidth, n_jobs)
+        Returns:
+            - pd.DataFrame, one row per epoch, columns ordered per channel like feature_engineer_epochs
+    '''
+    n_epochs = data.shape[0]
+    chunk_size = chunk_size or max(n_epochs, 1)
+    names = (TIME_FEATURES + (list(bands) if bands else [])
+             + ([f'{band}_power_db' for band in power_bands] if power_bands else []))
+
+    features = np.empty((n_epochs, len(ch_names), len(names)))
+    for start in range(0, n_epochs, chunk_size):
+        chunk = np.asarray(data[start:start + chunk_size], dtype=float)
+        values = time_domain_features(chunk)
+        if bands:
+            values.update(band_mean_db(chunk, sfreq, bands, **kwargs))
+        if power_bands:
+            values.update({f'{band}_power_db': value for band, value in band_db(chunk, sfreq, power_bands, **kwargs).items()})
+        features[start:start + chunk_size] = np.stack([values[name] for name in names], axis=-1)
+
+    columns = [f'{channel}_{name}' for channel in ch_names for name in names]
+    return pd.DataFrame(features.reshape(n_epochs, -1), columns=columns)
+
+
+def feature_engineer_epochs(epochs, picks='all', chunk_size=None, **kwargs):
+    '''
+        Vectorized version of feature_engineer_epochs for an mne.Epochs object
+
+        Args:
+            - epochs: mne.Epochs
+            - picks: 'all' or list of channel names
+            - chunk_size: int, number of epochs processed at once
+        Returns:
+            - pd.DataFrame with features
+    '''
+    ch_names = list(epochs.ch_names) if picks == 'all' else list(picks)
+    return extract_epoch_features(epochs.get_data(picks=ch_names), epochs.info['sfreq'], ch_names,
+                                  chunk_size=chunk_size, **kwargs)
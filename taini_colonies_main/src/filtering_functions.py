@@ -54,6 +54,138 @@ def filtering(x, sfreq, lp=0.5, hp=200, lower_val = 0.006, higher_val=0.013, art
         return interpolate_nan(rej, pkind='linear')
     return rej
 
+def decimation_factors(sfreq, target_sfreq, max_denominator=1000):
+    '''
+        Returns the (up, down) integer factors of the polyphase resampler that takes
+        sfreq as close as possible to target_sfreq, and the resulting sampling frequency
+    '''
+    from fractions import Fraction
+    ratio = Fraction(target_sfreq / sfreq).limit_denominator(max_denominator)
+    return ratio.numerator, ratio.denominator, sfreq * ratio.numerator / ratio.denominator
+
+def decimation_padding(up, down):
+    '''
+        Number of input samples needed on each side of a segment to let the
+        anti-aliasing filter of resample_poly settle (half its length, rounded up to a multiple of down)
+    '''
+    half_len = 10 * max(up, down)
+    return int(np.ceil(half_len / up / down)) * down
+
+def decimate(x, up, down, pad=0, axis=-1):
+    '''
+        Anti-aliased polyphase decimation along an axis (works on whole (epochs, channels, samples) arrays)
+
+        Args:
+            - x: nd array
+            - up, down: int, resampling factors (see decimation_factors)
+            - pad: int, samples of padding on both sides of x that are cut off again after resampling
+        Returns:
+            - nd array, resampled
+    '''
+    y = signal.resample_poly(x, up, down, axis=axis)
+    if pad:
+        out_pad = pad * up // down
+        y = np.take(y, np.arange(out_pad, y.shape[axis] - out_pad), axis=axis)
+    return y
+
+def notch_sos(sfreq, notch_freqs=(50,), quality=30):
+    '''
+        Second-order sections of a cascade of IIR notch filters (one per notch frequency)
+    '''
+    return np.vstack([signal.tf2sos(*signal.iirnotch(freq, quality, fs=sfreq)) for freq in notch_freqs])
+
+
+def iir_notch(x, sfreq, notch_freqs=(50,), quality=30, axis=-1):
+    '''
+        Zero-phase IIR notch filter along one axis (e.g. a continuous (channels, samples) recording)
+    '''
+    return signal.sosfiltfilt(notch_sos(sfreq, tuple(notch_freqs), quality), x, axis=axis)
+
+
+def spectrum_fit_notch(data, sfreq, notch_freqs=(50,), notch_widths=1, mt_bandwidth=None):
+    '''
+        Batched version of mne.filter.notch_filter(method='spectrum_fit') for epochs,
+        with the line frequencies given (no F-test detection).
+        Every epoch is treated as one multitaper window, which is what MNE does for signals
+        shorter than its default 10 s window: the sinusoid at each line frequency bin is
+        estimated from the odd DPSS tapers and subtracted.
+
+        Args:
+            - data: np.array (..., samples), e.g. (epochs, channels, samples)
+            - sfreq: float, sampling frequency
+            - notch_freqs: list of float, line frequencies
+            - notch_widths: float or list of float, bins within freq +- width/2 are removed too
+            - mt_bandwidth: float, multitaper bandwidth (None as in MNE)
+        Returns:
+            - np.array, the data with the line noise removed
+    '''
+    data = np.asarray(data, dtype=float)
+    n_samples = data.shape[-1]
+    if n_samples > 10 * sfreq:
+        print(f'Warning: epochs of {n_samples / sfreq:.1f} s are fitted as one window, MNE would use 10 s windows')
+    notch_widths = np.broadcast_to(notch_widths, (len(notch_freqs),))
+
+    half_nbw = float(mt_bandwidth) * n_samples / (2.0 * sfreq) if mt_bandwidth is not None else 4.0
+    tapers = signal.windows.dpss(n_samples, half_nbw, int(2 * half_nbw), sym=False)[::2]
+    h0 = tapers.sum(axis=1)
+
+    freqs = np.fft.rfftfreq(n_samples, 1.0 / sfreq)
+    indices = {np.argmin(np.abs(freqs - freq)) for freq in notch_freqs}
+    for freq, width in zip(notch_freqs, notch_widths):
+        indices.update(np.where((freqs > freq - width / 2.0) & (freqs < freq + width / 2.0))[0])
+    indices = np.array(sorted(indices))
+
+    # Tapered spectra only at the bins to remove: (..., tapers, bins)
+    centered = data - data.mean(axis=-1, keepdims=True)
+    kernels = np.exp(-2j * np.pi * np.outer(np.arange(n_samples), indices) / n_samples)
+    x_p = (centered[..., np.newaxis, :] * tapers) @ kernels
+    # Same DC / Nyquist scaling as MNE's one-sided tapered spectra
+    x_p[..., (indices == 0) | ((n_samples % 2 == 0) & (indices == n_samples // 2))] /= np.sqrt(2.0)
+
+    amplitudes = 2 * np.einsum('...tk,t->...k', x_p, h0) / np.sum(h0 ** 2)
+    rads = 2 * np.pi * np.arange(n_samples) / sfreq
+    fit = np.einsum('...k,kn->...n', amplitudes, np.exp(1j * np.outer(freqs[indices], rads))).real
+    return data - fit
+
+
+def notch_epochs_batch(data, sfreq, notch_freqs=(50,), method='spectrum_fit', chunk_size=256, n_jobs=1, **kwargs):
+    '''
+        Removes line noise from a whole (epochs, channels, samples) array, in parallel chunks of epochs
+
+        Args:
+            - data: np.array (epochs, channels, samples)
+            - sfreq: float, sampling frequency
+            - notch_freqs: list of float, line frequencies
+            - method: str, "spectrum_fit" (spectrum_fit_notch) or "iir" (iir_notch)
+            - chunk_size: int, number of epochs per chunk
+            - n_jobs: int, number of threads
+            - **kwargs: passed to spectrum_fit_notch (notch_widths, mt_bandwidth) or iir_notch (quality)
+        Returns:
+            - np.array (epochs, channels, samples), notch filtered copy of data
+    '''
+    if method == 'spectrum_fit':
+        func = lambda chunk: spectrum_fit_notch(chunk, sfreq, notch_freqs, **kwargs)
+    elif method == 'iir':
+        func = lambda chunk: iir_notch(chunk, sfreq, notch_freqs, **kwargs)
+    else:
+        raise NotImplementedError('Please chose either "spectrum_fit", or "iir" for method')
+
+    out = np.empty(np.shape(data))
+    starts = range(0, len(data), chunk_size)
+
+    def run(start):
+        out[start:start + chunk_size] = func(np.asarray(data[start:start + chunk_size], dtype=float))
+
+    if n_jobs == 1:
+        for start in starts:
+            run(start)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(run, starts))
+    return out
+
+
 def time_to_samples(time_str, sfreq):
     # split the time string into its components
     hour, minute, second = time_str.split('-')
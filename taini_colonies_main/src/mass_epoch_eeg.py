@@ -33,6 +33,7 @@ if __name__ == '__main__':
     # Parse from settings
     nwb_path = settings['nwb_files_folder']
     epoch_output = settings['epochs_folder']
+    set_read_options(settings.get('hdf5_read_options'))
 
     behaviors_and_lens = {
         'social_sniff': 0.5,
@@ -42,6 +43,11 @@ if __name__ == '__main__':
 
     relative_start = 0
     ploss_threshold = 5
+    overlap = None # None, 'drop' or 'annotate' epochs that overlap other behaviors
+    batch_size = 256 # epochs read at once
+    prefetch_depth = 2 # batches read ahead while the current batch is processed
+    target_sfreq = None # e.g. 250 to decimate the epochs, our PSDs only go up to 100 Hz
+    vigilance = None # None, 'annotate' or e.g. ['wake'] (needs the hypnogram of nwb_add_hypnogram.py)
 
     for i, file in enumerate(os.listdir(nwb_path)):
         print(f'Loading {os.path.join(nwb_path, file)}')
@@ -57,7 +63,9 @@ if __name__ == '__main__':
             print(f'Making {behavior} epochs for {filename}')
             print(f"output folder: {epoch_output}")
             
-            good_epochs = epoch_eeg(os.path.join(nwb_path, file), behavior, epoch_length, relative_start, ploss_threshold)
+            good_epochs = epoch_eeg(os.path.join(nwb_path, file), behavior, epoch_length, relative_start, ploss_threshold, overlap,
+                                    batch_size=batch_size, prefetch_depth=prefetch_depth, target_sfreq=target_sfreq,
+                                    vigilance=vigilance)
             if good_epochs != None:
                 good_epochs.save(f'{epoch_output}/{filename}_{behavior}-epo.fif', overwrite = True)
             else:
@@ -0,0 +1,142 @@
+'''
+Adds a multi-resolution min / max / mean pyramid of the filtered EEG to the NWB files, for fast browsing of long recordings
+
+The filtered EEG is streamed in blocks and decimated by a series of factors (by default 10, 100, 1000 and 10000
+samples per bin, the coarsest level gives a few thousand bins for a whole day at 500 Hz). Each level is computed from the previous one (min of the mins, max of the maxes, sum and count for the mean),
+so the samples are only reduced once. Every level is stored as a TimeSeries "level_<factor>" with the data
+(bins, channels, 3) = min, max, mean in the processing module "eeg_pyramid". Plotting helpers read the coarsest
+level that still gives at least one bin per screen pixel (see get_eeg_pyramid and choose_pyramid_level).
+'''
+
+import numpy as np
+from pynwb import NWBHDF5IO, TimeSeries
+from ndx_events import LabeledEvents, AnnotatedEventsTable, TTLs
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+import os
+import json
+from nwb_data_retrieval_functions import open_nwb, PYRAMID_MODULE, PYRAMID_STATS
+from prefetch_pipeline import run_pipeline
+
+PYRAMID_FACTORS = (10, 100, 1000, 10000)
+
+
+def reduce_bins(mins, maxs, sums, counts, step):
+    '''
+        Merges every step bins (last axis) of a level into one bin of the next level, a partial last bin is kept
+
+        Args:
+            - mins, maxs, sums: np.arrays (channels, bins)
+            - counts: 1D np.array, number of samples per bin
+            - step: int, bins merged into one
+        Returns:
+            - mins, maxs, sums, counts of the next level
+    '''
+    starts = np.arange(0, mins.shape[-1], step)
+    return (np.minimum.reduceat(mins, starts, axis=-1), np.maximum.reduceat(maxs, starts, axis=-1),
+            np.add.reduceat(sums, starts, axis=-1), np.add.reduceat(counts, starts))
+
+
+def block_pyramid(x, factors=PYRAMID_FACTORS):
+    '''
+        Pyramid levels of one block of samples
+
+        Args:
+            - x: np.array (channels, samples), starting at a multiple of the largest factor
+            - factors: increasing ints, every factor a multiple of the previous one
+        Returns:
+            - list with per factor np.array (bins, channels, 3) of min, max and mean (float32)
+    '''
+    level = (x, x, x.astype(float), np.ones(x.shape[-1], dtype=np.int64))
+    previous = 1
+    levels = []
+    for factor in factors:
+        level = reduce_bins(*level, factor // previous)
+        previous = factor
+        mins, maxs, sums, counts = level
+        levels.append(np.stack([mins, maxs, sums / counts], axis=-1).transpose(1, 0, 2).astype(np.float32))
+    return levels
+
+
+def compute_pyramid(nwb_file, factors=PYRAMID_FACTORS, block_seconds=600, prefetch_depth=2):
+    '''
+        Streams the filtered EEG of a recording once and computes all pyramid levels
+
+        Args:
+            - nwb_file: path, of the nwb file
+            - factors: increasing ints, samples per bin of every level (every factor a multiple of the previous one)
+            - block_seconds: float, seconds read at once (rounded up to a multiple of the largest factor)
+            - prefetch_depth: int, number of blocks read ahead while the previous block is processed
+        Returns:
+            - dict with the keys levels ({factor: np.array (bins, channels, 3)}), sfreq and n_samples
+    '''
+    factors = sorted(factors)
+    if any(factor % previous for previous, factor in zip([1] + factors[:-1], factors)):
+        raise ValueError(f'Every pyramid factor should be a multiple of the previous one, got {factors}')
+
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        filtered = nwb.acquisition['filtered_EEG'].data
+        sfreq = nwb.acquisition['filtered_EEG'].rate
+        n_samples = filtered.shape[0]
+
+        block_samples = int(np.ceil(block_seconds * sfreq / factors[-1])) * factors[-1]
+        blocks = [(start, min(start + block_samples, n_samples)) for start in range(0, n_samples, block_samples)]
+
+        def read_block(block, out):
+            start, end = block
+            return filtered[start:end].T
+
+        def process_block(block, data):
+            return block_pyramid(data, factors)
+
+        results, _ = run_pipeline(blocks, read_block, process_block, depth=prefetch_depth)
+
+    levels = {factor: np.concatenate([result[i] for result in results]) for i, factor in enumerate(factors)}
+    return {'levels': levels, 'sfreq': sfreq, 'n_samples': n_samples}
+
+
+def add_pyramid(nwb, pyramid):
+    '''
+        Adds the pyramid as the processing module PYRAMID_MODULE to an nwb file opened in "a" mode
+    '''
+    module = nwb.create_processing_module(
+        name=PYRAMID_MODULE,
+        description=f'Min / max / mean pyramid of filtered_EEG, decimated by {list(pyramid["levels"])} samples per bin'
+    )
+    for factor, level in pyramid['levels'].items():
+        module.add(TimeSeries(
+            name=f'level_{factor}',
+            data=H5DataIO(data=level, compression=True, chunks=(min(len(level), 4096), *level.shape[1:])),
+            unit='V',
+            description=f'{", ".join(PYRAMID_STATS)} of filtered_EEG per {factor} samples (bins, channels, stat)',
+            starting_time=0.,
+            rate=pyramid['sfreq'] / factor
+        ))
+
+
+if __name__ == '__main__':
+
+    # Load settings
+    with open('settings.json', "r") as f:
+        settings = json.load(f)
+
+    nwb_folder = settings['nwb_files_folder']
+
+    # Variables
+    factors = PYRAMID_FACTORS # samples per bin
+
+    # Main loop
+    for nwb_file in os.listdir(nwb_folder):
+        with open_nwb(f'{nwb_folder}/{nwb_file}') as io:
+            exists = PYRAMID_MODULE in io.read().processing
+        if exists:
+            print(f'Skipping {nwb_file} (EEG pyramid already exists)')
+            continue
+
+        print(f'Computing EEG pyramid of {nwb_file}')
+        pyramid = compute_pyramid(f'{nwb_folder}/{nwb_file}', factors=factors)
+        with NWBHDF5IO(f'{nwb_folder}/{nwb_file}', "a") as io:
+            nwb = io.read()
+            add_pyramid(nwb, pyramid)
+            io.write(nwb)
+        print(f'EEG pyramid added to NWB file: {nwb_file}')
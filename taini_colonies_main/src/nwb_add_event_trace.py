@@ -8,7 +8,7 @@ import re
 import json
 from datetime import date
 from taini_colonies_utils import load_event_trace
-from nwb_data_retrieval_functions import get_arena_position, get_day, get_animal_id
+from nwb_data_retrieval_functions import get_arena_position, get_day, get_animal_id, EEG_MODULES
 
 if __name__ == "__main__":
 
@@ -53,8 +53,8 @@ if __name__ == "__main__":
         with NWBHDF5IO(f"{nwb_folder}/{nwb_file}", "a") as io:
             print(f"Processing NWB file: {nwb_file}")
             nwb = io.read()
-            # Skip if there is an event trace already in there
-            if nwb.processing:
+            # Skip if there is an event trace already in there (EEG derivative modules do not count)
+            if set(nwb.processing) - set(EEG_MODULES):
                 print(f"Skipping {nwb_file} (processing module already exists)")
                 continue
 
@@ -0,0 +1,260 @@
+'''
+Scores wake / NREM / REM sleep from the EEG and EMG channels and adds the hypnogram to the NWB files
+
+The filtered recording is streamed in blocks and cut in fixed windows (e.g. 4 s). One Welch PSD of all
+windows and channels gives, per window:
+    - the EEG delta / theta power ratio (mean over the EEG channels)
+    - the EMG RMS in the EMG band (mean over the EMG channels, from the integrated PSD)
+Windows with high EMG are wake, the others are NREM (high delta/theta) or REM (low delta/theta). Both thresholds
+are taken per recording from the (log) feature distributions with Otsu's method, unless given.
+Windows with package loss are unscored. The hypnogram is stored as intervals (TimeIntervals with a state column)
+together with the window features in the processing module "eeg_hypnogram".
+'''
+
+import numpy as np
+from pynwb import NWBHDF5IO, TimeSeries
+from pynwb.epoch import TimeIntervals
+from ndx_events import LabeledEvents, AnnotatedEventsTable, TTLs
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+import os
+import json
+from nwb_data_retrieval_functions import open_nwb, get_filtering_info, find_package_loss, HYPNOGRAM_MODULE
+from prefetch_pipeline import run_pipeline
+from nwb_add_spectral_summary import window_psd
+
+STATES = ['wake', 'nrem', 'rem']
+UNSCORED = 'unscored'
+
+# Scoring bands (Hz)
+SCORING_BANDS = {
+    'delta': (0.5, 4),
+    'theta': (6, 9),
+    'emg': (30, 100)
+}
+
+
+def window_features(windows, sfreq, eeg_idx, emg_idx, bands=SCORING_BANDS):
+    '''
+        Scoring features of every window
+
+        Args:
+            - windows: np.array (windows, channels, samples)
+            - sfreq: float, sampling frequency
+            - eeg_idx, emg_idx: lists of channel indexes of the EEG and EMG channels
+            - bands: dict with the delta, theta and emg bands
+        Returns:
+            - delta_theta: 1D np.array, delta / theta power ratio (mean over the EEG channels)
+            - emg_rms: 1D np.array, RMS of the EMG band (mean over the EMG channels)
+    '''
+    psds, freqs = window_psd(windows, sfreq, fmax=max(high for _, high in bands.values()))
+    df = freqs[1] - freqs[0]
+    power = {band: psds[..., (freqs >= low) & (freqs < high)].sum(axis=-1) * df for band, (low, high) in bands.items()}
+    delta_theta = np.mean(power['delta'][:, eeg_idx] / power['theta'][:, eeg_idx], axis=1)
+    emg_rms = np.mean(np.sqrt(power['emg'][:, emg_idx]), axis=1)
+    return delta_theta, emg_rms
+
+
+def otsu_threshold(values, n_bins=256):
+    '''
+        Threshold that maximizes the between-class variance of a 1D distribution (Otsu's method)
+    '''
+    values = values[np.isfinite(values)]
+    counts, edges = np.histogram(values, bins=n_bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    w0 = np.cumsum(counts)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(counts * centers)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        between = w0 * w1 * (m0 / w0 - (m0[-1] - m0) / w1) ** 2
+    return centers[np.nanargmax(between[:-1])]
+
+
+def runs(states):
+    '''
+        Start index, length and state of every run of equal states
+    '''
+    change = np.flatnonzero(states[1:] != states[:-1]) + 1
+    starts = np.r_[0, change]
+    lengths = np.diff(np.r_[starts, len(states)])
+    return starts, lengths, states[starts]
+
+
+def smooth_states(states, min_bout=2, rem_after_nrem=True):
+    '''
+        Removes state changes that are too short to be real bouts
+
+        Args:
+            - states: np.array of states per window
+            - min_bout: int, runs of fewer windows take the state of the previous run (unscored runs are kept)
+            - rem_after_nrem: bool, REM that directly follows wake is scored as wake
+        Returns:
+            - np.array of states per window
+    '''
+    states = states.copy()
+    starts, lengths, run_states = runs(states)
+    for i in range(1, len(starts)):
+        previous = states[starts[i] - 1]
+        short = lengths[i] < min_bout and run_states[i] != UNSCORED and previous != UNSCORED
+        if short or (rem_after_nrem and run_states[i] == 'rem' and previous == 'wake'):
+            states[starts[i]:starts[i] + lengths[i]] = previous
+    return states
+
+
+def classify_states(delta_theta, emg_rms, valid, emg_threshold=None, ratio_threshold=None, min_bout=2,
+                    rem_after_nrem=True):
+    '''
+        Wake / NREM / REM per window
+
+        Args:
+            - delta_theta, emg_rms: 1D np.arrays of window features
+            - valid: 1D bool np.array, windows without (much) package loss
+            - emg_threshold: float, log10 EMG RMS above which a window is wake (None: Otsu)
+            - ratio_threshold: float, log10 delta/theta above which a sleep window is NREM (None: Otsu)
+            - min_bout, rem_after_nrem: see smooth_states
+        Returns:
+            - states: np.array of states per window
+            - thresholds: dict with the emg and ratio thresholds used (log10)
+    '''
+    log_emg, log_ratio = np.log10(emg_rms), np.log10(delta_theta)
+    if emg_threshold is None:
+        emg_threshold = otsu_threshold(log_emg[valid])
+    sleep = valid & (log_emg <= emg_threshold)
+    if ratio_threshold is None:
+        ratio_threshold = otsu_threshold(log_ratio[sleep]) if sleep.sum() > 1 else np.inf
+
+    states = np.full(len(valid), UNSCORED, dtype=object)
+    states[valid & ~sleep] = 'wake'
+    states[sleep & (log_ratio > ratio_threshold)] = 'nrem'
+    states[sleep & (log_ratio <= ratio_threshold)] = 'rem'
+    states = smooth_states(states.astype(str), min_bout, rem_after_nrem)
+    return states, {'emg': float(emg_threshold), 'ratio': float(ratio_threshold)}
+
+
+def states_to_intervals(states, window):
+    '''
+        Intervals (start_time, stop_time, state) of the runs of equal states
+    '''
+    starts, lengths, run_states = runs(states)
+    return starts * window, (starts + lengths) * window, run_states
+
+
+def compute_hypnogram(nwb_file, window=4.0, ploss_max=0.1, block_windows=900, prefetch_depth=2, **kwargs):
+    '''
+        Streams a recording and scores every window
+
+        Args:
+            - nwb_file: path, of the nwb file
+            - window: float, window length in seconds
+            - ploss_max: float, windows with a larger fraction of package loss (in any channel) are unscored
+            - block_windows: int, number of windows read at once (900 windows of 4 s = 1 h)
+            - prefetch_depth: int, number of blocks read ahead while the previous block is processed
+            - **kwargs: passed to classify_states (emg_threshold, ratio_threshold, min_bout, rem_after_nrem)
+        Returns:
+            - dict with the keys states, delta_theta, emg_rms, valid (per window), thresholds and window
+    '''
+    low_val, high_val, art = get_filtering_info(nwb_file)
+
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        filtered = nwb.acquisition['filtered_EEG'].data
+        raw = nwb.acquisition['raw_EEG'].data
+        sfreq = nwb.acquisition['filtered_EEG'].rate
+        locations = nwb.electrodes.location.data[:].tolist()
+        n_samples, n_channels = filtered.shape
+
+        emg_idx = [i for i, location in enumerate(locations) if 'EMG' in location]
+        eeg_idx = [i for i, location in enumerate(locations) if 'EMG' not in location]
+        if not emg_idx or not eeg_idx:
+            raise ValueError(f'Scoring needs EEG and EMG channels, {nwb_file} has {locations}')
+
+        win_samples = int(window * sfreq)
+        n_windows = n_samples // win_samples
+        block_samples = block_windows * win_samples
+        blocks = [(start, min(start + block_samples, n_windows * win_samples))
+                  for start in range(0, n_windows * win_samples, block_samples)]
+
+        def read_block(block, out):
+            start, end = block
+            return filtered[start:end].T, raw[start:end].T
+
+        def process_block(block, data):
+            filt, raw_eeg = data
+            n = filt.shape[-1] // win_samples
+            windows = filt.reshape(n_channels, n, win_samples).transpose(1, 0, 2)
+            ploss = find_package_loss(raw_eeg, low_val, high_val, art).reshape(n_channels, n, win_samples)
+            delta_theta, emg_rms = window_features(windows, sfreq, eeg_idx, emg_idx)
+            return delta_theta, emg_rms, np.all(ploss.mean(axis=-1) <= ploss_max, axis=0)
+
+        results, _ = run_pipeline(blocks, read_block, process_block, depth=prefetch_depth)
+
+    delta_theta, emg_rms, valid = [np.concatenate(values) for values in zip(*results)]
+    states, thresholds = classify_states(delta_theta, emg_rms, valid, **kwargs)
+    return {
+        'states': states,
+        'delta_theta': delta_theta,
+        'emg_rms': emg_rms,
+        'valid': valid,
+        'thresholds': thresholds,
+        'window': window
+    }
+
+
+def add_hypnogram(nwb, hypnogram):
+    '''
+        Adds the hypnogram as the processing module HYPNOGRAM_MODULE to an nwb file opened in "a" mode
+    '''
+    window = hypnogram['window']
+    thresholds = hypnogram['thresholds']
+    module = nwb.create_processing_module(
+        name=HYPNOGRAM_MODULE,
+        description=f'Vigilance states scored from filtered_EEG in {window} s windows: wake if log10 EMG RMS > '
+                    f'{thresholds["emg"]:.3f}, otherwise NREM if log10 delta/theta > {thresholds["ratio"]:.3f}, else REM'
+    )
+
+    intervals = TimeIntervals(name='hypnogram', description='Vigilance state intervals (seconds of EEG)')
+    intervals.add_column(name='state', description=f'One of {STATES + [UNSCORED]}')
+    for start, stop, state in zip(*states_to_intervals(hypnogram['states'], window)):
+        intervals.add_interval(start_time=float(start), stop_time=float(stop), state=str(state))
+    module.add(intervals)
+
+    module.add(TimeSeries(
+        name='scoring_features',
+        data=H5DataIO(data=np.stack([hypnogram['delta_theta'], hypnogram['emg_rms'],
+                                     hypnogram['valid']], axis=1).astype(np.float32), compression=True),
+        unit='n.a.',
+        description='Per window: EEG delta/theta power ratio, EMG RMS (V) and valid (1 without package loss)',
+        starting_time=0.,
+        rate=1 / window
+    ))
+
+
+if __name__ == '__main__':
+
+    # Load settings
+    with open('settings.json', "r") as f:
+        settings = json.load(f)
+
+    nwb_folder = settings['nwb_files_folder']
+
+    # Variables
+    window = 4.0 # seconds
+    ploss_max = 0.1 # max. fraction of package loss in a window to score it
+    min_bout = 2 # windows
+
+    # Main loop
+    for nwb_file in os.listdir(nwb_folder):
+        with open_nwb(f'{nwb_folder}/{nwb_file}') as io:
+            exists = HYPNOGRAM_MODULE in io.read().processing
+        if exists:
+            print(f'Skipping {nwb_file} (hypnogram already exists)')
+            continue
+
+        print(f'Scoring vigilance states of {nwb_file}')
+        hypnogram = compute_hypnogram(f'{nwb_folder}/{nwb_file}', window=window, ploss_max=ploss_max, min_bout=min_bout)
+        fractions = {state: np.mean(hypnogram['states'] == state).round(3) for state in STATES + [UNSCORED]}
+        print(f'Fraction of windows per state: {fractions}')
+        with NWBHDF5IO(f'{nwb_folder}/{nwb_file}', "a") as io:
+            nwb = io.read()
+            add_hypnogram(nwb, hypnogram)
+            io.write(nwb)
+        print(f'Hypnogram added to NWB file: {nwb_file}')
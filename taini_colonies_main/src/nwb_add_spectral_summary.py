@@ -0,0 +1,221 @@
+'''
+Adds a continuous EEG spectral summary to the NWB files, so hourly EEG analyses do not need to read the full recording
+
+The filtered EEG is streamed in blocks and cut in fixed windows (e.g. 4 s). For every window the
+Welch (or multitaper) PSD and the fraction of package loss per channel are stored, together with the
+band power per hour of recording (mean over the windows with little package loss), in the processing
+module "eeg_spectral_summary":
+    - spectrogram: DecompositionSeries (windows, channels, frequencies)
+    - ploss_fraction: TimeSeries (windows, channels), fraction of package loss samples per window
+    - hourly_band_power: DecompositionSeries (hours, channels, bands)
+    - hourly_valid_fraction: TimeSeries (hours, channels), fraction of windows used per hour
+'''
+
+import numpy as np
+from pynwb import NWBHDF5IO, TimeSeries
+from pynwb.misc import DecompositionSeries
+from ndx_events import LabeledEvents, AnnotatedEventsTable, TTLs
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+from scipy import signal
+import os
+import json
+from nwb_data_retrieval_functions import open_nwb, get_filtering_info, find_package_loss, SPECTRAL_SUMMARY_MODULE
+from prefetch_pipeline import run_pipeline
+from spectral_engine import multitaper_psd
+from band_power import FREQ_BANDS, band_matrix
+
+
+def window_psd(windows, sfreq, fmax=100, method='welch', seg_length=1.0):
+    '''
+        PSD of every window
+
+        Args:
+            - windows: np.array (windows, channels, samples)
+            - sfreq: float, sampling frequency
+            - fmax: float, highest frequency to keep
+            - method: str, "welch" (seg_length segments, 50% overlap) or "multitaper" (one estimate per window)
+        Returns:
+            - psds: np.array (windows, channels, freqs)
+            - freqs: 1D np.array of frequencies
+    '''
+    if method == 'welch':
+        freqs, psds = signal.welch(windows, fs=sfreq, nperseg=int(seg_length * sfreq), axis=-1)
+        fmask = freqs <= fmax
+        return psds[..., fmask], freqs[fmask]
+    elif method == 'multitaper':
+        return multitaper_psd(windows, sfreq, fmax=fmax)
+    raise NotImplementedError('Please chose either "welch", or "multitaper" for method')
+
+
+def compute_spectral_summary(nwb_file, window=4.0, fmax=100, method='welch', bands=FREQ_BANDS,
+                             ploss_max=0.1, block_windows=225, prefetch_depth=2):
+    '''
+        Streams a recording and computes the windowed spectrogram, package loss and hourly band power
+
+        Args:
+            - nwb_file: path, of the nwb file
+            - window: float, window length in seconds
+            - fmax: float, highest frequency to keep
+            - method: str, "welch" or "multitaper"
+            - bands: dict, band name: (fmin, fmax)
+            - ploss_max: float, windows with a larger fraction of package loss are left out of the hourly band power
+            - block_windows: int, number of windows read at once (225 windows of 4 s = 15 min)
+            - prefetch_depth: int, number of blocks read ahead while the previous block is processed
+        Returns:
+            - dict with the keys spectrogram (windows, channels, freqs), freqs, ploss_fraction (windows, channels),
+                hourly_band_power (hours, channels, bands), hourly_valid_fraction (hours, channels), sfreq, window
+    '''
+    low_val, high_val, art = get_filtering_info(nwb_file)
+
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        filtered = nwb.acquisition['filtered_EEG'].data
+        raw = nwb.acquisition['raw_EEG'].data
+        sfreq = nwb.acquisition['filtered_EEG'].rate
+        n_samples, n_channels = filtered.shape
+
+        win_samples = int(window * sfreq)
+        n_windows = n_samples // win_samples
+        block_samples = block_windows * win_samples
+        blocks = [(start, min(start + block_samples, n_windows * win_samples))
+                  for start in range(0, n_windows * win_samples, block_samples)]
+
+        def read_block(block, out):
+            start, end = block
+            return filtered[start:end].T, raw[start:end].T
+
+        def process_block(block, data):
+            filt, raw_eeg = data
+            n = filt.shape[-1] // win_samples
+            windows = filt.reshape(n_channels, n, win_samples).transpose(1, 0, 2)
+            ploss = find_package_loss(raw_eeg, low_val, high_val, art).reshape(n_channels, n, win_samples)
+            psds, freqs = window_psd(windows, sfreq, fmax=fmax, method=method)
+            return psds.astype(np.float32), freqs, ploss.mean(axis=-1).T
+
+        results, _ = run_pipeline(blocks, read_block, process_block, depth=prefetch_depth)
+
+    spectrogram = np.concatenate([psds for psds, _, _ in results])
+    freqs = results[0][1]
+    ploss_fraction = np.concatenate([ploss for _, _, ploss in results])
+
+    # Band power per window (one matrix multiply), then the mean of the valid windows per hour
+    df = freqs[1] - freqs[0]
+    band_power = spectrogram @ band_matrix(freqs, bands).astype(np.float32) * df
+    valid = ploss_fraction <= ploss_max
+    hour = (np.arange(n_windows) * window // 3600).astype(int)
+    n_hours = hour[-1] + 1 if n_windows else 0
+    per_hour = np.bincount(hour, minlength=n_hours)
+
+    hourly_sum = np.zeros((n_hours, n_channels, len(bands)))
+    np.add.at(hourly_sum, hour, np.where(valid[..., np.newaxis], band_power, 0))
+    hourly_valid = np.zeros((n_hours, n_channels))
+    np.add.at(hourly_valid, hour, valid)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        hourly_band_power = hourly_sum / hourly_valid[..., np.newaxis]
+
+    return {
+        'spectrogram': spectrogram,
+        'freqs': freqs,
+        'ploss_fraction': ploss_fraction,
+        'hourly_band_power': hourly_band_power,
+        'hourly_valid_fraction': hourly_valid / per_hour[:, np.newaxis],
+        'sfreq': sfreq,
+        'window': window
+    }
+
+
+def add_spectral_summary(nwb, summary, bands=FREQ_BANDS, method='welch', ploss_max=0.1):
+    '''
+        Adds the spectral summary as the processing module SPECTRAL_SUMMARY_MODULE to an nwb file opened in "a" mode
+    '''
+    channels = nwb.create_electrode_table_region(region=list(range(len(nwb.electrodes))),
+                                                 description='all electrodes')
+    window = summary['window']
+    freqs = summary['freqs']
+    df = freqs[1] - freqs[0]
+
+    module = nwb.create_processing_module(
+        name=SPECTRAL_SUMMARY_MODULE,
+        description=f'EEG spectral summary of filtered_EEG: {method} PSD of {window} s windows, '
+                    f'hourly band power of windows with package loss <= {ploss_max}'
+    )
+
+    spectrogram = DecompositionSeries(
+        name='spectrogram',
+        data=H5DataIO(data=summary['spectrogram'], compression=True),
+        metric='power',
+        unit='V^2/Hz',
+        description=f'{method} PSD per {window} s window',
+        source_timeseries=nwb.acquisition['filtered_EEG'],
+        source_channels=channels,
+        starting_time=0.,
+        rate=1 / window
+    )
+    for freq in freqs:
+        spectrogram.add_band(band_name=f'{freq:g}', band_limits=(freq - df / 2, freq + df / 2))
+    module.add(spectrogram)
+
+    module.add(TimeSeries(
+        name='ploss_fraction',
+        data=H5DataIO(data=summary['ploss_fraction'].astype(np.float32), compression=True),
+        unit='fraction',
+        description='Fraction of package loss samples per window and channel',
+        starting_time=0.,
+        rate=1 / window
+    ))
+
+    hourly = DecompositionSeries(
+        name='hourly_band_power',
+        data=summary['hourly_band_power'],
+        metric='power',
+        unit='V^2',
+        description=f'Mean band power per hour of recording, of the windows with package loss <= {ploss_max}',
+        source_timeseries=nwb.acquisition['filtered_EEG'],
+        source_channels=channels,
+        starting_time=0.,
+        rate=1 / 3600
+    )
+    for band, limits in bands.items():
+        hourly.add_band(band_name=band, band_limits=limits)
+    module.add(hourly)
+
+    module.add(TimeSeries(
+        name='hourly_valid_fraction',
+        data=summary['hourly_valid_fraction'],
+        unit='fraction',
+        description='Fraction of the windows per hour used for the hourly band power',
+        starting_time=0.,
+        rate=1 / 3600
+    ))
+
+
+if __name__ == '__main__':
+
+    # Load settings
+    with open('settings.json', "r") as f:
+        settings = json.load(f)
+
+    nwb_folder = settings['nwb_files_folder']
+
+    # Variables
+    window = 4.0 # seconds
+    method = 'welch'
+    fmax = 100
+    ploss_max = 0.1 # max. fraction of package loss in a window to use it for the hourly band power
+
+    # Main loop
+    for nwb_file in os.listdir(nwb_folder):
+        with open_nwb(f'{nwb_folder}/{nwb_file}') as io:
+            exists = SPECTRAL_SUMMARY_MODULE in io.read().processing
+        if exists:
+            print(f'Skipping {nwb_file} (spectral summary already exists)')
+            continue
+
+        print(f'Computing spectral summary of {nwb_file}')
+        summary = compute_spectral_summary(f'{nwb_folder}/{nwb_file}', window=window, fmax=fmax,
+                                           method=method, ploss_max=ploss_max)
+        with NWBHDF5IO(f'{nwb_folder}/{nwb_file}', "a") as io:
+            nwb = io.read()
+            add_spectral_summary(nwb, summary, method=method, ploss_max=ploss_max)
+            io.write(nwb)
+        print(f'Spectral summary added to NWB file: {nwb_file}')
@@ -19,7 +19,7 @@ import json
 import re
 from ndx_events import LabeledEvents, AnnotatedEventsTable, TTLs
 from taini_colonies_utils import str_sync_to_array
-from filtering_functions import interpolate_nan, time_to_samples, filtering
+from filtering_functions import interpolate_nan, time_to_samples, filtering, iir_notch
 # For compression
 from hdmf.backends.hdf5.h5_utils import H5DataIO
 
@@ -40,6 +40,7 @@ hcut = settings['hcut']
 art = settings['art']
 low_val = settings['low_val']
 high_val = settings['high_val']
+notch_freqs = settings.get('notch_freqs') # e.g. [50], None for no notch filter
 
 # Main 
 
@@ -155,6 +156,13 @@ for f in os.listdir(edf_folder):
         print(f'Filtering channel {channel}')
         filt.append(filtering(raw[channel][0][0], sfreq, lcut, hcut, low_val, high_val, art))
     filt = np.array(filt)
+    filtering_description = f'5th Order Bandpass butterwort Filter. Low:{lcut} Hz, High: {hcut}, low_val:{low_val}, high_val:{high_val}, art:{art}'
+
+    # Remove line noise once here, so epochs do not have to be notch filtered in every analysis
+    if notch_freqs:
+        print(f'Notch filtering at {notch_freqs} Hz')
+        filt = iir_notch(filt, sfreq, notch_freqs)
+        filtering_description += f', IIR notch (Q=30): {notch_freqs} Hz'
     
     # Create new ElectricalSeries object to hold the filtered EEG, and add to nwb
     filt_elec_series = ElectricalSeries(
@@ -163,7 +171,7 @@ for f in os.listdir(edf_folder):
         electrodes=all_table_region,
         starting_time = 0.,
         rate=sfreq,
-        filtering = f'5th Order Bandpass butterwort Filter. Low:{lcut} Hz, High: {hcut}, low_val:{low_val}, high_val:{high_val}, art:{art}'
+        filtering = filtering_description
     )
     nwb.add_acquisition(filt_elec_series)
 
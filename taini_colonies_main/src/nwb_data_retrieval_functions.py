@@ -6,6 +6,83 @@ Collection of various data retrieval functions to get data from NWB files
 import numpy as np
 import pandas as pd
 from pynwb import NWBHDF5IO
+import h5py
+import os
+
+# h5py file options used by all readers below (see set_read_options)
+READ_OPTIONS = {}
+
+# With a file driver (e.g. 'core') the last opened file is kept open and shared by all readers, path: NWBHDF5IO
+SHARED_FILES = {}
+
+# Processing modules with EEG derivatives, which are not behavior event traces
+SPECTRAL_SUMMARY_MODULE = 'eeg_spectral_summary'
+HYPNOGRAM_MODULE = 'eeg_hypnogram'
+PYRAMID_MODULE = 'eeg_pyramid'
+EEG_MODULES = [SPECTRAL_SUMMARY_MODULE, HYPNOGRAM_MODULE, PYRAMID_MODULE]
+
+# Statistics per bin of the EEG pyramid (last axis of its levels)
+PYRAMID_STATS = ['min', 'max', 'mean']
+
+def set_read_options(options=None, **kwargs):
+    '''
+        Sets the HDF5 read options used when opening NWB files for reading.
+        Can be given as a dict (e.g. settings['hdf5_read_options']) and/or as keyword arguments:
+            - rdcc_nbytes: int, raw data chunk cache size in bytes (h5py default is 1 MB)
+            - rdcc_nslots: int, number of chunk slots in the cache (preferably a prime ~100x the number of cached chunks)
+            - rdcc_w0: float between 0 and 1, chunk preemption policy (1 evicts fully read chunks first)
+            - page_buf_size: int, page buffer size in bytes (only for files written with paged aggregation)
+            - driver: str, e.g. 'core' to load the whole file into RAM on opening. The file is then opened once and
+                shared by all retrieval functions until another file is read or close_shared_files is called,
+                so only one file is held in memory. Do not open the same file for writing in the meantime
+        Options set to None are left at the h5py default.
+    '''
+    options = dict(options or {}, **kwargs)
+    unknown = set(options) - {'rdcc_nbytes', 'rdcc_nslots', 'rdcc_w0', 'page_buf_size', 'driver'}
+    if unknown:
+        raise ValueError(f'Unknown HDF5 read options: {unknown}')
+    close_shared_files()
+    READ_OPTIONS.clear()
+    READ_OPTIONS.update({key: value for key, value in options.items() if value is not None})
+
+class SharedNWB:
+    '''
+        Context manager around a shared NWBHDF5IO that leaves the file open on exit (see open_nwb)
+    '''
+    def __init__(self, io):
+        self.io = io
+
+    def __enter__(self):
+        return self.io
+
+    def __exit__(self, *args):
+        return False
+
+def close_shared_files():
+    '''
+        Closes the file kept open for the retrieval functions when a file driver is set
+    '''
+    for io in SHARED_FILES.values():
+        io.close()
+    SHARED_FILES.clear()
+
+def open_nwb(nwb_file):
+    '''
+        Opens an nwb_file for reading with the HDF5 read options set with set_read_options
+        Returns a NWBHDF5IO, to be used as a context manager.
+        With a file driver the file is only opened (and e.g. loaded into RAM) on the first call, the next calls
+        for the same file reuse it
+    '''
+    if not READ_OPTIONS:
+        return NWBHDF5IO(nwb_file, "r")
+    if 'driver' not in READ_OPTIONS:
+        return NWBHDF5IO(file=h5py.File(nwb_file, "r", **READ_OPTIONS), mode="r")
+
+    path = os.path.abspath(nwb_file)
+    if path not in SHARED_FILES:
+        close_shared_files()
+        SHARED_FILES[path] = NWBHDF5IO(file=h5py.File(nwb_file, "r", **READ_OPTIONS), mode="r")
+    return SharedNWB(SHARED_FILES[path])
 
 def get_raw_eeg(nwb_file, segment, channel_names=True):
     '''
@@ -14,7 +91,7 @@ def get_raw_eeg(nwb_file, segment, channel_names=True):
             keys: electorde brain locations
             values: EEG array
     '''
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         nwb = io.read()
         raw_eeg = nwb.acquisition['raw_EEG'].data[segment[0]: segment[1]].T
         if channel_names==False:
@@ -33,7 +110,7 @@ def get_filtered_eeg(nwb_file, segment, channel_names=True):
             keys: electorde brain locations
             values: 1D-array with filtered EEG samples, 
     '''
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         nwb = io.read()
         filtered_eeg = nwb.acquisition['filtered_EEG'].data[segment[0]: segment[1]].T
         if channel_names==False:
@@ -53,13 +130,37 @@ def get_ttl(nwb_file, arena_num, as_samples=True):
         Returns:
             - array of TTL onsets (in seconds or in sample numbers)
     '''
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         nwb = io.read()
         onsets = nwb.acquisition[f'TTL_{arena_num}'].timestamps[:]
         if as_samples:
             return (onsets*nwb.acquisition['raw_EEG'].rate).astype(int)
         return onsets
 
+def frames_to_samples(frames, ttl_onsets, sfreq, fps=30):
+    '''
+        Converts video frame numbers to EEG sample indices through the TTL pulses (one pulse every fps frames,
+        pulse k at frame (k - 1) * fps), for all frames at once. A frame on a pulse gets the onset of that pulse,
+        a frame between two pulses the mean of the estimates from the last and the next pulse.
+        get_behavior_eeg_onsets uses this too, so behavior epochs and motion features share one mapping.
+        Args:
+            - frames: array of frame numbers
+            - ttl_onsets: 1D array of TTL onsets in samples (get_ttl)
+            - sfreq: float, sampling frequency of the EEG
+            - fps: int, video frames per TTL pulse
+        Returns:
+            - np.array of EEG sample indices (int), -1 for frames outside the TTL pulses
+    '''
+    frames = np.asarray(frames, dtype=np.int64)
+    last_pulse = frames // fps
+    next_pulse = -(-frames // fps)
+    valid = (frames >= 0) & (next_pulse < len(ttl_onsets))
+    last_pulse, next_pulse = np.where(valid, last_pulse, 0), np.where(valid, next_pulse, 0)
+
+    x1 = (ttl_onsets[last_pulse] + (frames - last_pulse * fps) / fps * sfreq).astype(np.int64)
+    x2 = (ttl_onsets[next_pulse] - (next_pulse * fps - frames) / fps * sfreq).astype(np.int64)
+    return np.where(valid, ((x1 + x2) / 2).astype(np.int64), -1)
+
 def get_event_trace(nwb_file, version='last'):
     '''
         Retrieves the behavioral event trace data from an nwb files
@@ -67,7 +168,7 @@ def get_event_trace(nwb_file, version='last'):
             - pd.DataFrame of event trace
     '''
 
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         nwb = io.read()
         # Check version arg
         if version != 'last' and version not in nwb.processing.keys():
@@ -75,7 +176,7 @@ def get_event_trace(nwb_file, version='last'):
             raise IndexError(f'Version {version} invalid. Pick between {nwb.processing.keys()} for this nwb file')
         if version == 'last':
             try:
-                version = [i for i in nwb.processing.keys() if i != 'coordinate_data'][-1]
+                version = [i for i in nwb.processing.keys() if i != 'coordinate_data' and i not in EEG_MODULES][-1]
                 print("version is "+ version)
             except IndexError:
                 print(f"No event trace found in {nwb_file}")
@@ -111,11 +212,11 @@ def get_package_loss(nwb_file, segment):
     '''
     import re
 
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         nwb = io.read()
 
         # Parse filtering info
-        finfo = re.search('low_val:(.+),.+high_val:(.+),.+art:(.+)', nwb.acquisition['filtered_EEG'].filtering)
+        finfo = re.search('low_val:([^,]+),.+high_val:([^,]+),.+art:([^,]+)', nwb.acquisition['filtered_EEG'].filtering)
         low_val, high_val, art = float(finfo[1]), float(finfo[2]), finfo[3]
 
         # Find package loss in raw_eeg
@@ -135,15 +236,98 @@ def get_package_loss(nwb_file, segment):
             ploss_samples[location] = np.where(np.isnan(rej))[0]
         return ploss_signal, ploss_samples
 
+def get_eeg_segments(nwb_file, segments, out=None, filtered=True):
+    '''
+        Retrieves many equally long EEG segments from an nwb_file while opening it only once
+        Args:
+            - segments: list of (start, end) sample tuples, all of the same length
+            - out: np.array (segments, samples, channels) to read into, reused if the shape matches
+            - filtered: bool, read filtered_EEG (True) or raw_EEG (False)
+        Returns:
+            - np.array (segments, samples, channels). Use .transpose(0, 2, 1) for the (epochs, channels, samples) layout
+    '''
+    series = 'filtered_EEG' if filtered else 'raw_EEG'
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        dset = nwb.acquisition[series].data
+        shape = (len(segments), segments[0][1] - segments[0][0], dset.shape[1])
+        if out is None or out.shape != shape:
+            out = np.empty(shape, dtype=dset.dtype)
+        for i, (start, end) in enumerate(segments):
+            dset.read_direct(out, source_sel=np.s_[start:end], dest_sel=np.s_[i])
+        return out
+
+def get_ragged_segments(nwb_file, segments, out=None, filtered=True):
+    '''
+        Retrieves EEG segments of different lengths from an nwb_file while opening it only once, into one flat buffer
+        Args:
+            - segments: list of (start, end) sample tuples
+            - out: np.array (samples, channels) to read into, reused if it is long enough
+            - filtered: bool, read filtered_EEG (True) or raw_EEG (False)
+        Returns:
+            - np.array (total samples, channels), segment i is data[offsets[i]:offsets[i+1]]
+            - offsets: 1D int np.array (segments + 1) of sample offsets into data
+    '''
+    series = 'filtered_EEG' if filtered else 'raw_EEG'
+    offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+    np.cumsum([end - start for start, end in segments], out=offsets[1:])
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        dset = nwb.acquisition[series].data
+        if out is None or out.shape[0] < offsets[-1] or out.shape[1:] != dset.shape[1:]:
+            out = np.empty((offsets[-1], dset.shape[1]), dtype=dset.dtype)
+        out = out[:offsets[-1]]
+        for i, (start, end) in enumerate(segments):
+            dset.read_direct(out, source_sel=np.s_[start:end], dest_sel=np.s_[offsets[i]:offsets[i + 1]])
+        return out, offsets
+
+def get_n_samples(nwb_file, filtered=True):
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        return nwb.acquisition['filtered_EEG' if filtered else 'raw_EEG'].data.shape[0]
+
+def get_channel_locations(nwb_file):
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        return list(nwb.electrodes.location.data[:])
+
+def get_filtering_info(nwb_file):
+    '''
+        Parses the package loss thresholds stored in the filtered_EEG description
+        Returns (low_val, high_val, art). art is None if no artifact threshold was used
+    '''
+    import re
+
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        finfo = re.search('low_val:([^,]+),.+high_val:([^,]+),.+art:([^,]+)', nwb.acquisition['filtered_EEG'].filtering)
+        art = None if finfo[3] == 'None' else float(finfo[3])
+        return float(finfo[1]), float(finfo[2]), art
+
+def find_package_loss(raw_eeg, low_val, high_val, art=None):
+    '''
+        Vectorized version of the package loss detection in get_package_loss, along the last axis
+        Args:
+            - raw_eeg: np.array (..., samples) of raw EEG
+        Returns:
+            - bool np.array of the same shape, True where there is package loss
+    '''
+    rej = np.where((raw_eeg > low_val) & (raw_eeg < high_val), raw_eeg, np.nan)
+    if art is not None:
+        mean = np.mean(rej, axis=-1, keepdims=True)
+        std = np.std(rej, axis=-1, keepdims=True)
+        rej = np.where((rej > mean + art*std) | (rej < mean - art*std), np.nan, rej)
+    return np.isnan(rej)
+
 def get_sfreq(nwb_file, filtered=True):
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         nwb = io.read()
         if filtered:
             return nwb.acquisition['filtered_EEG'].rate
         return nwb.acquisition['raw_EEG'].rate
 
 def get_metadata(nwb_file, picks='all'):
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         if picks == 'all':
             return io.read().fields
         else:
@@ -154,53 +338,213 @@ def get_xy_coordinates(nwb_file, animal, body_point = 'center'):
     if body_point not in ['center', 'nose']:
         raise ValueError('body_point must be either center or nose')
     
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         nwb = io.read()
         data = nwb.processing['coordinate_data'][f'xy_{body_point}_{animal}'].data[:]
         timestamps = nwb.processing['coordinate_data'][f'xy_{body_point}_{animal}'].timestamps[:].astype(int)
         return timestamps, data
     
 def get_motion_data(nwb_file, animal):
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         nwb = io.read()
         data = nwb.processing['coordinate_data'][f'motion_{animal}'].data[:]
         timestamps = nwb.processing['coordinate_data'][f'motion_{animal}'].timestamps[:].astype(int)
         return timestamps, data
 
 def get_orientation_data(nwb_file, animal):
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         nwb = io.read()
         data = nwb.processing['coordinate_data'][f'orientation_{animal}'].data[:]
         timestamps = nwb.processing['coordinate_data'][f'orientation_{animal}'].timestamps[:].astype(int)
         return timestamps, data
 
 def get_animal_id(nwb_file):
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         nwb = io.read()
         return nwb.subject.subject_id
         
         
 # def get_genotype(nwb_file):
-#     with NWBHDF5IO(nwb_file, "r") as io:
+#     with open_nwb(nwb_file) as io:
 #         nwb = io.read()
 #         return nwb.subject.genotype
 
 def get_arena_id(nwb_file):
     from re import search
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         nwb = io.read()
         ses = nwb.experiment_description
         return search('Colony\/Arena_(\d+)', ses)[1]
     
 def get_arena_position(nwb_file):
     from re import search
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         nwb = io.read()
         ses = nwb.experiment_description
         return search('Position_(\d+)', ses)[1]
 
 def get_day(nwb_file):
     from re import search
-    with NWBHDF5IO(nwb_file, "r") as io:
+    with open_nwb(nwb_file) as io:
         nwb = io.read()
         return search("Day(\d+)", nwb.identifier)[1]
+
+def get_spectrogram(nwb_file, start=None, end=None):
+    '''
+        Retrieves the windowed spectrogram stored by nwb_add_spectral_summary.py
+        Args:
+            - start, end: window indexes to read (None reads all windows)
+        Returns:
+            - spectrogram: np.array (windows, channels, freqs)
+            - times: 1D np.array, window start times in seconds
+            - freqs: 1D np.array of frequencies
+            - ploss_fraction: np.array (windows, channels), fraction of package loss per window
+            - locations: list of channel locations
+    '''
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        module = nwb.processing[SPECTRAL_SUMMARY_MODULE]
+        spectrogram = module['spectrogram'].data[start:end]
+        window = 1 / module['spectrogram'].rate
+        first = start or 0
+        times = (first + np.arange(spectrogram.shape[0])) * window
+        freqs = np.array(module['spectrogram'].bands['band_name'].data[:], dtype=float)
+        ploss_fraction = module['ploss_fraction'].data[start:end]
+        locations = nwb.electrodes.location.data[:].tolist()
+        return spectrogram, times, freqs, ploss_fraction, locations
+
+def get_hourly_band_power(nwb_file):
+    '''
+        Retrieves the hourly band power stored by nwb_add_spectral_summary.py
+        Returns:
+            - pd.DataFrame with the columns hour (hours since the start of the recording), channel, band,
+                power and valid_fraction (fraction of the windows in that hour without package loss)
+    '''
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        module = nwb.processing[SPECTRAL_SUMMARY_MODULE]
+        power = module['hourly_band_power'].data[:]
+        valid = module['hourly_valid_fraction'].data[:]
+        bands = [str(band) for band in module['hourly_band_power'].bands['band_name'].data[:]]
+        locations = nwb.electrodes.location.data[:].tolist()
+
+    n_hours, n_channels, n_bands = power.shape
+    return pd.DataFrame({
+        'hour': np.repeat(np.arange(n_hours), n_channels * n_bands),
+        'channel': np.tile(np.repeat(locations, n_bands), n_hours),
+        'band': np.tile(bands, n_hours * n_channels),
+        'power': power.ravel(),
+        'valid_fraction': np.repeat(valid.ravel(), n_bands)
+    })
+
+def get_hypnogram(nwb_file):
+    '''
+        Retrieves the vigilance state intervals stored by nwb_add_hypnogram.py
+        Returns:
+            - pd.DataFrame with the columns start_time, stop_time (seconds of EEG) and state
+                ("wake", "nrem", "rem" or "unscored"), sorted by start_time
+    '''
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        if HYPNOGRAM_MODULE not in nwb.processing:
+            raise KeyError(f'No hypnogram in {nwb_file}, run nwb_add_hypnogram.py first')
+        intervals = nwb.processing[HYPNOGRAM_MODULE]['hypnogram']
+        return pd.DataFrame({
+            'start_time': intervals['start_time'].data[:],
+            'stop_time': intervals['stop_time'].data[:],
+            'state': np.array(intervals['state'].data[:]).astype(str)
+        })
+
+def lookup_states(hypnogram, times):
+    '''
+        Vigilance state at every time point, with one binary search over the interval starts
+        Args:
+            - hypnogram: pd.DataFrame as returned by get_hypnogram
+            - times: array of times in seconds of EEG (e.g. beh_start_sample / sfreq)
+        Returns:
+            - np.array of states ("unscored" outside the intervals)
+    '''
+    times = np.asarray(times, dtype=float)
+    starts = hypnogram['start_time'].to_numpy()
+    idx = np.searchsorted(starts, times, side='right') - 1
+    inside = (idx >= 0) & (times < hypnogram['stop_time'].to_numpy()[np.clip(idx, 0, None)])
+    return np.where(inside, hypnogram['state'].to_numpy()[np.clip(idx, 0, None)], 'unscored')
+
+def get_pyramid_factors(nwb_file):
+    '''
+        Samples per bin of the pyramid levels stored by nwb_add_eeg_pyramid.py (empty list without a pyramid)
+    '''
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        if PYRAMID_MODULE not in nwb.processing:
+            return []
+        return sorted(int(name.split('_')[-1]) for name in nwb.processing[PYRAMID_MODULE].data_interfaces)
+
+def choose_pyramid_level(n_samples, n_pixels, factors):
+    '''
+        Coarsest pyramid factor that still gives at least one bin per pixel (1 is the full resolution)
+    '''
+    return max([factor for factor in factors if n_samples // factor >= n_pixels], default=1)
+
+def minmax_decimate(x, n_pixels=None, factor=None):
+    '''
+        Min, max and mean per bin of the last axis, with the largest bin size that keeps at least n_pixels bins
+        Args:
+            - x: np.array (..., samples)
+            - n_pixels: int, minimal number of bins
+            - factor: int, samples per bin (instead of n_pixels, e.g. for blocks of a longer signal)
+        Returns:
+            - np.array (..., 3, bins) of the min, max and mean (PYRAMID_STATS), or (..., 1, samples) with the signal
+                itself if a bin would be a single sample
+            - factor: int, samples per bin
+    '''
+    x = np.asarray(x)
+    if factor is None:
+        factor = max(x.shape[-1] // n_pixels, 1)
+    if factor == 1:
+        return x[..., np.newaxis, :], 1
+    starts = np.arange(0, x.shape[-1], factor)
+    counts = np.diff(np.r_[starts, x.shape[-1]])
+    return np.stack([np.minimum.reduceat(x, starts, axis=-1), np.maximum.reduceat(x, starts, axis=-1),
+                     np.add.reduceat(x, starts, axis=-1) / counts], axis=-2), factor
+
+def get_eeg_pyramid(nwb_file, segment, n_pixels=2000, channel_names=True, block_samples=2**20):
+    '''
+        Retrieves a segment of the filtered EEG at the coarsest pyramid level with at least one bin per pixel
+        Args:
+            - segment: (start, end) in samples of the filtered EEG, None reads the whole recording
+            - n_pixels: int, width of the plot in pixels
+            - block_samples: int, samples read at once when no pyramid level fits
+        Returns:
+            - dict (or np.array (channels, 3, bins) if channel_names == False):
+                keys: electrode brain locations
+                values: np.array (3, bins) with the min, max and mean per bin (PYRAMID_STATS)
+            - factor: int, samples per bin. Without a suitable pyramid level the segment is streamed in blocks
+                through minmax_decimate. 1 if the segment has no more samples than pixels, the values are then
+                np.array (1, samples) with the signal itself
+            - start: int, first sample of the first bin
+    '''
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        n_samples = nwb.acquisition['filtered_EEG'].data.shape[0]
+        start, end = (0, n_samples) if segment is None else (segment[0], min(segment[1], n_samples))
+        factors = []
+        if PYRAMID_MODULE in nwb.processing:
+            factors = [int(name.split('_')[-1]) for name in nwb.processing[PYRAMID_MODULE].data_interfaces]
+        factor = choose_pyramid_level(end - start, n_pixels, factors)
+
+        if factor == 1:
+            # No pyramid level fits, decimate the segment block by block (bins of factor samples)
+            eeg = nwb.acquisition['filtered_EEG'].data
+            factor = max((end - start) // n_pixels, 1)
+            step = max(block_samples // factor, 1) * factor
+            data = np.concatenate([minmax_decimate(eeg[block:min(block + step, end)].T, factor=factor)[0]
+                                   for block in range(start, end, step)], axis=-1)
+        else:
+            level = nwb.processing[PYRAMID_MODULE][f'level_{factor}'].data
+            start = start // factor * factor
+            data = level[start // factor: -(-end // factor)].transpose(1, 2, 0)
+        if channel_names==False:
+            return data, factor, start
+        locations = nwb.electrodes.location.data[:]
+        return dict(zip(locations, data)), factor, start
@@ -0,0 +1,212 @@
+'''
+Per-second table of EEG band power and motion of the focal animal, aligned through the TTL pulses
+
+The frame timestamps of the coordinate_data series (motion_<a>, xy_center_<a>) are converted to EEG sample
+indices for all frames at once (frames_to_samples), which puts every frame in a window of the EEG time grid.
+On that grid (e.g. 1 s windows) the table holds:
+    - motion: number of frames, mean Motion value, mean speed (mm/s), distance travelled (mm) and mean x, y position
+    - EEG: band power per channel (Welch PSD per window, integrated with band_matrix) and the fraction of package
+      loss per channel. Band power of windows with more package loss than ploss_max is NaN
+The EEG is streamed in blocks of windows, the motion features are binned with np.bincount.
+The focal animal is the animal at the arena position of the recording (as in nwb_add_event_trace.py).
+'''
+
+import numpy as np
+import pandas as pd
+from ndx_events import LabeledEvents, AnnotatedEventsTable, TTLs
+import os
+import json
+from nwb_data_retrieval_functions import (open_nwb, get_filtering_info, find_package_loss, get_arena_id,
+                                          get_arena_position, get_ttl, get_sfreq, get_motion_data, get_xy_coordinates,
+                                          frames_to_samples, set_read_options)
+from prefetch_pipeline import run_pipeline
+from nwb_add_spectral_summary import window_psd
+from band_power import FREQ_BANDS, band_matrix
+
+MOTION_FEATURES = ['n_frames', 'motion', 'speed', 'distance', 'x', 'y']
+
+
+def binned_mean(values, bins, n_bins):
+    '''
+        Mean of the finite values per bin (NaN for empty bins)
+    '''
+    finite = np.isfinite(values)
+    counts = np.bincount(bins[finite], minlength=n_bins)
+    sums = np.bincount(bins[finite], weights=values[finite], minlength=n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def get_n_windows(nwb_file, window=1.0):
+    '''
+        Number of complete windows in the filtered EEG
+    '''
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        return nwb.acquisition['filtered_EEG'].data.shape[0] // int(window * nwb.acquisition['filtered_EEG'].rate)
+
+
+def motion_features(nwb_file, animal, window=1.0, fps=30):
+    '''
+        Motion and position features of one animal on the EEG window grid
+
+        Args:
+            - nwb_file: path, of the nwb file
+            - animal: int, animal number in coordinate_data (motion_<animal>, xy_center_<animal>)
+            - window: float, window length in seconds
+            - fps: int, video frames per TTL pulse
+        Returns:
+            - pd.DataFrame with one row per window and the columns of MOTION_FEATURES
+    '''
+    sfreq = get_sfreq(nwb_file)
+    n_windows = int(get_n_windows(nwb_file, window))
+    ttl_onsets = get_ttl(nwb_file, get_arena_id(nwb_file))
+    win_samples = int(window * sfreq)
+
+    motion_frames, motion = get_motion_data(nwb_file, animal)
+    xy_frames, xy = get_xy_coordinates(nwb_file, animal, body_point='center')
+
+    def frame_windows(frames):
+        samples = frames_to_samples(frames, ttl_onsets, sfreq, fps)
+        windows = np.where(samples >= 0, samples // win_samples, -1)
+        return samples, np.where(windows < n_windows, windows, -1)
+
+    # Motion per frame
+    _, motion_windows = frame_windows(motion_frames)
+    keep = motion_windows >= 0
+    features = {
+        'n_frames': np.bincount(motion_windows[keep], minlength=n_windows),
+        'motion': binned_mean(motion[keep, 0].astype(float), motion_windows[keep], n_windows)
+    }
+
+    # Speed between consecutive frames, assigned to the window of the second frame
+    xy_samples, xy_windows = frame_windows(xy_frames)
+    keep = xy_windows >= 0
+    step = np.full(len(xy), np.nan)
+    step[1:] = np.linalg.norm(np.diff(xy.astype(float), axis=0), axis=1)
+    dt = np.full(len(xy), np.nan)
+    dt[1:] = np.diff(xy_samples) / sfreq
+    step[1:][(xy_samples[:-1] < 0) | (dt[1:] <= 0)] = np.nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        speed = step / dt
+    features['speed'] = binned_mean(speed[keep], xy_windows[keep], n_windows)
+    finite = keep & np.isfinite(step)
+    features['distance'] = np.bincount(xy_windows[finite], weights=step[finite], minlength=n_windows)
+    features['x'] = binned_mean(xy[keep, 0].astype(float), xy_windows[keep], n_windows)
+    features['y'] = binned_mean(xy[keep, 1].astype(float), xy_windows[keep], n_windows)
+    return pd.DataFrame(features)
+
+
+def eeg_band_features(nwb_file, window=1.0, bands=FREQ_BANDS, ploss_max=0.1, block_windows=900, prefetch_depth=2):
+    '''
+        Band power per window and channel of the filtered EEG, streamed in blocks of windows
+
+        Args:
+            - nwb_file: path, of the nwb file
+            - window: float, window length in seconds (also the Welch segment length)
+            - bands: dict, band name: (fmin, fmax)
+            - ploss_max: float, band power of windows with a larger fraction of package loss is NaN
+            - block_windows: int, number of windows read at once
+            - prefetch_depth: int, number of blocks read ahead while the previous block is processed
+        Returns:
+            - pd.DataFrame with one row per window and the columns <channel>_<band> and <channel>_ploss
+    '''
+    low_val, high_val, art = get_filtering_info(nwb_file)
+
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        filtered = nwb.acquisition['filtered_EEG'].data
+        raw = nwb.acquisition['raw_EEG'].data
+        sfreq = nwb.acquisition['filtered_EEG'].rate
+        locations = nwb.electrodes.location.data[:].tolist()
+        n_samples, n_channels = filtered.shape
+
+        win_samples = int(window * sfreq)
+        n_windows = n_samples // win_samples
+        block_samples = block_windows * win_samples
+        blocks = [(start, min(start + block_samples, n_windows * win_samples))
+                  for start in range(0, n_windows * win_samples, block_samples)]
+        fmax = max(high for _, high in bands.values())
+
+        def read_block(block, out):
+            start, end = block
+            return filtered[start:end].T, raw[start:end].T
+
+        def process_block(block, data):
+            filt, raw_eeg = data
+            n = filt.shape[-1] // win_samples
+            windows = filt.reshape(n_channels, n, win_samples).transpose(1, 0, 2)
+            ploss = find_package_loss(raw_eeg, low_val, high_val, art).reshape(n_channels, n, win_samples).mean(axis=-1).T
+            psds, freqs = window_psd(windows, sfreq, fmax=fmax, seg_length=window)
+            band_power = psds @ band_matrix(freqs, bands) * (freqs[1] - freqs[0])
+            band_power[ploss > ploss_max] = np.nan
+            return band_power, ploss
+
+        results, _ = run_pipeline(blocks, read_block, process_block, depth=prefetch_depth)
+
+    band_power = np.concatenate([power for power, _ in results])
+    ploss = np.concatenate([ploss for _, ploss in results])
+    columns = {f'{location}_{band}': band_power[:, i, j]
+               for i, location in enumerate(locations) for j, band in enumerate(bands)}
+    columns.update({f'{location}_ploss': ploss[:, i] for i, location in enumerate(locations)})
+    return pd.DataFrame(columns)
+
+
+def eeg_motion_features(nwb_file, animal=None, window=1.0, bands=FREQ_BANDS, ploss_max=0.1, fps=30, **kwargs):
+    '''
+        Per-window table of EEG band power and motion of the focal animal on a shared time grid
+
+        Args:
+            - nwb_file: path, of the nwb file
+            - animal: int, animal number in coordinate_data. None uses the focal animal (the arena position)
+            - window: float, window length in seconds
+            - bands: dict, band name: (fmin, fmax)
+            - ploss_max: float, band power of windows with a larger fraction of package loss is NaN
+            - fps: int, video frames per TTL pulse
+            - **kwargs: passed to eeg_band_features (block_windows, prefetch_depth)
+        Returns:
+            - pd.DataFrame with one row per window: time (window start in seconds of EEG), the motion features
+                (MOTION_FEATURES) and the EEG features (<channel>_<band>, <channel>_ploss)
+    '''
+    if animal is None:
+        animal = int(get_arena_position(nwb_file))
+    motion = motion_features(nwb_file, animal, window=window, fps=fps)
+    eeg = eeg_band_features(nwb_file, window=window, bands=bands, ploss_max=ploss_max, **kwargs)
+    features = pd.concat([motion, eeg], axis=1)
+    features.insert(0, 'time', np.arange(len(features)) * window)
+    return features
+
+
+if __name__ == '__main__':
+
+    # Load settings
+    with open('settings.json', "r") as f:
+        settings = json.load(f)
+
+    nwb_folder = settings['nwb_files_folder']
+    features_folder = settings.get('features_folder', 'features')
+    set_read_options(settings.get('hdf5_read_options'))
+    os.makedirs(features_folder, exist_ok=True)
+
+    # Variables
+    window = 1.0 # seconds
+    ploss_max = 0.1 # max. fraction of package loss in a window to keep its band power
+
+    # Main loop
+    for nwb_file in os.listdir(nwb_folder):
+        filename = os.path.splitext(nwb_file)[0]
+        features_file = f'{features_folder}/{filename}_eeg_motion.csv'
+        if os.path.exists(features_file):
+            print(f'Skipping {nwb_file} (feature table already exists)')
+            continue
+
+        with open_nwb(f'{nwb_folder}/{nwb_file}') as io:
+            has_coordinates = 'coordinate_data' in io.read().processing
+        if not has_coordinates:
+            print(f'No coordinate data in {nwb_file}')
+            continue
+
+        print(f'Computing EEG and motion features of {nwb_file}')
+        features = eeg_motion_features(f'{nwb_folder}/{nwb_file}', window=window, ploss_max=ploss_max)
+        features.to_csv(features_file, index=False)
+        print(f'Feature table saved: {features_file}')
@@ -0,0 +1,263 @@
+'''
+Quality control of the EEG recordings in one streaming pass
+
+raw_EEG and filtered_EEG are read block by block (blocks never cross an hour), and per channel and hour
+of recording the following is accumulated:
+    - package loss: fraction of samples flagged by find_package_loss
+    - rails: fraction of raw samples at or below low_val and at or above high_val. find_package_loss drops all of
+      these, so they overlap with the package loss
+    - clipping: fraction of raw samples at the rails in runs shorter than clip_seconds. Longer runs at a rail are
+      dropouts (package loss), short ones are signal excursions that hit the range of the amplifier
+    - flat signal: fraction of 1 s windows without package loss in which the raw signal does not change
+    - mean, std and RMS of the filtered EEG (samples without package loss), with Welford / Chan accumulators
+      (count, mean, sum of squared deviations) that are merged block by block without keeping the signal
+Every file gets a QC table (one row per hour and channel) and the batch gets a summary with one row per file
+and channel, in which channels are flagged as bad, so the bads dict of the notebooks can be made from it.
+'''
+
+import numpy as np
+import pandas as pd
+from ndx_events import LabeledEvents, AnnotatedEventsTable, TTLs
+import os
+import json
+from nwb_data_retrieval_functions import (open_nwb, get_filtering_info, find_package_loss, get_animal_id, get_day,
+                                          set_read_options)
+from prefetch_pipeline import run_pipeline
+
+QC_COUNTS = ['n_samples', 'n_ploss', 'n_low_clip', 'n_high_clip', 'n_clip', 'n_windows', 'n_flat_windows']
+
+
+def block_moments(x, valid):
+    '''
+        Count, mean and sum of squared deviations per channel of the valid samples of a block (channels, samples)
+    '''
+    count = valid.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, np.sum(np.where(valid, x, 0), axis=-1) / count, 0)
+    m2 = np.sum(np.where(valid, x - mean[:, np.newaxis], 0) ** 2, axis=-1)
+    return count, mean, m2
+
+
+def merge_moments(acc, count, mean, m2):
+    '''
+        Merges the moments of a block into an accumulator (count, mean, m2), with Chan's parallel Welford update
+    '''
+    n_a, mean_a, m2_a = acc
+    n = n_a + count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = mean - mean_a
+        merged_mean = np.where(n > 0, mean_a + delta * count / n, 0)
+        merged_m2 = m2_a + m2 + np.where(n > 0, delta ** 2 * n_a * count / n, 0)
+    return n, merged_mean, merged_m2
+
+
+def short_run_counts(mask, max_length):
+    '''
+        Number of True samples per channel (first axis) in runs of fewer than max_length samples along the last axis
+    '''
+    n_channels, n_samples = mask.shape
+    padded = np.zeros((n_channels, n_samples + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded.ravel())
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    lengths = ends - starts
+    short = lengths < max_length
+    return np.bincount(starts[short] // (n_samples + 2), weights=lengths[short], minlength=n_channels).astype(np.int64)
+
+
+def qc_blocks(n_samples, sfreq, block_seconds=600):
+    '''
+        (start, end, hour) sample blocks of at most block_seconds that do not cross an hour
+    '''
+    hour_samples = int(3600 * sfreq)
+    block_samples = int(block_seconds * sfreq)
+    return [(start, min(start + block_samples, hour_start + hour_samples, n_samples), hour_start // hour_samples)
+            for hour_start in range(0, n_samples, hour_samples)
+            for start in range(hour_start, min(hour_start + hour_samples, n_samples), block_samples)]
+
+
+def compute_qc(nwb_file, block_seconds=600, flat_window=1.0, clip_seconds=0.05, prefetch_depth=2):
+    '''
+        Streams a recording once and computes the QC statistics per hour and channel
+
+        Args:
+            - nwb_file: path, of the nwb file
+            - block_seconds: float, seconds read at once
+            - flat_window: float, window length in seconds for the flat signal check
+            - clip_seconds: float, runs at the rails shorter than this are clipping, longer runs are dropouts
+            - prefetch_depth: int, number of blocks read ahead while the previous block is processed
+        Returns:
+            - pd.DataFrame, one row per hour and channel with hour, channel, the counts of QC_COUNTS,
+                ploss_fraction, low_clip_fraction, high_clip_fraction, clip_fraction, flat_fraction, mean, std and rms
+    '''
+    low_val, high_val, art = get_filtering_info(nwb_file)
+
+    with open_nwb(nwb_file) as io:
+        nwb = io.read()
+        filtered = nwb.acquisition['filtered_EEG'].data
+        raw = nwb.acquisition['raw_EEG'].data
+        sfreq = nwb.acquisition['filtered_EEG'].rate
+        locations = nwb.electrodes.location.data[:].tolist()
+        n_samples, n_channels = filtered.shape
+        blocks = qc_blocks(n_samples, sfreq, block_seconds)
+        n_hours = blocks[-1][2] + 1 if blocks else 0
+        win_samples = int(flat_window * sfreq)
+        clip_samples = max(int(clip_seconds * sfreq), 1)
+
+        counts = {key: np.zeros((n_hours, n_channels), dtype=np.int64) for key in QC_COUNTS}
+        moments = (np.zeros((n_hours, n_channels)), np.zeros((n_hours, n_channels)), np.zeros((n_hours, n_channels)))
+
+        def read_block(block, out):
+            start, end, _ = block
+            return raw[start:end].T, filtered[start:end].T
+
+        def process_block(block, data):
+            _, _, hour = block
+            raw_eeg, filt = data
+            ploss = find_package_loss(raw_eeg, low_val, high_val, art)
+            counts['n_samples'][hour] += raw_eeg.shape[-1]
+            counts['n_ploss'][hour] += ploss.sum(axis=-1)
+            low, high = raw_eeg <= low_val, raw_eeg >= high_val
+            counts['n_low_clip'][hour] += low.sum(axis=-1)
+            counts['n_high_clip'][hour] += high.sum(axis=-1)
+            # Short runs at either rail (runs crossing a block edge are counted per block)
+            counts['n_clip'][hour] += short_run_counts(low, clip_samples) + short_run_counts(high, clip_samples)
+
+            # Flat windows: no change of the raw signal in a window without package loss
+            n_win = raw_eeg.shape[-1] // win_samples
+            windows = raw_eeg[:, :n_win * win_samples].reshape(n_channels, n_win, win_samples)
+            clean = ~ploss[:, :n_win * win_samples].reshape(n_channels, n_win, win_samples).any(axis=-1)
+            flat = np.ptp(windows, axis=-1) == 0
+            counts['n_windows'][hour] += clean.sum(axis=-1)
+            counts['n_flat_windows'][hour] += (flat & clean).sum(axis=-1)
+
+            merged = merge_moments(tuple(m[hour] for m in moments), *block_moments(filt.astype(float), ~ploss))
+            for m, value in zip(moments, merged):
+                m[hour] = value
+
+        run_pipeline(blocks, read_block, process_block, depth=prefetch_depth)
+
+    return qc_table(counts, moments, locations)
+
+
+def qc_table(counts, moments, locations):
+    '''
+        QC table (rows x channels accumulators -> one row per row and channel) with the derived fractions
+    '''
+    n_rows, n_channels = counts['n_samples'].shape
+    df = pd.DataFrame({
+        'hour': np.repeat(np.arange(n_rows), n_channels),
+        'channel': np.tile(locations, n_rows)
+    })
+    for key, value in counts.items():
+        df[key] = value.ravel()
+    n_valid, mean, m2 = [m.ravel() for m in moments]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        df['ploss_fraction'] = df['n_ploss'] / df['n_samples']
+        df['low_clip_fraction'] = df['n_low_clip'] / df['n_samples']
+        df['high_clip_fraction'] = df['n_high_clip'] / df['n_samples']
+        df['clip_fraction'] = df['n_clip'] / df['n_samples']
+        df['flat_fraction'] = df['n_flat_windows'] / df['n_windows']
+        df['n_valid'] = n_valid
+        df['mean'] = np.where(n_valid > 0, mean, np.nan)
+        df['std'] = np.sqrt(m2 / n_valid)
+        df['rms'] = np.sqrt(m2 / n_valid + mean ** 2)
+    return df
+
+
+def summarize_qc(qc):
+    '''
+        Merges the hourly rows of a QC table into one row per channel
+        (the hourly moments are combined as merge_moments does, all hours at once)
+    '''
+    qc = qc.fillna({'mean': 0, 'std': 0})
+    grouped = qc.groupby('channel', sort=False)
+    channels = list(grouped.groups)
+    n = grouped['n_valid'].transform('sum')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (qc['n_valid'] * qc['mean']).groupby(qc['channel']).transform('sum') / n
+    m2 = qc['std'] ** 2 * qc['n_valid'] + qc['n_valid'] * (qc['mean'] - mean.fillna(0)) ** 2
+
+    counts = {key: grouped[key].sum()[channels].to_numpy()[np.newaxis] for key in QC_COUNTS}
+    moments = [grouped['n_valid'].sum()[channels].to_numpy()[np.newaxis],
+               mean.groupby(qc['channel']).first()[channels].fillna(0).to_numpy()[np.newaxis],
+               m2.groupby(qc['channel']).sum()[channels].to_numpy()[np.newaxis]]
+    return qc_table(counts, moments, channels).drop(columns='hour')
+
+
+def flag_channels(summary, max_ploss=0.2, max_clip=0.01, max_flat=0.1, rms_z=3.0):
+    '''
+        Flags bad channels in a batch summary (one row per file and channel)
+
+        Args:
+            - summary: pd.DataFrame with at least channel, ploss_fraction, clip_fraction, flat_fraction, rms
+            - max_ploss, max_clip, max_flat: float, maximum fractions of package loss, clipping (short runs at the
+                rails, see compute_qc) and flat windows
+            - rms_z: float, maximum robust z-score (median / MAD) of the log RMS among the files of the same channel
+        Returns:
+            - pd.DataFrame with the flag_ploss, flag_clip, flag_flat, flag_rms and bad columns added
+    '''
+    summary = summary.copy()
+    log_rms = np.log10(summary['rms'])
+    median = log_rms.groupby(summary['channel']).transform('median')
+    mad = (log_rms - median).abs().groupby(summary['channel']).transform('median') * 1.4826
+    summary['rms_z'] = (log_rms - median) / mad.replace(0, np.nan)
+
+    summary['flag_ploss'] = summary['ploss_fraction'] > max_ploss
+    summary['flag_clip'] = summary['clip_fraction'] > max_clip
+    summary['flag_flat'] = summary['flat_fraction'] > max_flat
+    summary['flag_rms'] = summary['rms_z'].abs() > rms_z
+    summary['bad'] = summary[['flag_ploss', 'flag_clip', 'flag_flat', 'flag_rms']].any(axis=1)
+    return summary
+
+
+def bads_from_qc(summary, animal_col='animal_id'):
+    '''
+        Bad channels per animal as the bads dict used in psd_analysis.ipynb ({animal: [channels]})
+        A channel is bad for an animal if it is flagged in any of its files
+    '''
+    bad = summary[summary['bad']]
+    return {animal: sorted(rows['channel'].unique().tolist()) for animal, rows in bad.groupby(animal_col)}
+
+
+if __name__ == '__main__':
+
+    # Load settings
+    with open('settings.json', "r") as f:
+        settings = json.load(f)
+
+    nwb_folder = settings['nwb_files_folder']
+    qc_folder = settings.get('qc_folder', 'qc')
+    set_read_options(settings.get('hdf5_read_options'))
+    os.makedirs(qc_folder, exist_ok=True)
+
+    # Variables
+    block_seconds = 600
+    max_ploss = 0.2 # fractions of the recording
+    max_clip = 0.01
+    max_flat = 0.1
+    rms_z = 3.0 # robust z-score of the log RMS among the recordings of the same channel
+
+    # Main loop, the per-file tables are reused if they exist
+    summaries = []
+    for nwb_file in os.listdir(nwb_folder):
+        filename = os.path.splitext(nwb_file)[0]
+        qc_file = f'{qc_folder}/{filename}_qc.csv'
+        if os.path.exists(qc_file):
+            print(f'Loading existing QC of {nwb_file}')
+            qc = pd.read_csv(qc_file)
+        else:
+            print(f'Computing QC of {nwb_file}')
+            qc = compute_qc(f'{nwb_folder}/{nwb_file}', block_seconds=block_seconds)
+            qc.to_csv(qc_file, index=False)
+
+        summary = summarize_qc(qc)
+        summary.insert(0, 'file', filename)
+        summary.insert(1, 'animal_id', get_animal_id(f'{nwb_folder}/{nwb_file}'))
+        summary.insert(2, 'day', get_day(f'{nwb_folder}/{nwb_file}'))
+        summaries.append(summary)
+
+    summary = flag_channels(pd.concat(summaries, ignore_index=True), max_ploss, max_clip, max_flat, rms_z)
+    summary.to_csv(f'{qc_folder}/qc_summary.csv', index=False)
+    print(summary.loc[summary['bad'], ['file', 'channel', 'flag_ploss', 'flag_clip', 'flag_flat', 'flag_rms']])
+    print(f'Bad channels per animal: {bads_from_qc(summary)}')
@@ -0,0 +1,267 @@
+'''
+Phase-amplitude coupling (e.g. OFC theta phase / gamma amplitude) for a whole grid of band pairs at once
+
+Every phase and amplitude band is band-passed with one zero-phase SOS filter call over the whole
+(epochs, channels, samples) block, and its analytic signal comes from one FFT-based Hilbert transform.
+The coupling of all (phase, amplitude) pairs is then one (sparse for the phase bins) matrix multiply over time:
+    - mean vector length (Canolty 2006): |sum_t amp(t) exp(i phase(t))| / n_times
+    - modulation index (Tort 2010): KL divergence of the phase-binned mean amplitude from a uniform distribution
+These sums are additive over epochs, so PAC pooled over epochs is computed chunk by chunk.
+Surrogates circularly shift the amplitude within every epoch and reuse the phase weights, they are spread
+over threads and give the z-score of the observed PAC.
+'''
+
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from scipy import signal, sparse
+
+
+def make_bands(centers, width):
+    '''
+        Bands (n, 2) of the given width around the centers
+    '''
+    centers = np.asarray(centers, dtype=float)
+    return np.stack([centers - width / 2, centers + width / 2], axis=1)
+
+
+# Theta phase, gamma amplitude (the amplitude bands are wide enough for the theta sidebands)
+PHASE_BANDS = make_bands(np.arange(4, 13, 1), 2)
+AMP_BANDS = make_bands(np.arange(30, 91, 10), 20)
+
+
+@lru_cache(maxsize=64)
+def get_bandpass_sos(sfreq, low, high, order=4):
+    '''
+        Butterworth band-pass in second-order sections, cached per (sfreq, band, order)
+    '''
+    return signal.butter(order, [low, high], btype='bandpass', fs=sfreq, output='sos')
+
+
+def band_analytic(data, sfreq, bands, order=4):
+    '''
+        Analytic signal of every band
+
+        Args:
+            - data: np.array (epochs, channels, samples)
+            - sfreq: float, sampling frequency
+            - bands: array (bands, 2) of (low, high) in Hz
+            - order: int, Butterworth order (applied forwards and backwards)
+        Returns:
+            - complex np.array (epochs, channels, bands, samples)
+    '''
+    out = np.empty(data.shape[:-1] + (len(bands), data.shape[-1]), dtype=complex)
+    for i, (low, high) in enumerate(bands):
+        filtered = signal.sosfiltfilt(get_bandpass_sos(float(sfreq), float(low), float(high), order), data, axis=-1)
+        out[..., i, :] = signal.hilbert(filtered, axis=-1)
+    return out
+
+
+def phase_bins(phase, n_bins=18):
+    '''
+        Phase bin (0 to n_bins - 1) of every phase sample in radians
+    '''
+    return np.clip(((phase + np.pi) / (2 * np.pi) * n_bins).astype(int), 0, n_bins - 1)
+
+
+def phase_weights(phase, method='mi', n_bins=18):
+    '''
+        Phase weights that turn the coupling of all band pairs into one matrix multiply with the amplitude.
+        They only depend on the phase, so the amplitude shifted surrogates reuse them
+
+        Args:
+            - phase: np.array (epochs, channels, phase bands, samples), phase in radians
+            - method: str, "mi" or "mvl"
+            - n_bins: int, phase bins of the modulation index
+        Returns:
+            - weights: mvl: complex np.array exp(i phase) (epochs, channels, phase bands, samples)
+                mi: sparse one-hot matrix (epochs x channels x bins x phase bands, epochs x channels x samples)
+                that sums the amplitude samples per phase bin
+            - counts: number of samples in every sum of pac_sums, broadcastable to the sums
+    '''
+    n_epochs, n_channels, n_phase, n_times = phase.shape
+    if method == 'mvl':
+        return np.exp(1j * phase), np.full((n_epochs, n_channels, n_phase, 1), n_times)
+    elif method == 'mi':
+        n_series = n_epochs * n_channels
+        bins = phase_bins(phase, n_bins).reshape(n_series, n_phase, n_times)
+        series = np.arange(n_series)[:, np.newaxis, np.newaxis]
+        rows = (series * n_bins + bins) * n_phase + np.arange(n_phase)[:, np.newaxis]
+        cols = np.broadcast_to(series * n_times + np.arange(n_times), rows.shape)
+        weights = sparse.csr_matrix((np.ones(rows.size), (rows.ravel(), cols.ravel())),
+                                    shape=(n_series * n_bins * n_phase, n_series * n_times))
+        counts = np.asarray(weights.sum(axis=1)).reshape(n_epochs, n_channels, n_bins, n_phase, 1)
+        return weights, counts
+    raise NotImplementedError('Please chose either "mi", or "mvl" for method')
+
+
+def pac_sums(weights, amp, n_bins=None):
+    '''
+        Sums over time from which the coupling of every (phase band, amplitude band) pair follows.
+        They are additive over epochs, so pooled PAC is the PAC of the sums over epochs
+
+        Args:
+            - weights: phase_weights
+            - amp: np.array (epochs, channels, amplitude bands, samples), amplitude envelope
+            - n_bins: int, phase bins of the modulation index (None for mvl)
+        Returns:
+            - mvl: complex np.array (epochs, channels, phase bands, amplitude bands), sum of amp * exp(i phase)
+            - mi: np.array (epochs, channels, bins, phase bands, amplitude bands), sum of amp per phase bin
+    '''
+    n_epochs, n_channels, n_amp, _ = amp.shape
+    amp_t = np.swapaxes(amp, -1, -2)
+    if n_bins is None:
+        return weights @ amp_t
+    sums = weights @ amp_t.reshape(-1, n_amp)
+    return sums.reshape(n_epochs, n_channels, n_bins, -1, n_amp)
+
+
+def pac_from_sums(sums, counts, method='mi'):
+    '''
+        PAC values from (summed) pac_sums
+
+        Returns:
+            - np.array (..., phase bands, amplitude bands)
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'mvl':
+            return np.abs(sums) / counts
+        mean_amp = np.where(counts > 0, sums / counts, 0)
+        p = mean_amp / mean_amp.sum(axis=-3, keepdims=True)
+        plogp = np.where(p > 0, p * np.log(p), 0)
+    return 1 + plogp.sum(axis=-3) / np.log(sums.shape[-3])
+
+
+def _surrogate_sums(weights, counts, amp, method, n_bins, pooled, shifts):
+    '''
+        PAC (per epoch) or pooled sums of surrogates that circularly shift the amplitude of every epoch
+
+        Args:
+            - shifts: int array (surrogates, epochs), samples to shift (the same for all channels and bands)
+        Returns:
+            - list with per surrogate the per-epoch PAC, or the sums over the epochs if pooled
+    '''
+    n_times = amp.shape[-1]
+    bins = n_bins if method == 'mi' else None
+    out = []
+    for shift in shifts:
+        idx = (np.arange(n_times) - shift[:, np.newaxis]) % n_times
+        sums = pac_sums(weights, np.take_along_axis(amp, idx[:, np.newaxis, np.newaxis, :], axis=-1), bins)
+        out.append(sums.sum(axis=0) if pooled else pac_from_sums(sums, counts, method))
+    return out
+
+
+def compute_pac(data, sfreq, phase_bands=PHASE_BANDS, amp_bands=AMP_BANDS, method='mi', n_bins=18, pooled=False,
+                trim=0.0, order=4, n_surrogates=0, chunk_size=64, n_jobs=1, seed=None):
+    '''
+        PAC of every (phase band, amplitude band) pair
+
+        Args:
+            - data: np.array (epochs, channels, samples)
+            - sfreq: float, sampling frequency
+            - phase_bands, amp_bands: arrays (bands, 2) of (low, high) in Hz (see make_bands)
+            - method: str, "mi" (modulation index) or "mvl" (mean vector length)
+            - n_bins: int, phase bins of the modulation index
+            - pooled: bool, one PAC value over all epochs (recommended for short epochs) instead of one per epoch
+            - trim: float, seconds cut from both ends of every epoch after filtering (edge artefacts)
+            - order: int, Butterworth order
+            - n_surrogates: int, number of amplitude shifted surrogates for the z-score (0: no surrogates)
+            - chunk_size: int, number of epochs filtered at once (limits memory use)
+            - n_jobs: int, threads computing the surrogates
+            - seed: int, random seed of the surrogates
+        Returns:
+            - dict with pac (and z, surrogate_mean, surrogate_std with surrogates):
+                np.arrays (epochs, channels, phase bands, amplitude bands), without the epochs axis when pooled
+    '''
+    data = np.asarray(data, dtype=float)
+    n_trim = int(trim * sfreq)
+    n_times = data.shape[-1] - 2 * n_trim
+    rng = np.random.default_rng(seed)
+
+    pac, pooled_sums, pooled_counts = [], 0, 0
+    surr_sum, surr_sq, surr_pooled = [], [], None
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        phase = np.angle(band_analytic(chunk, sfreq, phase_bands, order))[..., n_trim:n_trim + n_times]
+        amp = np.abs(band_analytic(chunk, sfreq, amp_bands, order))[..., n_trim:n_trim + n_times]
+
+        weights, counts = phase_weights(phase, method, n_bins)
+        sums = pac_sums(weights, amp, n_bins if method == 'mi' else None)
+        if pooled:
+            pooled_sums = pooled_sums + sums.sum(axis=0)
+            pooled_counts = pooled_counts + counts.sum(axis=0)
+        else:
+            pac.append(pac_from_sums(sums, counts, method))
+        if not n_surrogates:
+            continue
+
+        # Shifts of at least 10% of the epoch, split over the threads
+        shifts = rng.integers(n_times // 10, n_times - n_times // 10 + 1, (n_surrogates, len(chunk)))
+        jobs = np.array_split(shifts, n_jobs) if n_jobs > 1 else [shifts]
+        run = lambda job: _surrogate_sums(weights, counts, amp, method, n_bins, pooled, job)
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            results = [r for job in pool.map(run, jobs) for r in job]
+        if pooled:
+            # The phase bin counts do not change with the shift, only the sums are added over the chunks
+            surr_pooled = np.stack(results) + (0 if surr_pooled is None else surr_pooled)
+        else:
+            surr_sum.append(sum(results))
+            surr_sq.append(sum(r ** 2 for r in results))
+
+    out = {'pac': pac_from_sums(pooled_sums, pooled_counts, method) if pooled else np.concatenate(pac)}
+    if n_surrogates:
+        if pooled:
+            surrogates = pac_from_sums(surr_pooled, pooled_counts, method)
+            mean, std = surrogates.mean(axis=0), surrogates.std(axis=0)
+        else:
+            mean = np.concatenate(surr_sum) / n_surrogates
+            std = np.sqrt(np.clip(np.concatenate(surr_sq) / n_surrogates - mean ** 2, 0, None))
+        out.update({
+            'surrogate_mean': mean,
+            'surrogate_std': std,
+            'z': (out['pac'] - mean) / std
+        })
+    return out
+
+
+def epochs_pac(epochs, picks=None, grouper=None, phase_bands=PHASE_BANDS, amp_bands=AMP_BANDS, **kwargs):
+    '''
+        Pooled PAC of an mne.Epochs object, optionally per metadata group, as a tidy DataFrame
+
+        Args:
+            - epochs: mne.Epochs
+            - picks: str or list of str, channel names. None uses all EEG channels
+            - grouper: str or list of str, metadata column(s) to group the epochs by (None uses all epochs)
+            - phase_bands, amp_bands: arrays (bands, 2)
+            - **kwargs: passed to compute_pac (method, n_surrogates, trim, n_jobs, ...)
+        Returns:
+            - pd.DataFrame with the columns of grouper, channel, phase_freq, amp_freq (band centers), pac (and z)
+    '''
+    if picks is None:
+        ch_names = [ch for ch, ch_type in zip(epochs.ch_names, epochs.get_channel_types()) if ch_type == 'eeg']
+    else:
+        ch_names = [picks] if isinstance(picks, str) else list(picks)
+    grouper = [] if grouper is None else ([grouper] if isinstance(grouper, str) else list(grouper))
+    groups = epochs.metadata.groupby(grouper).indices.items() if grouper else [((), np.arange(len(epochs)))]
+
+    phase_freqs, amp_freqs = np.mean(phase_bands, axis=1), np.mean(amp_bands, axis=1)
+    ch, ph, am = np.meshgrid(np.arange(len(ch_names)), np.arange(len(phase_freqs)), np.arange(len(amp_freqs)),
+                             indexing='ij')
+    dfs = []
+    for group, idx in groups:
+        out = compute_pac(epochs[idx].get_data(picks=ch_names), epochs.info['sfreq'], phase_bands, amp_bands,
+                          pooled=True, **kwargs)
+        df = pd.DataFrame({
+            'channel': np.array(ch_names)[ch.ravel()],
+            'phase_freq': phase_freqs[ph.ravel()],
+            'amp_freq': amp_freqs[am.ravel()],
+            'pac': out['pac'].ravel()
+        })
+        if 'z' in out:
+            df['z'] = out['z'].ravel()
+        group = group if isinstance(group, tuple) else (group,)
+        for k, col in enumerate(grouper):
+            df.insert(k, col, group[k])
+        dfs.append(df)
+    return pd.concat(dfs, ignore_index=True)
@@ -0,0 +1,82 @@
+'''
+Bounded producer/consumer pipeline that overlaps reading (HDF5 reads + decompression)
+with computation, using a reader thread and a ring of reusable buffers
+'''
+
+import threading
+import queue
+import time
+
+
+def run_pipeline(items, read_func, process_func, depth=2, verbose=True):
+    '''
+        Reads items in a background thread while the previous items are processed
+
+        The reader fills a ring of `depth` buffers. A buffer is only handed back to the reader
+        after process_func returned, so at most `depth` items are in memory at the same time.
+
+        Args:
+            - items: list, of things to read (e.g. files, or groups of segments)
+            - read_func: callable(item, out) -> data. out is the data previously read into this ring slot
+                (None on the first pass) and can be reused as the output buffer
+            - process_func: callable(item, data) -> result. data must not be kept after returning,
+                because its buffer is reused by the reader
+            - depth: int, number of ring buffers (how many items are prefetched)
+            - verbose: bool, print the time spent waiting on I/O versus computing
+        Returns:
+            - results: list of process_func results, in the order of items
+            - stats: dict with the seconds spent reading, waiting on I/O, computing and in total
+    '''
+    if depth < 1:
+        raise ValueError('depth must be at least 1')
+
+    slots = [None] * depth
+    free_slots = queue.Queue()
+    for slot in range(depth):
+        free_slots.put(slot)
+    full_slots = queue.Queue()
+    stop = threading.Event()
+    stats = {'read': 0.0, 'io_wait': 0.0, 'compute': 0.0, 'total': 0.0}
+
+    def reader():
+        for item in items:
+            slot = free_slots.get()
+            if stop.is_set():
+                return
+            try:
+                t0 = time.perf_counter()
+                slots[slot] = read_func(item, slots[slot])
+                stats['read'] += time.perf_counter() - t0
+            except Exception as e:
+                full_slots.put((None, e))
+                return
+            full_slots.put((slot, None))
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+
+    results = []
+    try:
+        for item in items:
+            t0 = time.perf_counter()
+            slot, error = full_slots.get()
+            stats['io_wait'] += time.perf_counter() - t0
+            if error is not None:
+                raise error
+
+            t0 = time.perf_counter()
+            results.append(process_func(item, slots[slot]))
+            stats['compute'] += time.perf_counter() - t0
+            free_slots.put(slot)
+    finally:
+        # Unblock the reader if we stopped early
+        stop.set()
+        free_slots.put(None)
+        thread.join()
+
+    stats['total'] = time.perf_counter() - start
+    if verbose:
+        print(f"Pipeline: {len(items)} items in {stats['total']:.2f} s "
+              f"(reading {stats['read']:.2f} s, waiting on I/O {stats['io_wait']:.2f} s, computing {stats['compute']:.2f} s)")
+    return results, stats
@@ -0,0 +1,112 @@
+'''
+On-disk cache for PSDs of epoch data
+
+PSDs are stored as .npz files named after a hash of the epoch data and of all PSD parameters
+(sfreq, fmin, fmax, method, bandwidth, ...), so the same data is never transformed twice.
+When the cache grows over max_bytes the least recently used files are removed.
+'''
+
+import numpy as np
+import hashlib
+import json
+import os
+import mne
+
+# Cache settings (see set_psd_cache)
+PSD_CACHE = {
+    'folder': 'psd_cache',
+    'max_bytes': 2 * 1024**3,
+    'enabled': True
+}
+
+
+def set_psd_cache(folder=None, max_bytes=None, enabled=None):
+    '''
+        Changes the cache folder, the maximum cache size in bytes or switches the cache on/off
+    '''
+    if folder is not None:
+        PSD_CACHE['folder'] = folder
+    if max_bytes is not None:
+        PSD_CACHE['max_bytes'] = max_bytes
+    if enabled is not None:
+        PSD_CACHE['enabled'] = enabled
+
+
+def psd_cache_key(data, sfreq, fmin, fmax, method, **kwargs):
+    '''
+        Returns the hex digest identifying a PSD computation: a hash of the data and of all parameters
+    '''
+    data = np.ascontiguousarray(data)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(str((data.shape, data.dtype.str)).encode())
+    h.update(data.view(np.uint8).data)
+    params = {'sfreq': float(sfreq), 'fmin': float(fmin), 'fmax': float(fmax), 'method': method, **kwargs}
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def evict_psd_cache(folder=None, max_bytes=None):
+    '''
+        Removes the least recently used cache files until the cache is smaller than max_bytes
+    '''
+    folder = folder or PSD_CACHE['folder']
+    max_bytes = PSD_CACHE['max_bytes'] if max_bytes is None else max_bytes
+    if not os.path.isdir(folder):
+        return
+
+    files = [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith('.npz')]
+    stats = sorted(((os.stat(f).st_mtime, os.stat(f).st_size, f) for f in files))
+    total = sum(size for _, size, _ in stats)
+    for _, size, f in stats:
+        if total <= max_bytes:
+            break
+        os.remove(f)
+        total -= size
+
+
+def psd_array_cached(data, sfreq, fmin=0, fmax=np.inf, method='multitaper', **kwargs):
+    '''
+        Drop-in for mne.time_frequency.psd_array_multitaper / psd_array_welch that looks up the result in the cache first
+
+        Args:
+            - data: np.array (..., samples), e.g. epochs.get_data(picks=channel)
+            - sfreq: float, sampling frequency
+            - fmin, fmax: float, frequency range
+            - method: str, "multitaper" or "welch"
+            - **kwargs: passed to the MNE psd function (e.g. bandwidth), and part of the cache key
+        Returns:
+            - psds, freqs as returned by MNE
+    '''
+    if method == 'multitaper':
+        psd_func = mne.time_frequency.psd_array_multitaper
+    elif method == 'welch':
+        psd_func = mne.time_frequency.psd_array_welch
+    else:
+        raise NotImplementedError('Please chose either "welch", or "multitaper" for method')
+
+    if not PSD_CACHE['enabled']:
+        return psd_func(data, sfreq=sfreq, fmin=fmin, fmax=fmax, **kwargs)
+
+    # verbose does not change the result
+    key_kwargs = {k: v for k, v in kwargs.items() if k != 'verbose'}
+    path = os.path.join(PSD_CACHE['folder'], f"{psd_cache_key(data, sfreq, fmin, fmax, method, **key_kwargs)}.npz")
+
+    if os.path.exists(path):
+        try:
+            with np.load(path) as f:
+                psds, freqs = f['psds'], f['freqs']
+            # Mark as recently used
+            os.utime(path)
+            return psds, freqs
+        except (OSError, ValueError, KeyError):
+            # Broken cache file (e.g. interrupted write), recompute it
+            os.remove(path)
+
+    psds, freqs = psd_func(data, sfreq=sfreq, fmin=fmin, fmax=fmax, **kwargs)
+
+    os.makedirs(PSD_CACHE['folder'], exist_ok=True)
+    tmp_path = f'{path[:-4]}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, psds=psds, freqs=freqs)
+    os.replace(tmp_path, path)
+    evict_psd_cache()
+    return psds, freqs
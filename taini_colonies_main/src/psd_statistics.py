@@ -0,0 +1,295 @@
+'''
+Statistics for PSD comparisons with epochs nested within animals
+
+Hierarchical bootstrap: every resample draws animals with replacement and then, within every drawn
+animal, its epochs with replacement. A resample is stored as a row of epoch weights, so a whole block
+of resamples is averaged with one (resamples, epochs) @ (epochs, freqs) matrix multiply.
+
+Cluster-based permutation test over frequency: the group labels of the per-animal mean spectra
+(or the signs of the per-animal differences for paired designs) are permuted, the t-statistics
+of a whole block of permutations are computed at once and blocks are spread over a process pool.
+'''
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from concurrent.futures import ProcessPoolExecutor
+
+
+def bootstrap_weights(animals, n_boot, level='hierarchical', rng=None):
+    '''
+        Epoch weight matrix of n_boot bootstrap resamples
+
+        The weights of one resample sum to 1 and give every drawn animal the same weight,
+        so weights @ psds is the mean over the drawn animals of their (resampled) epoch means.
+
+        Args:
+            - animals: 1D array (epochs,), animal of every epoch
+            - n_boot: int, number of resamples
+            - level: str, "hierarchical" (animals, then epochs within animals) or "animal" (animals only)
+            - rng: np.random.Generator
+        Returns:
+            - np.array (n_boot, epochs) of weights
+    '''
+    rng = np.random.default_rng(rng)
+    animal_names, animal_idx = np.unique(np.asarray(animals), return_inverse=True)
+    n_animals = len(animal_names)
+
+    # How often every animal is drawn in every resample
+    draws = rng.integers(0, n_animals, (n_boot, n_animals))
+    times_drawn = np.zeros((n_boot, n_animals), dtype=np.int64)
+    np.add.at(times_drawn, (np.arange(n_boot)[:, np.newaxis], draws), 1)
+
+    weights = np.zeros((n_boot, len(animal_idx)))
+    for a in range(n_animals):
+        epochs_a = np.where(animal_idx == a)[0]
+        n_a = len(epochs_a)
+        if level == 'hierarchical':
+            # Drawing n_a epochs k times is one multinomial with k * n_a trials
+            counts = rng.multinomial(times_drawn[:, a] * n_a, np.full(n_a, 1 / n_a))
+        elif level == 'animal':
+            counts = np.repeat(times_drawn[:, a:a + 1], n_a, axis=1)
+        else:
+            raise NotImplementedError('Please chose either "hierarchical", or "animal" for level')
+        weights[:, epochs_a] = counts / (n_a * n_animals)
+    return weights
+
+
+def animal_mean(data, animals):
+    '''
+        Mean over animals of the per-animal epoch means
+
+        Args:
+            - data: np.array (epochs, ...)
+            - animals: 1D array (epochs,), animal of every epoch
+        Returns:
+            - np.array (...)
+    '''
+    _, animal_idx, counts = np.unique(np.asarray(animals), return_inverse=True, return_counts=True)
+    weights = 1 / (counts[animal_idx] * len(counts))
+    return np.tensordot(weights, data, axes=1)
+
+
+def hierarchical_bootstrap_ci(data, animals, n_boot=10000, ci=0.95, level='hierarchical', chunk_size=1000, seed=None):
+    '''
+        Bootstrap confidence interval of the animal-level mean spectrum
+
+        Args:
+            - data: np.array (epochs, ...) e.g. PSDs (epochs, freqs) or (epochs, channels, freqs)
+            - animals: 1D array (epochs,), animal of every epoch (e.g. epochs.metadata['animal_id'])
+            - n_boot: int, number of resamples
+            - ci: float, confidence level
+            - level: str, "hierarchical" or "animal" (see bootstrap_weights)
+            - chunk_size: int, number of resamples per matrix multiply (limits memory use)
+            - seed: int, random seed
+        Returns:
+            - mean: np.array (...), mean over animals of the per-animal means
+            - lower, upper: np.array (...), percentile confidence interval
+    '''
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=float)
+    flat = data.reshape(len(data), -1)
+
+    boot = np.empty((n_boot, flat.shape[1]))
+    for start in range(0, n_boot, chunk_size):
+        n = min(chunk_size, n_boot - start)
+        boot[start:start + n] = bootstrap_weights(animals, n, level=level, rng=rng) @ flat
+
+    alpha = (1 - ci) / 2
+    lower, upper = np.quantile(boot, [alpha, 1 - alpha], axis=0)
+    shape = data.shape[1:]
+    return animal_mean(data, animals), lower.reshape(shape), upper.reshape(shape)
+
+
+def grouped_bootstrap_ci(data, metadata, grouper, animal_col='animal_id', **kwargs):
+    '''
+        hierarchical_bootstrap_ci per group of epochs
+
+        Args:
+            - data: np.array (epochs, ...)
+            - metadata: pd.DataFrame, epoch metadata (e.g. epochs.metadata)
+            - grouper: str, metadata column to group by (e.g. 'injection' or 'surgery')
+            - animal_col: str, metadata column with the animal of every epoch
+            - **kwargs: passed to hierarchical_bootstrap_ci
+        Returns:
+            - dict, group: (mean, lower, upper)
+    '''
+    groups = metadata[grouper].to_numpy()
+    animals = metadata[animal_col].to_numpy()
+    return {group: hierarchical_bootstrap_ci(data[groups == group], animals[groups == group], **kwargs)
+            for group in pd.unique(groups)}
+
+
+def subject_means(data, metadata, grouper, animal_col='animal_id'):
+    '''
+        Mean spectrum per animal and group, the units that are permuted in cluster_permutation_test
+
+        Args:
+            - data: np.array (epochs, freqs)
+            - metadata: pd.DataFrame, epoch metadata
+            - grouper: str, metadata column with exactly two groups
+            - animal_col: str, metadata column with the animal of every epoch
+        Returns:
+            - X: list of two np.arrays (animals, freqs), in the order of group_names
+            - group_names: list of the two groups
+            - animals: list of two arrays with the animal of every row of X
+    '''
+    keys = metadata[[grouper, animal_col]].astype(str).agg('|'.join, axis=1).to_numpy()
+    unit_names, unit_idx = np.unique(keys, return_inverse=True)
+    means = np.zeros((len(unit_names), data.shape[1]))
+    np.add.at(means, unit_idx, data)
+    means /= np.bincount(unit_idx)[:, np.newaxis]
+
+    unit_groups = np.array([name.split('|', 1)[0] for name in unit_names])
+    unit_animals = np.array([name.split('|', 1)[1] for name in unit_names])
+    group_names = [str(group) for group in pd.unique(metadata[grouper])]
+    if len(group_names) != 2:
+        raise ValueError(f'{grouper} needs exactly two groups, got {group_names}')
+    return ([means[unit_groups == group] for group in group_names], group_names,
+            [unit_animals[unit_groups == group] for group in group_names])
+
+
+def t_statistics(X, n1, perms=None, paired=False):
+    '''
+        t-statistics of a block of permutations
+
+        Args:
+            - X: np.array (units, freqs). Unpaired: rows of group 1 then group 2. Paired: the per-animal differences
+            - n1: int, number of units in group 1 (unpaired)
+            - perms: unpaired: int array (permutations, units) of row orders; paired: array (permutations, units)
+                of +-1 signs. None gives the observed statistic
+            - paired: bool, one-sample t-test on the differences (sign flips) or Student's two-sample t-test
+        Returns:
+            - np.array (permutations, freqs)
+    '''
+    n = X.shape[0]
+    if paired:
+        signs = np.ones((1, n)) if perms is None else perms
+        mean = signs @ X / n
+        var = (np.sum(X ** 2, axis=0) - n * mean ** 2) / (n - 1)
+        return mean / np.sqrt(var / n)
+
+    perms = np.arange(n)[np.newaxis] if perms is None else perms
+    n2 = n - n1
+    total, total_sq = X.sum(axis=0), np.sum(X ** 2, axis=0)
+    sum1 = X[perms[:, :n1]].sum(axis=1)
+    sq1 = (X ** 2)[perms[:, :n1]].sum(axis=1)
+    sum2, sq2 = total - sum1, total_sq - sq1
+    mean1, mean2 = sum1 / n1, sum2 / n2
+    pooled = (sq1 - n1 * mean1 ** 2 + sq2 - n2 * mean2 ** 2) / (n - 2)
+    return (mean1 - mean2) / np.sqrt(pooled * (1 / n1 + 1 / n2))
+
+
+def find_clusters(t_obs, threshold, tail=0):
+    '''
+        Contiguous runs of frequencies where the statistic exceeds the threshold
+
+        Returns:
+            - list of (indices, mass) with mass the sum of the t-values in the cluster
+    '''
+    clusters = []
+    for sign in ([1, -1] if tail == 0 else [tail]):
+        above = np.concatenate([[False], sign * t_obs > threshold, [False]])
+        starts = np.where(above[1:] & ~above[:-1])[0]
+        ends = np.where(~above[1:] & above[:-1])[0]
+        clusters.extend((np.arange(start, end), t_obs[start:end].sum()) for start, end in zip(starts, ends))
+    return sorted(clusters, key=lambda cluster: cluster[0][0])
+
+
+def max_cluster_masses(T, threshold, tail=0):
+    '''
+        Largest absolute cluster mass of every permutation, for a block of statistics T (permutations, freqs)
+    '''
+    n_perm, n_freqs = T.shape
+    out = np.zeros(n_perm)
+    for sign in ([1, -1] if tail == 0 else [tail]):
+        S = sign * T
+        # One flat array with a separator after every permutation, so runs never cross rows
+        values = np.zeros((n_perm, n_freqs + 1))
+        values[:, :n_freqs] = np.where(S > threshold, S, 0)
+        above = (values > 0).ravel()
+        values = values.ravel()
+
+        edges = np.diff(np.concatenate([[False], above, [False]]).astype(np.int8))
+        starts, ends = np.where(edges == 1)[0], np.where(edges == -1)[0]
+        if len(starts) == 0:
+            continue
+        cumsum = np.concatenate([[0], np.cumsum(values)])
+        np.maximum.at(out, starts // (n_freqs + 1), cumsum[ends] - cumsum[starts])
+    return out
+
+
+def _permutation_block(args):
+    '''
+        Max cluster masses of one block of random permutations (runs in a worker process)
+    '''
+    X, n1, paired, threshold, tail, n_perm, seed = args
+    rng = np.random.default_rng(seed)
+    if paired:
+        perms = rng.choice([-1., 1.], size=(n_perm, X.shape[0]))
+    else:
+        perms = np.argsort(rng.random((n_perm, X.shape[0])), axis=1)
+    return max_cluster_masses(t_statistics(X, n1, perms, paired), threshold, tail)
+
+
+def cluster_permutation_test(X, n_permutations=5000, threshold=None, tail=0, paired=False, n_jobs=None,
+                             block_size=500, seed=None):
+    '''
+        Cluster-based permutation test over frequencies with animals as the unit of permutation
+
+        Args:
+            - X: list of two np.arrays (animals, freqs), e.g. the per-animal mean (dB) spectra of subject_means.
+                For paired=True both arrays must have the same animals in the same order
+            - n_permutations: int
+            - threshold: float, cluster forming t-threshold (None: p < 0.05 of the t-distribution, two-sided for tail=0
+                and one-sided for tail=1 or -1, as MNE)
+            - tail: int, 0 (two-sided), 1 (group 1 > group 2) or -1
+            - paired: bool, sign flips of the per-animal differences (within-animal designs, e.g. CNO vs Saline)
+                instead of permuting group labels (between-animal designs, e.g. DREADDs vs mCherry)
+            - n_jobs: int, worker processes (None uses all cores, 1 runs in this process)
+            - block_size: int, permutations per vectorized block
+            - seed: int, random seed
+        Returns:
+            - t_obs: np.array (freqs,), observed t-statistic
+            - clusters: list of (indices,) tuples, as mne.stats.permutation_cluster_test
+            - cluster_p_values: np.array, p-value per cluster
+            - H0: np.array (n_permutations,), max absolute cluster mass per permutation
+    '''
+    if paired:
+        if X[0].shape != X[1].shape:
+            raise ValueError('Paired test needs the same animals in both groups')
+        data, n1 = X[0] - X[1], None
+        df = data.shape[0] - 1
+    else:
+        data, n1 = np.concatenate(X, axis=0), X[0].shape[0]
+        df = data.shape[0] - 2
+    data = np.asarray(data, dtype=float)
+    if threshold is None:
+        threshold = stats.t.ppf(1 - (0.05 / 2 if tail == 0 else 0.05), df)
+
+    t_obs = t_statistics(data, n1, paired=paired)[0]
+    clusters = find_clusters(t_obs, threshold, tail)
+
+    sizes = [min(block_size, n_permutations - start) for start in range(0, n_permutations, block_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    blocks = [(data, n1, paired, threshold, tail, size, block_seed) for size, block_seed in zip(sizes, seeds)]
+    if n_jobs == 1:
+        H0 = np.concatenate([_permutation_block(block) for block in blocks])
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            H0 = np.concatenate(list(pool.map(_permutation_block, blocks)))
+
+    cluster_p_values = np.array([(1 + np.sum(H0 >= abs(mass))) / (1 + n_permutations) for _, mass in clusters])
+    return t_obs, [(indices,) for indices, _ in clusters], cluster_p_values, H0
+
+
+def cluster_table(t_obs, clusters, cluster_p_values, freqs):
+    '''
+        Clusters of cluster_permutation_test as a DataFrame (fmin, fmax, mass, p_value)
+    '''
+    return pd.DataFrame({
+        'fmin': [freqs[c[0][0]] for c in clusters],
+        'fmax': [freqs[c[0][-1]] for c in clusters],
+        'mass': [t_obs[c[0]].sum() for c in clusters],
+        'p_value': cluster_p_values
+    })
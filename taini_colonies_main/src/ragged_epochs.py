@@ -0,0 +1,195 @@
+'''
+Ragged storage for variable-length behavior epochs
+
+A ragged store keeps all bouts of a file in one flat (channels, samples) buffer,
+together with an offsets array: bout i is data[:, offsets[i]:offsets[i+1]].
+This way every bout keeps its true duration without padding everything to the longest bout.
+
+The store is a plain dict with the keys:
+    - data: 2D np.array (channels, total samples)
+    - offsets: 1D np.array (bouts + 1) of sample offsets into data
+    - ch_names: list of str, channel names
+    - sfreq: float, sampling frequency
+    - metadata: pd.DataFrame, one row per bout
+'''
+
+import numpy as np
+import pandas as pd
+from scipy import signal
+
+
+def make_ragged_store(bouts, ch_names, sfreq, metadata):
+    '''
+        Creates a ragged store from a list of bouts
+
+        Args:
+            - bouts: list of 2D np.arrays (channels, samples), the samples can differ per bout
+            - ch_names: list of str, channel names
+            - sfreq: float, sampling frequency
+            - metadata: pd.DataFrame, one row per bout
+        Returns:
+            - dict, ragged store (see module docstring)
+    '''
+    lengths = np.array([bout.shape[-1] for bout in bouts], dtype=np.int64)
+    offsets = np.zeros(lengths.size + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    data = np.empty((len(ch_names), offsets[-1]))
+    for i, bout in enumerate(bouts):
+        data[:, offsets[i]:offsets[i + 1]] = bout
+
+    metadata = metadata.reset_index(drop=True)
+    metadata['epoch_n_samples'] = lengths
+    return {
+        'data': data,
+        'offsets': offsets,
+        'ch_names': list(ch_names),
+        'sfreq': sfreq,
+        'metadata': metadata
+    }
+
+
+def subset_ragged_store(store, mask):
+    '''
+        Selects bouts from a ragged store
+
+        Args:
+            - store: dict, ragged store
+            - mask: 1D bool array or array of bout indexes
+        Returns:
+            - dict, new ragged store with only the selected bouts
+    '''
+    idx = np.arange(len(store['offsets']) - 1)[mask]
+    return make_ragged_store(
+        [get_ragged_epoch(store, i) for i in idx],
+        store['ch_names'],
+        store['sfreq'],
+        store['metadata'].iloc[idx]
+    )
+
+
+def get_ragged_epoch(store, i):
+    '''
+        Returns a view of bout i as a 2D np.array (channels, samples)
+    '''
+    return store['data'][:, store['offsets'][i]:store['offsets'][i + 1]]
+
+
+def iter_ragged_epochs(store):
+    '''
+        Iterates over the bouts of a ragged store
+
+        Yields:
+            - tuple of (bout index, 2D np.array view (channels, samples))
+    '''
+    for i in range(len(store['offsets']) - 1):
+        yield i, get_ragged_epoch(store, i)
+
+
+def apply_ragged(store, func, **kwargs):
+    '''
+        Applies a per-bout feature function over a ragged store
+
+        Args:
+            - store: dict, ragged store
+            - func: callable, takes a 2D array (channels, samples) and the sfreq and returns a dict of features
+        Returns:
+            - pd.DataFrame of features joined to the bout metadata
+    '''
+    features = [func(bout, store['sfreq'], **kwargs) for _, bout in iter_ragged_epochs(store)]
+    return pd.concat([pd.DataFrame(features), store['metadata']], axis=1)
+
+
+def ragged_welch_psd(store, fmin=0, fmax=100, seg_length=1.0, overlap=0.5, window='hann'):
+    '''
+        Welch PSD per bout, computed over all bouts at once.
+        All Welch segments of all bouts are gathered in one (segments, channels, samples) block,
+        transformed with one rfft and averaged per bout with np.add.reduceat.
+        Because the segment length is fixed, every bout gets the same frequency grid whatever its duration.
+
+        Args:
+            - store: dict, ragged store
+            - fmin, fmax: float, frequency range to return
+            - seg_length: float, length of the Welch segments in seconds
+            - overlap: float, fraction of overlap between Welch segments
+            - window: str, window passed to scipy.signal.get_window
+        Returns:
+            - psds: 3D np.array (bouts, channels, freqs). Bouts shorter than seg_length are np.nan
+            - freqs: 1D np.array of frequencies
+    '''
+    sfreq = store['sfreq']
+    offsets = store['offsets']
+    n_bouts = len(offsets) - 1
+    nperseg = int(seg_length * sfreq)
+    step = max(int(nperseg * (1 - overlap)), 1)
+
+    # Number of full Welch segments that fit in every bout
+    lengths = np.diff(offsets)
+    n_segs = np.where(lengths >= nperseg, (lengths - nperseg) // step + 1, 0)
+
+    freqs = np.fft.rfftfreq(nperseg, 1 / sfreq)
+    fmask = (freqs >= fmin) & (freqs <= fmax)
+    psds = np.full((n_bouts, store['data'].shape[0], fmask.sum()), np.nan)
+    if n_segs.sum() == 0:
+        return psds, freqs[fmask]
+
+    # Start sample of every segment of every bout, in the flat buffer
+    bout_of_seg = np.repeat(np.arange(n_bouts), n_segs)
+    first_seg = np.concatenate([[0], np.cumsum(n_segs)[:-1]])
+    seg_in_bout = np.arange(n_segs.sum()) - np.repeat(first_seg, n_segs)
+    seg_starts = offsets[bout_of_seg] + seg_in_bout * step
+
+    # (segments, channels, samples) through fancy indexing of the flat buffer
+    segments = store['data'][:, seg_starts[:, None] + np.arange(nperseg)].transpose(1, 0, 2)
+    segments = signal.detrend(segments, axis=-1, type='constant')
+    win = signal.get_window(window, nperseg)
+    spec = np.abs(np.fft.rfft(segments * win, axis=-1)[..., fmask]) ** 2
+    spec /= sfreq * np.sum(win ** 2)
+
+    # One-sided spectrum: double everything except DC and Nyquist
+    scale = np.full(freqs.size, 2.0)
+    scale[0] = 1
+    if nperseg % 2 == 0:
+        scale[-1] = 1
+    spec *= scale[fmask]
+
+    # Average the segments per bout
+    has_segs = n_segs > 0
+    psds[has_segs] = np.add.reduceat(spec, first_seg[has_segs], axis=0) / n_segs[has_segs, None, None]
+    return psds, freqs[fmask]
+
+
+def save_ragged_store(store, path):
+    '''
+        Saves a ragged store as a single .npz file (metadata columns are stored with a "metadata/" prefix)
+    '''
+    metadata = {}
+    for col, values in store['metadata'].items():
+        # Store text columns as fixed-width strings so the file loads without pickle
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            metadata[f'metadata/{col}'] = values.to_numpy()
+        else:
+            metadata[f'metadata/{col}'] = values.to_numpy(dtype=str)
+    np.savez(
+        path,
+        data=store['data'],
+        offsets=store['offsets'],
+        ch_names=np.array(store['ch_names']),
+        sfreq=store['sfreq'],
+        **metadata
+    )
+
+
+def load_ragged_store(path):
+    '''
+        Loads a ragged store saved with save_ragged_store
+    '''
+    with np.load(path) as f:
+        metadata = pd.DataFrame({key.split('/', 1)[1]: f[key] for key in f.files if key.startswith('metadata/')})
+        return {
+            'data': f['data'],
+            'offsets': f['offsets'],
+            'ch_names': f['ch_names'].tolist(),
+            'sfreq': float(f['sfreq']),
+            'metadata': metadata
+        }
@@ -0,0 +1,257 @@
+'''
+Aperiodic (1/f) fits and peak detection for many spectra at once, FOOOF-style
+
+The aperiodic component log10(P) = offset - log10(knee + f^exponent) is fitted to all spectra together:
+    - without knee, it is a straight line in log-log space. Every spectrum has the same design matrix,
+      so the (masked) least-squares solutions of all spectra come from a few matrix multiplies
+    - with knee, a grid of (knee, exponent) curves is scored for all spectra with one matrix multiply
+      (the offset has a closed form) and the best grid point is refined with batched Gauss-Newton steps
+As in FOOOF, the final fit only uses the points at or below an initial fit, so peaks do not pull the fit up.
+Peaks are then the local maxima of the flattened spectra (log power minus the aperiodic fit).
+'''
+
+import numpy as np
+import pandas as pd
+from .spectral_engine import multitaper_psd
+
+# Same bands as band_power.FREQ_BANDS (delta is too low for a peak in most fits)
+PEAK_BANDS = {
+    'theta': (4, 8),
+    'alpha': (8, 13),
+    'beta': (13, 30),
+    'gamma': (30, 100)
+}
+
+
+def _line_fit(x, Y, mask):
+    '''
+        Masked least-squares line Y = offset - exponent * x for every row of Y (x shared by all rows)
+    '''
+    w = mask.astype(float)
+    n = w.sum(axis=1)
+    sx, sxx = w @ x, w @ x ** 2
+    sy, sxy = np.sum(w * Y, axis=1), np.sum(w * Y * x, axis=1)
+    slope = (n * sxy - sx * sy) / (n * sxx - sx ** 2)
+    offset = (sy - slope * sx) / n
+    return offset, -slope
+
+
+def _knee_curves(freqs, knee, exponent):
+    return np.log10(knee[..., np.newaxis] + freqs ** exponent[..., np.newaxis])
+
+
+def _knee_fit(freqs, Y, mask, knees, exponents, n_iter):
+    '''
+        Masked fit of Y = offset - log10(knee + f^exponent): grid search, then Gauss-Newton steps
+    '''
+    w = mask.astype(float)
+    n = w.sum(axis=1)
+
+    # Grid: for a fixed curve C the best offset is the masked mean of Y + C,
+    # and the squared error is sum(w (Y + C)^2) - (sum(w (Y + C)))^2 / n
+    grid_k, grid_e = [g.ravel() for g in np.meshgrid(knees, exponents)]
+    C = _knee_curves(freqs, grid_k, grid_e)  # (grid, freqs)
+    wy = w * Y
+    sse = (np.sum(wy * Y, axis=1)[:, np.newaxis] + 2 * wy @ C.T + w @ (C ** 2).T
+           - (wy.sum(axis=1)[:, np.newaxis] + w @ C.T) ** 2 / n[:, np.newaxis])
+    best = np.argmin(sse, axis=1)
+    knee, exponent = grid_k[best].copy(), grid_e[best].copy()
+    offset = np.sum(w * (Y + _knee_curves(freqs, knee, exponent)), axis=1) / n
+
+    log_f = np.log(freqs)
+    for _ in range(n_iter):
+        f_exp = freqs ** exponent[:, np.newaxis]
+        denom = (knee[:, np.newaxis] + f_exp) * np.log(10)
+        residual = w * (Y - offset[:, np.newaxis] + _knee_curves(freqs, knee, exponent))
+        # Jacobian of the model (spectra, freqs, [offset, knee, exponent])
+        J = np.stack([np.ones_like(f_exp), -1 / denom, -f_exp * log_f / denom], axis=-1) * w[..., np.newaxis]
+        JtJ = np.einsum('sfi,sfj->sij', J, J) + 1e-9 * np.eye(3)
+        step = np.linalg.solve(JtJ, np.einsum('sfi,sf->si', J, residual)[..., np.newaxis])[..., 0]
+        offset += step[:, 0]
+        knee = np.clip(knee + step[:, 1], 0, None)
+        exponent += step[:, 2]
+    return offset, knee, exponent
+
+
+def fit_aperiodic(psds, freqs, knee=False, ap_percentile=0.025, knees=None, exponents=None, n_iter=10):
+    '''
+        Aperiodic fit of many spectra at once
+
+        Args:
+            - psds: np.array (..., freqs) of power (not dB), e.g. (epochs, channels, freqs)
+            - freqs: 1D np.array of frequencies (> 0)
+            - knee: bool, fit a knee (for wide frequency ranges) or a straight line in log-log space
+            - ap_percentile: float, percentile (as FOOOF's ap_percentile_thresh) of the flattened spectrum,
+                points above it are left out of the final fit
+            - knees, exponents: 1D arrays, grid of the knee fit (None uses a default grid)
+            - n_iter: int, Gauss-Newton steps of the knee fit
+        Returns:
+            - dict of np.arrays (...): offset, exponent, knee (0 without knee), r_squared, error (mean absolute error),
+                and fit (..., freqs), the aperiodic fit in log10 power
+    '''
+    freqs = np.asarray(freqs, dtype=float)
+    if np.any(freqs <= 0):
+        raise ValueError('Frequencies must be > 0 for an aperiodic fit, please set fmin > 0')
+    shape = np.shape(psds)[:-1]
+    Y = np.log10(np.asarray(psds, dtype=float).reshape(-1, len(freqs)))
+    x = np.log10(freqs)
+
+    if knee:
+        knees = np.concatenate([[0], np.logspace(-1, 4, 26)]) if knees is None else knees
+        exponents = np.linspace(0.5, 4, 36) if exponents is None else exponents
+        model = lambda mask: _knee_fit(freqs, Y, mask, knees, exponents, n_iter)
+        curve = lambda offset, knee, exponent: offset[:, np.newaxis] - _knee_curves(freqs, knee, exponent)
+    else:
+        model = lambda mask: _line_fit(x, Y, mask)
+        curve = lambda offset, exponent: offset[:, np.newaxis] - exponent[:, np.newaxis] * x
+
+    # Initial fit on all points, then only the points at or below it
+    flat = np.clip(Y - curve(*model(np.ones(Y.shape, dtype=bool))), 0, None)
+    mask = flat <= np.percentile(flat, ap_percentile, axis=1, keepdims=True)
+    params = model(mask)
+    fit = curve(*params)
+    offset, exponent = params[0], params[-1]
+    knee_values = params[1] if knee else np.zeros(len(Y))
+
+    residual = Y - fit
+    r_squared = 1 - np.sum(residual ** 2, axis=1) / np.sum((Y - Y.mean(axis=1, keepdims=True)) ** 2, axis=1)
+    return {
+        'offset': offset.reshape(shape),
+        'exponent': exponent.reshape(shape),
+        'knee': knee_values.reshape(shape),
+        'r_squared': r_squared.reshape(shape),
+        'error': np.mean(np.abs(residual), axis=1).reshape(shape),
+        'fit': fit.reshape(shape + (len(freqs),))
+    }
+
+
+def find_peaks_batch(flat, freqs, max_n_peaks=6, min_peak_height=0.1, peak_threshold=2.0):
+    '''
+        Peaks of many flattened spectra at once
+
+        A peak is a local maximum that is higher than min_peak_height and than peak_threshold times the standard
+        deviation of its flattened spectrum. The bandwidth is the full width at half the peak height.
+
+        Args:
+            - flat: np.array (..., freqs), log10 power minus the aperiodic fit
+            - freqs: 1D np.array of (evenly spaced) frequencies
+            - max_n_peaks: int, the highest peaks are kept
+            - min_peak_height: float, in log10 power
+            - peak_threshold: float, in standard deviations of the flattened spectrum
+        Returns:
+            - dict of np.arrays (..., max_n_peaks), NaN padded and sorted by height: cf (center frequency),
+                pw (height above the aperiodic fit, log10 power), bw (bandwidth, Hz)
+    '''
+    shape = np.shape(flat)[:-1]
+    flat = np.asarray(flat, dtype=float).reshape(-1, len(freqs))
+    n_spectra, n_freqs = flat.shape
+    df = freqs[1] - freqs[0]
+
+    threshold = np.maximum(min_peak_height, peak_threshold * flat.std(axis=1))
+    is_peak = np.zeros(flat.shape, dtype=bool)
+    is_peak[:, 1:-1] = (flat[:, 1:-1] > flat[:, :-2]) & (flat[:, 1:-1] >= flat[:, 2:])
+    is_peak &= flat > threshold[:, np.newaxis]
+
+    # Keep the max_n_peaks highest peaks of every spectrum
+    height = np.where(is_peak, flat, -np.inf)
+    top = np.argsort(-height, axis=1)[:, :max_n_peaks]
+    top_height = np.take_along_axis(height, top, axis=1)
+    found = np.isfinite(top_height)
+    spectrum, idx = np.nonzero(found)[0], top[found]
+
+    # Walk out from all peaks at once until the flattened spectrum drops below half the peak height
+    half = flat[spectrum, idx] / 2
+    left, right = idx.copy(), idx.copy()
+    for _ in range(n_freqs):
+        move_left = (left > 0) & (flat[spectrum, np.maximum(left - 1, 0)] > half)
+        move_right = (right < n_freqs - 1) & (flat[spectrum, np.minimum(right + 1, n_freqs - 1)] > half)
+        if not (move_left.any() or move_right.any()):
+            break
+        left -= move_left
+        right += move_right
+
+    out = {key: np.full((n_spectra, max_n_peaks), np.nan) for key in ['cf', 'pw', 'bw']}
+    slot = np.nonzero(found)[1]
+    out['cf'][spectrum, slot] = freqs[idx]
+    out['pw'][spectrum, slot] = flat[spectrum, idx]
+    out['bw'][spectrum, slot] = (right - left + 1) * df
+    return {key: value.reshape(shape + (max_n_peaks,)) for key, value in out.items()}
+
+
+def parameterize_spectra(psds, freqs, knee=False, max_n_peaks=6, min_peak_height=0.1, peak_threshold=2.0, **kwargs):
+    '''
+        fit_aperiodic followed by find_peaks_batch on the flattened spectra
+
+        Returns:
+            - dict with the keys of fit_aperiodic and find_peaks_batch
+    '''
+    params = fit_aperiodic(psds, freqs, knee=knee, **kwargs)
+    flat = np.log10(psds) - params['fit']
+    params.update(find_peaks_batch(flat, freqs, max_n_peaks=max_n_peaks, min_peak_height=min_peak_height,
+                                   peak_threshold=peak_threshold))
+    return params
+
+
+def band_peaks(params, bands=PEAK_BANDS):
+    '''
+        Highest peak per band
+
+        Returns:
+            - dict, <band>_cf / <band>_pw / <band>_bw: np.array (...) (NaN without a peak in the band)
+    '''
+    out = {}
+    for band, (low, high) in bands.items():
+        in_band = (params['cf'] >= low) & (params['cf'] < high)
+        pw = np.where(in_band, params['pw'], -np.inf)
+        best = np.argmax(pw, axis=-1)[..., np.newaxis]
+        has_peak = np.isfinite(np.take_along_axis(pw, best, axis=-1))[..., 0]
+        for key in ['cf', 'pw', 'bw']:
+            out[f'{band}_{key}'] = np.where(has_peak, np.take_along_axis(params[key], best, axis=-1)[..., 0], np.nan)
+    return out
+
+
+def spectral_parameters(data, sfreq, ch_names, metadata=None, fmin=1, fmax=100, knee=False, bands=PEAK_BANDS,
+                        bandwidth=None, n_jobs=1, **kwargs):
+    '''
+        Per-epoch aperiodic and peak parameters of every channel
+
+        Args:
+            - data: np.array (epochs, channels, samples), e.g. epochs.get_data()
+            - sfreq: float, sampling frequency
+            - ch_names: list of str, channel names
+            - metadata: pd.DataFrame, epoch metadata (e.g. epochs.metadata), joined on the epoch index
+            - fmin, fmax: float, frequency range of the fit (fmin > 0)
+            - knee: bool, fit a knee
+            - bands: dict, band name: (fmin, fmax) for the highest peak per band
+            - bandwidth: float, multitaper bandwidth
+            - n_jobs: int, threads for the multitaper engine
+            - **kwargs: passed to parameterize_spectra
+        Returns:
+            - pd.DataFrame, one row per epoch and channel: epoch, channel, offset, exponent, knee, r_squared, error,
+                n_peaks and <band>_cf, <band>_pw, <band>_bw (+ metadata)
+    '''
+    psds, freqs = multitaper_psd(data, sfreq, fmin=fmin, fmax=fmax, bandwidth=bandwidth, n_jobs=n_jobs)
+    params = parameterize_spectra(psds, freqs, knee=knee, **kwargs)
+
+    n_epochs, n_channels = psds.shape[:2]
+    df = pd.DataFrame({
+        'epoch': np.repeat(np.arange(n_epochs), n_channels),
+        'channel': np.tile(ch_names, n_epochs)
+    })
+    for key in ['offset', 'exponent', 'knee', 'r_squared', 'error']:
+        df[key] = params[key].ravel()
+    df['n_peaks'] = np.sum(~np.isnan(params['cf']), axis=-1).ravel()
+    for key, values in band_peaks(params, bands).items():
+        df[key] = values.ravel()
+    if metadata is not None:
+        df = df.join(metadata.reset_index(drop=True), on='epoch')
+    return df
+
+
+def epochs_spectral_parameters(epochs, picks=None, **kwargs):
+    '''
+        spectral_parameters for an mne.Epochs object (metadata included)
+    '''
+    ch_names = list(epochs.ch_names) if picks is None else ([picks] if isinstance(picks, str) else list(picks))
+    return spectral_parameters(epochs.get_data(picks=ch_names), epochs.info['sfreq'], ch_names,
+                               metadata=epochs.metadata, **kwargs)
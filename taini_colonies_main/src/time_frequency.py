@@ -0,0 +1,195 @@
+'''
+Batched Morlet time-frequency power around behavior onsets (event-related spectral perturbation)
+
+Same wavelets and power as mne.time_frequency.tfr_array_morlet (use_fft=True, output='power'), but the FFTs
+of the whole Morlet family are computed once per (sfreq, freqs, n_cycles, n_times), and every block of
+epochs is transformed with one FFT that is reused for all wavelets. The wavelets are stored circularly
+centered, so the inverse FFT gives the 'same' convolution directly and only the decimated samples are kept.
+Large sets are written block by block to a .npy file on disk.
+'''
+
+import numpy as np
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from scipy import fft
+
+BASELINE_MODES = ['mean', 'ratio', 'logratio', 'percent', 'zscore', 'zlogratio']
+
+
+def morlet_wavelet(sfreq, freq, n_cycles=7.0, zero_mean=False):
+    '''
+        Complex Morlet wavelet as mne.time_frequency.morlet
+    '''
+    sigma_t = n_cycles / (2.0 * np.pi * freq)
+    t = np.arange(0.0, 5.0 * sigma_t, 1.0 / sfreq)
+    t = np.r_[-t[::-1], t[1:]]
+    oscillation = np.exp(2.0 * 1j * np.pi * freq * t)
+    if zero_mean:
+        oscillation -= np.exp(-2 * np.pi ** 2 * freq ** 2 * sigma_t ** 2)
+    W = oscillation * np.exp(-t ** 2 / (2.0 * sigma_t ** 2))
+    return W / (np.sqrt(0.5) * np.linalg.norm(W))
+
+
+@lru_cache(maxsize=16)
+def get_morlet_family(sfreq, freqs, n_cycles, n_times, zero_mean=False):
+    '''
+        FFTs of a Morlet family, centered at sample 0, cached per (sfreq, freqs, n_cycles, n_times)
+
+        Args:
+            - sfreq: float, sampling frequency
+            - freqs: tuple of float, wavelet frequencies
+            - n_cycles: tuple of float, cycles per wavelet (one per frequency)
+            - n_times: int, epoch length in samples
+        Returns:
+            - W_fft: complex np.array (freqs, n_fft), read-only
+            - n_fft: int, FFT length (no wrap-around of the 'same' convolution)
+    '''
+    wavelets = [morlet_wavelet(sfreq, freq, cycles, zero_mean) for freq, cycles in zip(freqs, n_cycles)]
+    longest = max(len(W) for W in wavelets)
+    if longest > n_times:
+        raise ValueError(f'At least one of the wavelets ({longest} samples) is longer than the epochs ({n_times} '
+                         'samples). Use fewer n_cycles, higher frequencies or longer epochs (relative_start)')
+    n_fft = fft.next_fast_len(n_times + longest - 1)
+
+    family = np.zeros((len(wavelets), n_fft), dtype=complex)
+    for i, W in enumerate(wavelets):
+        half = len(W) // 2
+        family[i, :len(W) - half] = W[half:]
+        family[i, n_fft - half:] = W[:half]
+    W_fft = fft.fft(family, axis=-1)
+    W_fft.flags.writeable = False
+    return W_fft, n_fft
+
+
+def _tfr_chunk(x, W_fft, n_fft, n_times, decim, output):
+    '''
+        Power (or complex coefficients) of one chunk (epochs, channels, samples) -> (epochs, channels, freqs, times)
+    '''
+    x_fft = fft.fft(x, n=n_fft, axis=-1)
+    coefs = fft.ifft(x_fft[..., np.newaxis, :] * W_fft, axis=-1)[..., :n_times:decim]
+    if output == 'complex':
+        return coefs
+    return coefs.real ** 2 + coefs.imag ** 2
+
+
+def tfr_morlet(data, sfreq, freqs, n_cycles=7.0, decim=1, output='power', zero_mean=False, chunk_size=16, n_jobs=1):
+    '''
+        Morlet time-frequency decomposition of a whole block of epochs
+
+        Args:
+            - data: np.array (epochs, channels, samples)
+            - sfreq: float, sampling frequency
+            - freqs: 1D array of frequencies
+            - n_cycles: float or 1D array (one per frequency), e.g. freqs / 2
+            - decim: int, keep every decim-th sample of the output
+            - output: str, "power" or "complex"
+            - zero_mean: bool, zero mean wavelets (as MNE)
+            - chunk_size: int, number of epochs transformed at once (limits memory use)
+            - n_jobs: int, number of threads working on separate chunks
+        Returns:
+            - np.array (epochs, channels, freqs, times), the same layout as MNE
+    '''
+    if output not in ['power', 'complex']:
+        raise NotImplementedError('Please chose either "power", or "complex" for output')
+    data = np.asarray(data, dtype=float)
+    n_times = data.shape[-1]
+    freqs = tuple(np.atleast_1d(freqs).astype(float))
+    n_cycles = tuple(np.broadcast_to(np.asarray(n_cycles, dtype=float), (len(freqs),)))
+    W_fft, n_fft = get_morlet_family(float(sfreq), freqs, n_cycles, n_times, zero_mean)
+
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    run = lambda chunk: _tfr_chunk(chunk, W_fft, n_fft, n_times, decim, output)
+    if n_jobs == 1 or len(chunks) == 1:
+        return np.concatenate([run(chunk) for chunk in chunks])
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        return np.concatenate(list(pool.map(run, chunks)))
+
+
+def baseline_normalize(power, times, baseline=(None, 0), mode='logratio'):
+    '''
+        Baseline normalization of power (..., times), as mne.baseline.rescale
+
+        Args:
+            - power: np.array (..., times)
+            - times: 1D np.array, time of every sample relative to the behavior onset (s)
+            - baseline: tuple (start, end) in seconds, None is the first / last sample
+            - mode: str, "mean", "ratio", "logratio" (log10), "percent", "zscore" or "zlogratio"
+        Returns:
+            - np.array (..., times)
+    '''
+    start = times[0] if baseline[0] is None else baseline[0]
+    end = times[-1] if baseline[1] is None else baseline[1]
+    in_baseline = (times >= start) & (times <= end)
+    if not in_baseline.any():
+        raise ValueError(f'No samples in the baseline {baseline}, times are {times[0]} to {times[-1]} s')
+
+    mean = power[..., in_baseline].mean(axis=-1, keepdims=True)
+    if mode == 'mean':
+        return power - mean
+    elif mode == 'ratio':
+        return power / mean
+    elif mode == 'logratio':
+        return np.log10(power / mean)
+    elif mode == 'percent':
+        return (power - mean) / mean
+    elif mode == 'zscore':
+        return (power - mean) / power[..., in_baseline].std(axis=-1, keepdims=True)
+    elif mode == 'zlogratio':
+        log_ratio = np.log10(power / mean)
+        return log_ratio / log_ratio[..., in_baseline].std(axis=-1, keepdims=True)
+    raise NotImplementedError(f'Unknown baseline mode {mode}, please chose from {BASELINE_MODES}')
+
+
+def epochs_tfr(epochs, freqs, n_cycles=7.0, picks=None, decim=1, baseline=(None, 0), mode='logratio', zero_mean=True,
+               path=None, block_size=256, **kwargs):
+    '''
+        Per-epoch baseline normalized Morlet power of an mne.Epochs object and the ERSP (normalized mean power)
+
+        The epochs should include a pre-onset baseline, e.g. epoch_eeg(..., relative_start=-1, epoch_length=3).
+        The epochs are read and transformed block_size at a time. With a path the per-epoch power is written
+        to a .npy file block by block (opened again with np.load(path, mmap_mode='r')), so the whole
+        (epochs, channels, freqs, times) array never has to fit in memory.
+
+        Args:
+            - epochs: mne.Epochs (epochs.times relative to the behavior onset)
+            - freqs: 1D array of frequencies
+            - n_cycles: float or 1D array
+            - picks: str or list of str, channel names. None uses all channels
+            - decim: int, keep every decim-th sample of the output
+            - baseline: tuple (start, end) in seconds, None does not normalize
+            - mode: str, baseline mode (see baseline_normalize)
+            - zero_mean: bool, zero mean wavelets (the default of epochs.compute_tfr)
+            - path: str, .npy file for the per-epoch power. None keeps it in memory
+            - block_size: int, number of epochs read at once
+            - **kwargs: passed to tfr_morlet (chunk_size, n_jobs)
+        Returns:
+            - power: np.array (epochs, channels, freqs, times) (a read-only memmap if path is given)
+            - ersp: np.array (channels, freqs, times), baseline normalized mean power over epochs
+            - times: 1D np.array of the (decimated) times
+    '''
+    ch_names = list(epochs.ch_names) if picks is None else ([picks] if isinstance(picks, str) else list(picks))
+    times = epochs.times[::decim]
+    shape = (len(epochs), len(ch_names), len(freqs), len(times))
+    if path is None:
+        power = np.empty(shape)
+    else:
+        power = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+
+    total = np.zeros(shape[1:])
+    for start in range(0, len(epochs), block_size):
+        block = epochs[start:start + block_size].get_data(picks=ch_names)
+        block_power = tfr_morlet(block, epochs.info['sfreq'], freqs, n_cycles=n_cycles, decim=decim,
+                                 zero_mean=zero_mean, **kwargs)
+        total += block_power.sum(axis=0)
+        if baseline is not None:
+            block_power = baseline_normalize(block_power, times, baseline, mode)
+        power[start:start + len(block_power)] = block_power
+
+    ersp = total / len(epochs)
+    if baseline is not None:
+        ersp = baseline_normalize(ersp, times, baseline, mode)
+    if path is not None:
+        power.flush()
+        del power
+        power = np.load(path, mmap_mode='r')
+    return power, ersp, times